@@ -56,10 +56,13 @@ def run(args):
     print(f"Pipeline stage {args.rank} {get_number_of_params(smod) // 10 ** 6}M params")
 
     # Create schedule runtime
+    # The encoder output is consumed by every decoder stage: relay it from
+    # one to the next rather than sending a copy to each
     stage = PipelineStage(
         pipe,
         args.rank,
         device=args.device,
+        multicast=True,
     )
 
     # Attach to a schedule
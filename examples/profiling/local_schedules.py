@@ -0,0 +1,90 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+# Compares the step time of the schedules on a pipeline of MLP blocks, with
+# all stages running as threads of this process (see `LocalPipeline`).
+#
+# Run command:
+# python local_schedules.py --stages 4 --threads_per_stage 2
+
+import argparse
+import time
+
+import torch
+
+from pippy import (
+    LocalPipeline,
+    pipe_split,
+    pipeline,
+    Schedule1F1B,
+    ScheduleGPipe,
+    ScheduleInterleaved1F1B,
+    ScheduleLoopedBFS,
+    ScheduleZeroBubbleH1,
+)
+
+
+class MLPBlocks(torch.nn.Module):
+    def __init__(self, d_hid, n_stages):
+        super().__init__()
+        self.blocks = torch.nn.ModuleList(
+            [
+                torch.nn.Sequential(
+                    torch.nn.Linear(d_hid, 4 * d_hid),
+                    torch.nn.ReLU(),
+                    torch.nn.Linear(4 * d_hid, d_hid),
+                )
+                for _ in range(n_stages)
+            ]
+        )
+
+    def forward(self, x):
+        for i, block in enumerate(self.blocks):
+            if i > 0:
+                pipe_split()
+            x = x + block(x)
+        return x
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=int, default=4)
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--d_hid", type=int, default=1024)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--threads_per_stage", type=int, default=1)
+    args = parser.parse_args(args)
+
+    torch.set_num_threads(args.threads_per_stage)
+    torch.manual_seed(0)
+    x = torch.randn(args.chunks * args.batch_size, args.d_hid)
+    target = torch.randn(args.chunks * args.batch_size, args.d_hid)
+    mod = MLPBlocks(args.d_hid, args.stages)
+    loss_fn = torch.nn.MSELoss()
+
+    for schedule_class, num_ranks in [
+        (ScheduleGPipe, None),
+        (Schedule1F1B, None),
+        (ScheduleZeroBubbleH1, None),
+        (ScheduleLoopedBFS, args.stages // 2),
+        (ScheduleInterleaved1F1B, args.stages // 2),
+    ]:
+        pipe = pipeline(
+            mod, args.chunks, example_args=(x.chunk(args.chunks)[0],)
+        )
+        runner = LocalPipeline(
+            pipe, schedule_class, args.chunks, loss_fn, num_ranks=num_ranks
+        )
+        # Warmup
+        runner.step(x, target=target)
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            runner.step(x, target=target)
+        step_time = (time.perf_counter() - start) / args.iters
+        runner.shutdown()
+        print(
+            f"{schedule_class.__name__:>24}: step time {step_time * 1e3:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
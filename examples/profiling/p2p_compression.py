@@ -0,0 +1,144 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+# Reports, for each activation / gradient codec, the bytes a stage sends per
+# step and the end-to-end step time of a pipeline of MLP blocks.
+#
+# Run command:
+# torchrun --nproc-per-node 4 p2p_compression.py
+# (add `--cuda` to run on GPUs with NCCL)
+
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+from pippy import (
+    CastCodec,
+    Int8Codec,
+    ManualPipelineStage,
+    Schedule1F1B,
+    TopKCodec,
+)
+
+
+class MLPBlock(torch.nn.Module):
+    def __init__(self, d_hid):
+        super().__init__()
+        self.net = torch.nn.Sequential(
+            torch.nn.Linear(d_hid, 4 * d_hid),
+            torch.nn.ReLU(),
+            torch.nn.Linear(4 * d_hid, d_hid),
+        )
+
+    def forward(self, x):
+        return x + self.net(x)
+
+
+# (name, activation codec, gradient codec)
+CODECS = [
+    ("none", None, None),
+    ("bf16", CastCodec(torch.bfloat16), CastCodec(torch.bfloat16)),
+    ("fp16", CastCodec(torch.float16), CastCodec(torch.float16)),
+    ("int8", Int8Codec(), Int8Codec()),
+    ("int8 per channel", Int8Codec(per_channel=True), Int8Codec()),
+    ("bf16 + top-1% grads", CastCodec(torch.bfloat16), TopKCodec(0.01)),
+]
+
+
+def run_codec(args, act_codec, grad_codec):
+    torch.manual_seed(0)
+    mod = MLPBlock(args.d_hid)
+    x = torch.randn(args.chunks * args.batch_size, args.d_hid)
+    target = torch.randn(args.chunks * args.batch_size, args.d_hid)
+
+    stage = ManualPipelineStage(
+        mod,
+        args.rank,
+        args.world_size,
+        args.device,
+        args.chunks,
+        input_args=x.chunk(args.chunks)[0],
+        act_codec=act_codec,
+        grad_codec=grad_codec,
+    )
+    schedule = Schedule1F1B(stage, args.chunks, loss_fn=torch.nn.MSELoss())
+
+    def step():
+        if args.rank == 0:
+            schedule.step(x.to(args.device))
+        elif args.rank == args.world_size - 1:
+            schedule.step(target=target.to(args.device))
+        else:
+            schedule.step()
+
+    # Warmup
+    step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        step()
+    if args.device.type == "cuda":
+        torch.cuda.synchronize()
+    dist.barrier()
+    step_time = (time.perf_counter() - start) / args.iters
+
+    # Activations sent forward and gradients sent back, per microbatch
+    example = x.chunk(args.chunks)[0]
+    wire_bytes = [
+        example.numel() * example.element_size()
+        if codec is None
+        else codec.wire_bytes(example)
+        for codec in (act_codec, grad_codec)
+    ]
+    return args.chunks * sum(wire_bytes), step_time
+
+
+def run_worker(args):
+    for name, act_codec, grad_codec in CODECS:
+        step_bytes, step_time = run_codec(args, act_codec, grad_codec)
+        if args.rank == 1:
+            print(
+                f"{name:>20}: {step_bytes / 2**20:8.2f} MiB on the wire per "
+                f"stage boundary and step, step time {step_time * 1e3:8.2f} ms"
+            )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--world_size", type=int, default=int(os.getenv("WORLD_SIZE", 4))
+    )
+    parser.add_argument("--rank", type=int, default=int(os.getenv("RANK", -1)))
+    parser.add_argument(
+        "--master_addr", type=str, default=os.getenv("MASTER_ADDR", "localhost")
+    )
+    parser.add_argument(
+        "--master_port", type=str, default=os.getenv("MASTER_PORT", "29500")
+    )
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--d_hid", type=int, default=1024)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args(args)
+
+    if args.cuda:
+        dev_id = args.rank % torch.cuda.device_count()
+        args.device = torch.device(f"cuda:{dev_id}")
+        torch.cuda.set_device(args.device)
+        backend = "nccl"
+    else:
+        args.device = torch.device("cpu")
+        backend = "gloo"
+    dist.init_process_group(
+        backend=backend,
+        rank=args.rank,
+        world_size=args.world_size,
+    )
+
+    run_worker(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+# Measures the host (CPU) time spent building P2P ops per microbatch, with the
+# stage's communication plan reused ("planned") and rebuilt for every
+# microbatch as before plans were cached ("rebuilt").
+#
+# Run command:
+# torchrun --nproc-per-node 4 p2p_host_overhead.py
+
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+from pippy import ManualPipelineStage, ScheduleGPipe
+
+
+class MultiTensorBlock(torch.nn.Module):
+    """
+    Passes `n_tensors` small tensors across each stage boundary, like the
+    hidden states, masks and position ids of a transformer layer.
+    """
+
+    def __init__(self, d_hid, n_tensors):
+        super().__init__()
+        self.lins = torch.nn.ModuleList(
+            [torch.nn.Linear(d_hid, d_hid) for _ in range(n_tensors)]
+        )
+
+    def forward(self, *xs):
+        return tuple(lin(x) for lin, x in zip(self.lins, xs))
+
+
+def get_all_ops(stage, chunks):
+    for chunk in range(chunks):
+        stage.get_fwd_recv_ops(chunk)
+        stage.get_fwd_send_ops()
+        stage.get_bwd_recv_ops(chunk)
+        stage.get_bwd_send_ops()
+
+
+def time_per_microbatch(stage, chunks, iters, rebuild):
+    start = time.perf_counter()
+    for _ in range(iters):
+        if rebuild:
+            stage._clear_comm_plan()
+        get_all_ops(stage, chunks)
+    return (time.perf_counter() - start) / (iters * chunks)
+
+
+def run_worker(args):
+    torch.manual_seed(0)
+    mod = MultiTensorBlock(args.d_hid, args.n_tensors)
+    xs = [
+        torch.randn(args.chunks * args.batch_size, args.d_hid)
+        for _ in range(args.n_tensors)
+    ]
+    target = torch.randn(args.chunks * args.batch_size, args.d_hid)
+
+    stage = ManualPipelineStage(
+        mod,
+        args.rank,
+        args.world_size,
+        args.device,
+        args.chunks,
+        input_args=[x.chunk(args.chunks)[0] for x in xs],
+    )
+    schedule = ScheduleGPipe(
+        stage,
+        args.chunks,
+        loss_fn=lambda out, target: sum(
+            torch.nn.functional.mse_loss(o, target) for o in out
+        ),
+    )
+
+    # One step to populate the outputs and gradients the send ops refer to
+    if args.rank == 0:
+        schedule.step(*xs)
+    elif args.rank == args.world_size - 1:
+        schedule.step(target=target)
+    else:
+        schedule.step()
+    dist.barrier()
+    # The schedule releases the outputs of a chunk once sent: forward one
+    # more chunk, whose outputs the send ops are built from
+    stage.forward_one_chunk(tuple(x.chunk(args.chunks)[0] for x in xs))
+
+    rebuilt = time_per_microbatch(stage, args.chunks, args.iters, True)
+    planned = time_per_microbatch(stage, args.chunks, args.iters, False)
+    print(
+        f"Rank {args.rank}: host time to build P2P ops per microbatch, "
+        f"rebuilt: {rebuilt * 1e6:.1f} us, planned: {planned * 1e6:.1f} us "
+        f"({rebuilt / planned:.1f}x)"
+    )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--world_size", type=int, default=int(os.getenv("WORLD_SIZE", 4))
+    )
+    parser.add_argument("--rank", type=int, default=int(os.getenv("RANK", -1)))
+    parser.add_argument(
+        "--master_addr", type=str, default=os.getenv("MASTER_ADDR", "localhost")
+    )
+    parser.add_argument(
+        "--master_port", type=str, default=os.getenv("MASTER_PORT", "29500")
+    )
+    parser.add_argument("--chunks", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--d_hid", type=int, default=16)
+    parser.add_argument("--n_tensors", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=100)
+    args = parser.parse_args(args)
+
+    # Host overhead matters most for small CPU microbatches
+    args.device = torch.device("cpu")
+    dist.init_process_group(
+        backend="gloo",
+        rank=args.rank,
+        world_size=args.world_size,
+    )
+
+    run_worker(args)
+
+
+if __name__ == "__main__":
+    main()
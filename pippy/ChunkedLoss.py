@@ -0,0 +1,126 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Cross entropy of a language model head computed in chunks of tokens, so that
+the `[tokens, vocab]` logits are never materialized at once.
+
+The last stage of the pipeline returns the hidden states, and the output
+projection (the "head") is applied by the loss, which a schedule computes on
+the last stage right after its forward:
+
+    loss_fn = ChunkedCrossEntropyLoss(lm_head, chunk_size=1024)
+    schedule = Schedule1F1B(stage, chunks, loss_fn=loss_fn)
+
+The logits of each chunk are freed once its loss is computed, and computed
+again in backward. Since the loss is known as soon as the forward is done,
+the schedule does not keep the outputs of the last stage unless asked to
+(see `return_outputs`).
+"""
+
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def _cross_entropy_sum(
+    hidden: torch.Tensor,
+    target: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    ignore_index: int,
+) -> torch.Tensor:
+    logits = F.linear(hidden, weight, bias)
+    return F.cross_entropy(
+        logits.float(), target, ignore_index=ignore_index, reduction="sum"
+    )
+
+
+def chunked_cross_entropy(
+    hidden: torch.Tensor,
+    weight: torch.Tensor,
+    target: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    chunk_size: int = 1024,
+    ignore_index: int = -100,
+    reduction: str = "mean",
+) -> torch.Tensor:
+    """
+    Cross entropy of the logits `hidden @ weight.T + bias` against `target`,
+    computed `chunk_size` tokens at a time. `hidden` is `[..., hidden_dim]`
+    and `target` has its leading dimensions. Only the logits of one chunk
+    exist at a time, in forward as in backward: each chunk saves its inputs
+    only and computes its logits again for its gradients.
+
+    `reduction` is "mean", over the tokens whose target is not
+    `ignore_index`, or "sum".
+    """
+    if reduction not in ("mean", "sum"):
+        raise ValueError(
+            f"Expected reduction 'mean' or 'sum' but got {reduction!r}"
+        )
+    if chunk_size <= 0:
+        raise ValueError(f"Expected a positive chunk size but got {chunk_size}")
+    if hidden.shape[:-1] != target.shape:
+        raise ValueError(
+            f"Hidden states of shape {list(hidden.shape)} do not match targets of shape {list(target.shape)}"
+        )
+    hidden = hidden.reshape(-1, hidden.size(-1))
+    target = target.reshape(-1)
+
+    loss = hidden.new_zeros((), dtype=torch.float32)
+    for hidden_chunk, target_chunk in zip(
+        hidden.split(chunk_size), target.split(chunk_size)
+    ):
+        loss = loss + checkpoint(
+            _cross_entropy_sum,
+            hidden_chunk,
+            target_chunk,
+            weight,
+            bias,
+            ignore_index,
+            use_reentrant=False,
+        )
+    if reduction == "sum":
+        return loss
+    # As `F.cross_entropy`, nan if all targets are ignored
+    return loss / (target != ignore_index).sum()
+
+
+class ChunkedCrossEntropyLoss(torch.nn.Module):
+    """
+    Loss applying the output projection `head` to the hidden states and
+    taking the cross entropy against the targets, in chunks of `chunk_size`
+    tokens (see `chunked_cross_entropy`). To pass as the `loss_fn` of a
+    schedule, which then accumulates the gradients of `head` with those of
+    the last stage.
+    """
+
+    # The schedules do not return the outputs of the last stage by default
+    _return_outputs = False
+
+    def __init__(
+        self,
+        head: torch.nn.Linear,
+        chunk_size: int = 1024,
+        ignore_index: int = -100,
+        reduction: str = "mean",
+    ):
+        super().__init__()
+        self.head = head
+        self.chunk_size = chunk_size
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+
+    def forward(
+        self, hidden: torch.Tensor, target: torch.Tensor
+    ) -> torch.Tensor:
+        return chunked_cross_entropy(
+            hidden,
+            self.head.weight,
+            target,
+            self.head.bias,
+            self.chunk_size,
+            self.ignore_index,
+            self.reduction,
+        )
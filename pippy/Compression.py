@@ -0,0 +1,200 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Codecs compressing the activations and gradients sent between pipeline
+stages.
+
+A stage given a codec encodes each tensor it sends into one or more "wire"
+tensors, which are sent instead, and decodes the wire tensors it receives
+into its receive buffers. The wire buffers are allocated with the receive
+buffers, from the shape and dtype of the tensor they carry. Stages sending to
+each other must use the same codecs.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Dict, Hashable, List
+
+import torch
+
+
+class Codec(ABC):
+    """
+    Encodes a tensor into wire tensors of fixed shapes, given by the shape
+    and dtype of the tensor.
+    """
+
+    @abstractmethod
+    def wire_buffers(self, example: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Allocate the wire tensors a tensor like `example` is encoded into.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def encode(self, tensor: torch.Tensor, key: Hashable) -> List[torch.Tensor]:
+        """
+        Encode `tensor` into contiguous wire tensors, shaped like those of
+        `wire_buffers`. `key` identifies the stream of tensors `tensor` belongs
+        to (the same output of the same stage across microbatches), for codecs
+        keeping state across them.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, wire: List[torch.Tensor], out: torch.Tensor) -> None:
+        """
+        Decode the wire tensors `wire` into `out`.
+        """
+        raise NotImplementedError
+
+    def wire_bytes(self, example: torch.Tensor) -> int:
+        """
+        Number of bytes sent for a tensor like `example`.
+        """
+        return sum(
+            t.numel() * t.element_size()
+            for t in self.wire_buffers(example.to("meta"))
+        )
+
+
+class CastCodec(Codec):
+    """
+    Sends floating point tensors in a lower precision `dtype`, by default
+    bfloat16. Other tensors are sent as is.
+    """
+
+    def __init__(self, dtype: torch.dtype = torch.bfloat16):
+        if not dtype.is_floating_point:
+            raise ValueError(f"Expected a floating point dtype but got {dtype}")
+        self.dtype = dtype
+
+    def wire_buffers(self, example: torch.Tensor) -> List[torch.Tensor]:
+        if not example.is_floating_point():
+            return [torch.empty_like(example)]
+        return [torch.empty_like(example, dtype=self.dtype)]
+
+    def encode(self, tensor: torch.Tensor, key: Hashable) -> List[torch.Tensor]:
+        if not tensor.is_floating_point():
+            return [tensor.detach().contiguous()]
+        return [tensor.detach().to(self.dtype).contiguous()]
+
+    def decode(self, wire: List[torch.Tensor], out: torch.Tensor) -> None:
+        (data,) = wire
+        out.copy_(data)
+
+
+class Int8Codec(Codec):
+    """
+    Symmetric int8 quantization of floating point tensors, with one float32
+    scale per tensor, or per channel along dimension `dim` if `per_channel`.
+    Other tensors are sent as is.
+    """
+
+    def __init__(self, per_channel: bool = False, dim: int = -1):
+        self.per_channel = per_channel
+        self.dim = dim
+
+    def _per_channel(self, tensor: torch.Tensor) -> bool:
+        return self.per_channel and tensor.dim() > 0
+
+    def wire_buffers(self, example: torch.Tensor) -> List[torch.Tensor]:
+        if not example.is_floating_point():
+            return [torch.empty_like(example)]
+        num_scales = example.size(self.dim) if self._per_channel(example) else 1
+        return [
+            torch.empty_like(example, dtype=torch.int8),
+            torch.empty(num_scales, dtype=torch.float32, device=example.device),
+        ]
+
+    def _scale_shape(self, tensor: torch.Tensor) -> List[int]:
+        # Shape of the scales, broadcastable to `tensor`
+        shape = [1] * tensor.dim()
+        if self._per_channel(tensor):
+            shape[self.dim] = tensor.size(self.dim)
+        return shape
+
+    def encode(self, tensor: torch.Tensor, key: Hashable) -> List[torch.Tensor]:
+        if not tensor.is_floating_point():
+            return [tensor.detach().contiguous()]
+        tensor = tensor.detach().float()
+        if self._per_channel(tensor):
+            channel_dim = self.dim % tensor.dim()
+            dims = [d for d in range(tensor.dim()) if d != channel_dim]
+            amax = tensor.abs().amax(dim=dims) if dims else tensor.abs()
+        else:
+            amax = tensor.abs().max().reshape(1)
+        scale = amax.clamp(min=torch.finfo(torch.float32).tiny) / 127
+        quantized = (
+            (tensor / scale.view(self._scale_shape(tensor)))
+            .round()
+            .clamp(-127, 127)
+            .to(torch.int8)
+        )
+        return [quantized.contiguous(), scale.contiguous()]
+
+    def decode(self, wire: List[torch.Tensor], out: torch.Tensor) -> None:
+        if len(wire) == 1:
+            out.copy_(wire[0])
+            return
+        quantized, scale = wire
+        out.copy_(quantized.float() * scale.view(self._scale_shape(out)))
+
+
+class TopKCodec(Codec):
+    """
+    Sends the `ratio` fraction of the elements of largest magnitude of each
+    floating point tensor, with their indices; the others are received as
+    zeros. Intended for gradients. With `error_feedback`, the elements not
+    sent are added to the next tensor encoded with the same key, so that
+    nothing is lost over microbatches. Other tensors are sent as is.
+    """
+
+    def __init__(self, ratio: float = 0.01, error_feedback: bool = True):
+        if not 0 < ratio <= 1:
+            raise ValueError(f"Expected a ratio in (0, 1] but got {ratio}")
+        self.ratio = ratio
+        self.error_feedback = error_feedback
+        # map key to the elements not sent yet
+        self.residuals: Dict[Hashable, torch.Tensor] = {}
+
+    def _k(self, tensor: torch.Tensor) -> int:
+        return max(1, int(tensor.numel() * self.ratio))
+
+    def _index_dtype(self, tensor: torch.Tensor) -> torch.dtype:
+        return (
+            torch.int32
+            if tensor.numel() <= torch.iinfo(torch.int32).max
+            else torch.int64
+        )
+
+    def wire_buffers(self, example: torch.Tensor) -> List[torch.Tensor]:
+        if not example.is_floating_point() or example.numel() == 0:
+            return [torch.empty_like(example)]
+        k = self._k(example)
+        return [
+            torch.empty(k, dtype=example.dtype, device=example.device),
+            torch.empty(
+                k, dtype=self._index_dtype(example), device=example.device
+            ),
+        ]
+
+    def encode(self, tensor: torch.Tensor, key: Hashable) -> List[torch.Tensor]:
+        if not tensor.is_floating_point() or tensor.numel() == 0:
+            return [tensor.detach().contiguous()]
+        flat = tensor.detach().flatten()
+        if self.error_feedback and key in self.residuals:
+            flat = flat + self.residuals[key]
+        indices = flat.abs().topk(self._k(tensor), sorted=False).indices
+        values = flat[indices]
+        if self.error_feedback:
+            residual = flat.clone()
+            residual[indices] = 0
+            self.residuals[key] = residual
+        return [values.contiguous(), indices.to(self._index_dtype(tensor))]
+
+    def decode(self, wire: List[torch.Tensor], out: torch.Tensor) -> None:
+        if len(wire) == 1:
+            out.copy_(wire[0])
+            return
+        values, indices = wire
+        out.zero_()
+        out.view(-1)[indices.long()] = values
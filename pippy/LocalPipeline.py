@@ -0,0 +1,487 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+In-process pipeline runtime.
+
+Runs all stages of a `Pipe` in one process, one thread per pipeline rank,
+without `torch.distributed`. Each thread executes the program its rank would
+run under a schedule (see `_Action`), but activations and gradients are
+handed over through memory instead of P2P ops: a stage waits for the outputs
+of the stages it consumes, and for the gradients of the stages consuming it.
+Torch operators release the GIL, so the stages compute in parallel on a
+many-core CPU, with no serialization and no process group to set up. This
+also makes it a cheap harness to benchmark schedules on real models.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+import torch
+import torch.fx as fx
+from torch.profiler import record_function
+
+from ._backward import (
+    stage_backward,
+    stage_backward_input,
+    stage_backward_weight,
+)
+from ._IR import Pipe
+from ._utils import flatten_args
+from .microbatch import (
+    merge_chunks,
+    split_args_kwargs_into_chunks,
+    SplitPlanCache,
+)
+from .PipelineSchedule import (
+    _COMM_TYPES,
+    BACKWARD,
+    BACKWARD_INPUT,
+    BACKWARD_WEIGHT,
+    FORWARD,
+    PipelineSchedule,
+)
+from .ScheduleSimulator import get_schedule_programs
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Aborted(Exception):
+    """
+    Raised in the ranks waiting on a rank that failed.
+    """
+
+
+class LocalPipeline:
+    """
+    Runs a `Pipe` under the microbatch ordering of `schedule_class`, with the
+    ranks as threads of this process (see the module documentation). Stages
+    are placed on ranks as in `simulate_schedule`: rank `r` runs stages `r`,
+    `r + num_ranks`, ... `num_ranks` defaults to the number of stages.
+
+    The torch intra-op thread pool is shared by the ranks, so
+    `torch.set_num_threads` may need to be lowered to about the number of
+    cores per rank.
+
+    Example:
+        pipe = pipeline(model, n_microbatches, example_args=(x_mb,))
+        runner = LocalPipeline(pipe, Schedule1F1B, n_microbatches, loss_fn)
+        output = runner.step(x, target=target)
+    """
+
+    def __init__(
+        self,
+        pipe: Pipe,
+        schedule_class: Type[PipelineSchedule],
+        n_microbatches: int,
+        loss_fn: Optional[Callable[..., torch.Tensor]] = None,
+        output_merge_spec: Optional[Union[Dict[str, Any], Tuple[Any]]] = None,
+        num_ranks: Optional[int] = None,
+    ):
+        if pipe.has_loss_and_backward:
+            raise NotImplementedError(
+                "LocalPipeline does not support pipes with a loss in the "
+                "model, pass `loss_fn` instead"
+            )
+        self.pipe = pipe
+        self.num_stages = pipe.num_stages
+        self._n_microbatches = n_microbatches
+        self._loss_fn = loss_fn
+        self._output_merge_spec = output_merge_spec
+        self._has_backward = loss_fn is not None
+        self._programs = get_schedule_programs(
+            schedule_class,
+            n_microbatches,
+            self.num_stages,
+            num_ranks,
+            self._has_backward,
+        )
+        self._stage_modules = [
+            pipe.get_stage_module(stage_index)
+            for stage_index in range(self.num_stages)
+        ]
+
+        # Dataflow between the stages, from the graph of the pipe
+        graph = pipe.split_gm.graph
+        self._placeholders: List[fx.Node] = []
+        self._stage_nodes: Dict[int, fx.Node] = {}
+        self._node_stage: Dict[fx.Node, int] = {}
+        for node in graph.nodes:
+            if node.op == "placeholder":
+                self._placeholders.append(node)
+            elif node.op == "call_module":
+                stage_index = int(node.target[len("submod_") :])
+                self._stage_nodes[stage_index] = node
+                self._node_stage[node] = stage_index
+            elif node.op == "output":
+                self._output_node = node
+        # Stages whose outputs each stage consumes
+        self._producers: Dict[int, List[int]] = {}
+        for stage_index, node in self._stage_nodes.items():
+            producers: Set[int] = set()
+
+            def add_producer(n: fx.Node) -> fx.Node:
+                producer = self._source_stage(n)
+                if producer is not None:
+                    producers.add(producer)
+                return n
+
+            fx.node.map_arg((node.args, node.kwargs), add_producer)
+            self._producers[stage_index] = sorted(producers)
+        # Number of stages consuming the outputs of each stage
+        self._num_consumers = [0] * self.num_stages
+        for stage_producers in self._producers.values():
+            for producer in stage_producers:
+                self._num_consumers[producer] += 1
+        output_stages = set()
+        fx.node.map_arg(
+            self._output_node.args,
+            lambda n: output_stages.add(self._source_stage(n)),
+        )
+        if output_stages - {self.num_stages - 1}:
+            raise ValueError(
+                "LocalPipeline expects the output of the pipe to come from "
+                f"the last stage only, but it comes from stages {output_stages}"
+            )
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self._programs), thread_name_prefix="pippy-rank"
+        )
+        self._cond = threading.Condition()
+        # How inputs of the structures seen so far are split
+        self._split_plans = SplitPlanCache()
+        self._clear_runtime_states()
+
+    def _source_stage(self, node: fx.Node) -> Optional[int]:
+        """
+        Stage producing the value of `node`, or `None` for the inputs of the
+        pipe.
+        """
+        while node.op == "call_function":
+            # getitem on the outputs of a stage
+            node = node.args[0]  # type: ignore[assignment]
+        return self._node_stage.get(node)
+
+    def _clear_runtime_states(self) -> None:
+        # Inputs of the pipe, per microbatch
+        self._root_values: List[Dict[fx.Node, Any]] = []
+        self._target_mbs: Optional[List] = None
+        # Map (stage node, microbatch) to the outputs of the stage, until all
+        # the consuming stages have read them, and to the number of those yet
+        # to read them
+        self._values: Dict[Tuple[fx.Node, int], Any] = {}
+        self._pending_reads: Dict[Tuple[fx.Node, int], int] = {}
+        # Map (stage, microbatch) to the gradients of the outputs of the stage
+        # by id, and to the number of consuming stages that contributed
+        self._grads: Dict[Tuple[int, int], Dict[int, torch.Tensor]] = {}
+        self._num_grads: Dict[Tuple[int, int], int] = {}
+        # Map (stage, microbatch) to what the backward needs: the outputs (or
+        # the loss), and the received inputs with their source tensor and stage
+        self._fwd_cache: Dict[Tuple[int, int], Tuple[Any, List]] = {}
+        # Map (stage, microbatch) to the state of a split backward
+        self._bwd_weight_cache: Dict[
+            Tuple[int, int], Tuple[Optional[Dict[str, Any]], Any]
+        ] = {}
+        self._outputs: Dict[int, Any] = {}
+        self._losses: Dict[int, torch.Tensor] = {}
+        self._error: Optional[Exception] = None
+
+    def _wait_for(self, ready: Callable[[], bool]) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self._error is not None or ready())
+            if self._error is not None:
+                raise _Aborted()
+
+    def _value(self, node: fx.Node, mb_index: int) -> Any:
+        """
+        Value of `node` for microbatch `mb_index`, waiting for the stage
+        producing it.
+        """
+        if node.op == "placeholder":
+            return self._root_values[mb_index][node]
+        if node.op == "call_function":
+            args = fx.node.map_arg(
+                node.args, lambda n: self._value(n, mb_index)
+            )
+            kwargs = fx.node.map_arg(
+                node.kwargs, lambda n: self._value(n, mb_index)
+            )
+            return node.target(*args, **kwargs)  # type: ignore[operator]
+        key = (node, mb_index)
+        self._wait_for(lambda: key in self._values)
+        return self._values[key]
+
+    def _release_value(self, node: fx.Node, mb_index: int) -> None:
+        """
+        Called with the lock held by each stage reading the outputs of stage
+        `node` for microbatch `mb_index`, which are dropped after the last.
+        """
+        key = (node, mb_index)
+        self._pending_reads[key] -= 1
+        if self._pending_reads[key] <= 0:
+            del self._values[key]
+            del self._pending_reads[key]
+
+    def _forward(self, stage_index: int, mb_index: int) -> None:
+        node = self._stage_nodes[stage_index]
+        # (received tensor, tensor of the producer, producer stage)
+        received: List[Tuple[torch.Tensor, torch.Tensor, int]] = []
+
+        def receive(arg: fx.Node):
+            value = self._value(arg, mb_index)
+            producer = self._source_stage(arg)
+            if producer is None:
+                return value
+
+            def detach(v):
+                # A leaf of this stage's autograd graph, as if received
+                if not isinstance(v, torch.Tensor):
+                    return v
+                leaf = v.detach().requires_grad_(v.requires_grad)
+                received.append((leaf, v, producer))
+                return leaf
+
+            return fx.node.map_aggregate(value, detach)
+
+        args = fx.node.map_arg(node.args, receive)
+        kwargs = fx.node.map_arg(node.kwargs, receive)
+        with self._cond:
+            for producer in self._producers[stage_index]:
+                self._release_value(self._stage_nodes[producer], mb_index)
+        output = self._stage_modules[stage_index](*args, **kwargs)
+        key = (node, mb_index)
+        with self._cond:
+            self._values[key] = output
+            self._pending_reads[key] = self._num_consumers[stage_index]
+            self._cond.notify_all()
+
+        stage_output = output
+        if stage_index == self.num_stages - 1:
+            pipe_output = fx.node.map_arg(
+                self._output_node.args[0], lambda n: self._value(n, mb_index)
+            )
+            self._outputs[mb_index] = pipe_output
+        with self._cond:
+            if self._pending_reads[key] == 0:
+                # Not consumed by other stages
+                self._release_value(node, mb_index)
+            if self._has_backward:
+                stage_output = self._loss_fn(  # type: ignore[misc]
+                    pipe_output, self._target_mbs[mb_index]  # type: ignore[index]
+                )
+                self._losses[mb_index] = stage_output
+        if self._has_backward:
+            self._fwd_cache[(stage_index, mb_index)] = (stage_output, received)
+
+    def _backward(
+        self, stage_index: int, mb_index: int, full_backward: bool
+    ) -> None:
+        key = (stage_index, mb_index)
+        self._wait_for(
+            lambda: self._num_grads.get(key, 0)
+            == self._num_consumers[stage_index]
+        )
+        stage_output, received = self._fwd_cache.pop(key)
+        if stage_index == self.num_stages - 1:
+            # The loss
+            outputs, output_grads = stage_output, None
+        else:
+            with self._cond:
+                grads = self._grads.pop(key, {})
+            outputs = []
+            output_grads = []
+            for t in flatten_args(stage_output):
+                if isinstance(t, torch.Tensor) and id(t) in grads:
+                    outputs.append(t)
+                    output_grads.append(grads[id(t)])
+
+        input_values = [leaf for leaf, _, _ in received]
+        bwd_kwargs: Dict[str, Any] = {
+            "stage_output": outputs,
+            "output_grads": output_grads,
+            "input_values": input_values,
+        }
+        # No gradient flows back through this stage without gradients of its
+        # outputs
+        needs_backward = stage_index == self.num_stages - 1 or bool(outputs)
+        param_groups = None
+        if not needs_backward:
+            grads_input: List[Optional[torch.Tensor]] = [None] * len(
+                input_values
+            )
+        elif full_backward:
+            grads_input = stage_backward(**bwd_kwargs)
+        else:
+            grads_input, param_groups = stage_backward_input(
+                **bwd_kwargs,
+                weights=[
+                    p
+                    for p in self._stage_modules[stage_index].parameters()
+                    if p.requires_grad
+                ],
+            )
+        if not full_backward:
+            self._bwd_weight_cache[key] = (
+                bwd_kwargs if needs_backward else None,
+                param_groups,
+            )
+
+        # Hand the input gradients over to the producers
+        with self._cond:
+            for (_, source, producer), grad in zip(received, grads_input):
+                if grad is None:
+                    continue
+                producer_grads = self._grads.setdefault(
+                    (producer, mb_index), {}
+                )
+                previous = producer_grads.get(id(source))
+                # Summed if consumed by several stages
+                producer_grads[id(source)] = (
+                    grad if previous is None else previous + grad
+                )
+            for producer in self._producers[stage_index]:
+                producer_key = (producer, mb_index)
+                self._num_grads[producer_key] = (
+                    self._num_grads.get(producer_key, 0) + 1
+                )
+            self._cond.notify_all()
+
+    def _backward_weight(self, stage_index: int, mb_index: int) -> None:
+        bwd_kwargs, param_groups = self._bwd_weight_cache.pop(
+            (stage_index, mb_index)
+        )
+        if param_groups is None:
+            # No input gradient was needed, so the backward was not split
+            if bwd_kwargs is not None:
+                stage_backward(**bwd_kwargs)
+        else:
+            stage_backward_weight(param_groups)
+
+    def _run_rank(self, rank: int) -> None:
+        try:
+            for action in self._programs[rank]:
+                computation_type, stage_index, mb_index = action
+                if computation_type in _COMM_TYPES:
+                    # Data is handed over through memory
+                    continue
+                with record_function(f"{action}"):
+                    if computation_type == FORWARD:
+                        self._forward(stage_index, mb_index)
+                    elif computation_type in (BACKWARD, BACKWARD_INPUT):
+                        self._backward(
+                            stage_index,
+                            mb_index,
+                            full_backward=computation_type == BACKWARD,
+                        )
+                    elif computation_type == BACKWARD_WEIGHT:
+                        self._backward_weight(stage_index, mb_index)
+                    else:
+                        raise ValueError(f"Unknown action {action}")
+                logger.debug(f"[Rank {rank}] Finished {action}")
+        except _Aborted:
+            raise
+        except Exception as e:
+            # Wake up the ranks waiting on this one
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+                self._cond.notify_all()
+            raise
+
+    def _bind_inputs(self, args: Tuple, kwargs: Dict) -> Dict[fx.Node, Any]:
+        """
+        Map the placeholders of the pipe to the inputs of one microbatch.
+        """
+        args_iter = iter(args)
+        bound: Dict[fx.Node, Any] = {}
+        for node in self._placeholders:
+            arg = next(args_iter, node)
+            if arg is not node:
+                bound[node] = arg
+            elif node.target in kwargs:
+                bound[node] = kwargs[node.target]
+            elif node.args:
+                # Default value
+                bound[node] = node.args[0]
+            else:
+                raise TypeError(f"Missing input `{node.target}` of the pipe")
+        return bound
+
+    def step(self, *args, target=None, losses: Optional[List] = None, **kwargs):
+        """
+        Run one iteration with *whole-batch* input, as the `step` of the
+        schedules. Returns the merged output of the pipe; the parameter
+        gradients are accumulated in the stage modules.
+
+        args: positional arguments to the model (as in non-pipeline case).
+        kwargs: keyword arguments to the model (as in non-pipeline case).
+        target: target for the loss function.
+        losses: a list to store the losses for each microbatch.
+        """
+        if self._has_backward and target is None:
+            raise ValueError("A target is required to compute the loss")
+        try:
+            pipe_info = self.pipe.info()
+            args_chunk_spec = pipe_info.args_chunk_spec
+            kwargs_chunk_spec = pipe_info.kwargs_chunk_spec
+        except RuntimeError:
+            # Not created by `pipeline`
+            args_chunk_spec = kwargs_chunk_spec = None
+        arg_mbs, kwarg_mbs = split_args_kwargs_into_chunks(
+            args,
+            kwargs,
+            self._n_microbatches,
+            args_chunk_spec,
+            kwargs_chunk_spec,
+            split_plans=self._split_plans,
+        )
+        self._root_values = [
+            self._bind_inputs(mb_args, mb_kwargs)
+            for mb_args, mb_kwargs in zip(arg_mbs, kwarg_mbs)
+        ]
+        if target is not None:
+            self._target_mbs = list(
+                torch.tensor_split(target, self._n_microbatches)
+            )
+
+        futures = [
+            self._executor.submit(self._run_rank, rank)
+            for rank in self._programs
+        ]
+        for future in futures:
+            future.exception()
+        try:
+            if self._error is not None:
+                raise self._error
+            if losses is not None and self._has_backward:
+                losses.clear()
+                losses.extend(
+                    self._losses[mb_index]
+                    for mb_index in range(self._n_microbatches)
+                )
+            return merge_chunks(
+                [
+                    self._outputs[mb_index]
+                    for mb_index in range(self._n_microbatches)
+                ],
+                self._output_merge_spec,
+            )
+        finally:
+            self._clear_runtime_states()
+
+    def shutdown(self) -> None:
+        """
+        Stop the threads of the ranks.
+        """
+        self._executor.shutdown()
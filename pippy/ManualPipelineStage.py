@@ -1,19 +1,39 @@
 # (c) Meta Platforms, Inc. and affiliates. Confidential and proprietary.
 
+import hashlib
+import json
 import logging
+import os
 from collections import deque
-from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 import torch.distributed as dist
 import torch.nn as nn
+from torch._subclasses.fake_tensor import (
+    DataDependentOutputException,
+    DynamicOutputShapeException,
+    FakeTensorMode,
+    UnsupportedOperatorException,
+)
+from torch.utils._pytree import (
+    tree_flatten,
+    tree_leaves,
+    tree_map_only,
+    tree_unflatten,
+    treespec_dumps,
+    treespec_loads,
+)
 
 from ._PipelineStage import (
     _make_tensor_from_meta,
+    InputInfo,
     PipelineStageBase,
     RecvInfo,
     RootArgPlaceholder,
 )
+from .Compression import Codec
+from .SharedMemoryTransport import SharedMemoryTransport
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +41,14 @@ METADATA_TENSOR_LEN = 100
 PLACEHOLDER_VAL = -1
 
 
+def _can_require_grad(tensor: torch.Tensor) -> bool:
+    """
+    Whether a stage input or output like `tensor` can require gradient: only
+    then is its gradient sent back.
+    """
+    return tensor.dtype.is_floating_point or tensor.dtype.is_complex
+
+
 def create_empty_tensors(
     tensor: Union[torch.Tensor, List[torch.tensor]], device: torch.device
 ) -> List[torch.Tensor]:
@@ -102,6 +130,236 @@ def extract_metadata_from_tensor(tensor: torch.Tensor) -> List[torch.Size]:
     return metadata
 
 
+def _to_meta(value: Any) -> Any:
+    """
+    Replace the tensors of pytree `value` by meta tensors of the same shapes
+    and dtypes.
+    """
+    return tree_map_only(
+        torch.Tensor,
+        lambda t: torch.empty(t.shape, dtype=t.dtype, device="meta"),
+        value,
+    )
+
+
+def _tensor_metadata(value: Any) -> Dict[str, Any]:
+    """
+    Describe pytree `value` as a JSON-serializable dict: its structure, and
+    the dtype and shape of each of its tensors. The other leaves, which must
+    be JSON-serializable, are kept as they are.
+    """
+    leaves, spec = tree_flatten(value)
+    return {
+        "spec": treespec_dumps(spec),
+        "leaves": [
+            {"dtype": str(leaf.dtype).split(".")[-1], "shape": list(leaf.shape)}
+            if isinstance(leaf, torch.Tensor)
+            else {"value": leaf}
+            for leaf in leaves
+        ],
+    }
+
+
+def _meta_from_metadata(metadata: Dict[str, Any]) -> Any:
+    """
+    Rebuild the pytree described by `metadata` (see `_tensor_metadata`), with
+    meta tensors in place of its tensors.
+    """
+    leaves = [
+        torch.empty(
+            leaf["shape"], dtype=getattr(torch, leaf["dtype"]), device="meta"
+        )
+        if "dtype" in leaf
+        else leaf["value"]
+        for leaf in metadata["leaves"]
+    ]
+    return tree_unflatten(leaves, treespec_loads(metadata["spec"]))
+
+
+def encode_metadata(
+    value: Any,
+    device: Optional[torch.device] = torch.device("cpu"),
+) -> torch.Tensor:
+    """
+    Encode the structure of pytree `value` and the dtype and shape of each of
+    its tensors into a uint8 tensor that can be sent over the wire. Unlike
+    `create_metadata_tensor`, there is no limit on the number of tensors or
+    dimensions.
+    """
+    data = json.dumps(_tensor_metadata(value)).encode()
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8).to(device)
+
+
+def decode_metadata(tensor: torch.Tensor) -> Any:
+    """
+    Decode a tensor created by `encode_metadata` into the pytree it describes,
+    with meta tensors in place of its tensors.
+    """
+    data = bytes(tensor.cpu().tolist())
+    return _meta_from_metadata(json.loads(data.decode()))
+
+
+def send_metadata(value: Any, dst: int, device: torch.device) -> None:
+    """
+    Send the metadata of pytree `value` (see `encode_metadata`) to rank `dst`,
+    which must call `recv_metadata`.
+    """
+    metadata = encode_metadata(value, device)
+    size = torch.tensor([metadata.numel()], dtype=torch.int64, device=device)
+    dist.send(size, dst)
+    dist.send(metadata, dst)
+
+
+def recv_metadata(src: int, device: torch.device) -> Any:
+    """
+    Receive the metadata sent by rank `src` with `send_metadata`. Returns the
+    pytree it describes, with meta tensors in place of its tensors.
+    """
+    size = torch.empty(1, dtype=torch.int64, device=device)
+    dist.recv(size, src)
+    metadata = torch.empty(int(size.item()), dtype=torch.uint8, device=device)
+    dist.recv(metadata, src)
+    return decode_metadata(metadata)
+
+
+def _as_args(value: Any) -> List[Any]:
+    """
+    The arguments a stage is called with, given the outputs of the previous
+    stage or a microbatch: the elements of a list or tuple, else the value
+    itself.
+    """
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _dry_run(
+    model: nn.Module,
+    args: Sequence[Any],
+    device: torch.device,
+) -> Any:
+    """
+    Run `model` on fake tensors on `device` like the tensors of `args`,
+    without computing anything nor allocating device memory. Returns its
+    outputs, with meta tensors in place of the tensors. Models the fake
+    tensors cannot run, for instance with data-dependent shapes, are run on
+    zero tensors instead.
+    """
+    fake_mode = FakeTensorMode(allow_non_fake_inputs=True)
+    try:
+        with fake_mode:
+            fake_args = tree_map_only(
+                torch.Tensor,
+                lambda t: torch.empty(t.shape, dtype=t.dtype, device=device),
+                args,
+            )
+            outputs = model(*fake_args)
+    except (
+        DataDependentOutputException,
+        DynamicOutputShapeException,
+        UnsupportedOperatorException,
+    ) as e:
+        logger.info(f"Cannot run {type(model).__name__} on fake tensors: {e}")
+        with torch.no_grad():
+            outputs = model(
+                *tree_map_only(
+                    torch.Tensor,
+                    lambda t: torch.zeros(
+                        t.shape, dtype=t.dtype, device=device
+                    ),
+                    args,
+                )
+            )
+    return _to_meta(outputs)
+
+
+def _shape_cache_key(
+    stage_modules: List[nn.Module],
+    stage_ids: List[int],
+    num_stages: int,
+    device: torch.device,
+    microbatch: Optional[Any],
+) -> str:
+    """
+    Key of the shapes inferred by `get_stage_shapes` in its cache file: a
+    digest of the input signature, from the rank of the first stage, and of
+    the architecture and parameters of the stages of this rank. Collective.
+    """
+    input_digest = torch.zeros(32, dtype=torch.uint8, device=device)
+    if microbatch is not None:
+        input_digest = torch.frombuffer(
+            bytearray(
+                hashlib.sha256(
+                    json.dumps(_tensor_metadata(microbatch)).encode()
+                ).digest()
+            ),
+            dtype=torch.uint8,
+        ).to(device)
+    # The first stage is on rank 0
+    dist.broadcast(input_digest, src=0)
+
+    key = hashlib.sha256(bytes(input_digest.cpu().tolist()))
+    key.update(json.dumps([num_stages, stage_ids]).encode())
+    for model in stage_modules:
+        key.update(repr(model).encode())
+        for name, t in list(model.named_parameters()) + list(
+            model.named_buffers()
+        ):
+            key.update(f"{name}:{t.dtype}:{list(t.shape)}".encode())
+    return key.hexdigest()
+
+
+def _read_shape_cache(
+    cache_file: str,
+    key: str,
+) -> Optional[Dict[int, Tuple[List[Any], Any]]]:
+    """
+    The inputs and outputs of each stage stored under `key` in `cache_file`,
+    or `None` if missing.
+    """
+    try:
+        with open(cache_file) as f:
+            entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    return {
+        int(stage_id): (
+            _meta_from_metadata(metadata["inputs"]),
+            _meta_from_metadata(metadata["outputs"]),
+        )
+        for stage_id, metadata in entry.items()
+    }
+
+
+def _write_shape_cache(
+    cache_file: str,
+    key: str,
+    stage_meta: Dict[int, Tuple[List[Any], Any]],
+) -> None:
+    """
+    Store the inputs and outputs of each stage under `key` in `cache_file`,
+    keeping the other entries.
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = {
+        str(stage_id): {
+            "inputs": _tensor_metadata(inputs),
+            "outputs": _tensor_metadata(outputs),
+        }
+        for stage_id, (inputs, outputs) in stage_meta.items()
+    }
+    tmp_file = f"{cache_file}.tmp{os.getpid()}"
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+
 def get_stage_shapes(
     stage_modules: List[nn.Module],
     stage_ids: List[int],
@@ -110,12 +368,17 @@ def get_stage_shapes(
     world_size: int,
     device: torch.device,
     microbatch: Optional[Union[torch.tensor, List[torch.tensor]]] = None,
+    cache_file: Optional[str] = None,
 ):
     """
     Performs a dry run through all the pipeline stages (a rank can have multiple pipeline stages in the case of
     virtual pipelining) and returns the shape of the inputs and outputs of the module.
     Only the first stage must pass in a microbatch.
 
+    The dry run is done on fake tensors, without computation. Each stage sends the dtype, shape and structure of
+    its outputs to the next stage (see `send_metadata`), which calls its module with them as arguments: the
+    elements of a tuple or list of outputs, else the output itself.
+
     Each rank must call get_stage_shapes or the program will hang.
 
     Args:
@@ -126,51 +389,76 @@ def get_stage_shapes(
         rank: Rank of the current process.
         world_size: Number of processes participating in the pipeline.
         device: Device where the tensors are allocated.
+        cache_file: File, one per rank, the shapes are stored in, keyed by the input signature and the stage
+                modules. When all ranks find their shapes there, the dry run is skipped. Must be passed on all
+                ranks or none.
 
     Returns a dictionary containing the following keys:
         "inputs": Shape of the inputs to the module
         "outputs": Shape of the outputs of the module
+        "input_meta": Inputs to the module, as meta tensors
+        "output_meta": Outputs of the module, as meta tensors in their structure
     """
 
-    stage_id_to_shapes: Dict[int, Dict[str, torch.Size]] = {}
-    for stage_id, model in zip(stage_ids, stage_modules):
-        input_shape_metadata_tensor = create_metadata_tensor(device=device)
-        # TODO: Assumes prev_stage == rank - 1 and next_stage == rank + 1
-        prev_rank = (rank - 1) % world_size
-        next_rank = (rank + 1) % world_size
-        shapes = {}
-
-        # first stage doesn't receive anything and uses a microbatch
-        if stage_id == 0:
-            if microbatch is None:
-                raise RuntimeError("Microbatch is required for first stage")
-            example_fwd_inputs = microbatch
-            if isinstance(example_fwd_inputs, torch.Tensor):
-                example_fwd_inputs = [example_fwd_inputs]
-        else:
-            # other stages must receive shape information
-            # TODO: send/recv should take a group, rather than use the default group
-            dist.recv(input_shape_metadata_tensor, prev_rank)
-            metadata = extract_metadata_from_tensor(input_shape_metadata_tensor)
-            example_fwd_inputs = [
-                torch.empty(shape_list, device=device)
-                for shape_list in metadata
-            ]
-        shapes["inputs"] = [fwd_input.shape for fwd_input in example_fwd_inputs]
-
-        # perform forward
-        # TODO: if forward fails raise a more descriptive error explaining which stage failed
-        fwd_outputs = model(*example_fwd_inputs)
-        fwd_outputs = create_empty_tensors(fwd_outputs, device)
-        shapes["outputs"] = [fwd_output.shape for fwd_output in fwd_outputs]
-
-        # send shape dims
-        if stage_id != num_stages - 1:
-            output_shape_metadata_tensor = create_metadata_tensor(
-                fwd_outputs, device=device
-            )
-            dist.send(output_shape_metadata_tensor, next_rank)
-        stage_id_to_shapes[stage_id] = shapes
+    stage_meta: Optional[Dict[int, Tuple[List[Any], Any]]] = None
+    cache_key = None
+    if cache_file is not None:
+        cache_key = _shape_cache_key(
+            stage_modules, stage_ids, num_stages, device, microbatch
+        )
+        stage_meta = _read_shape_cache(cache_file, cache_key)
+        # Skip the dry run only if no rank needs it
+        found = torch.tensor(
+            [stage_meta is not None], dtype=torch.int64, device=device
+        )
+        dist.all_reduce(found, op=dist.ReduceOp.MIN)
+        if not found.item():
+            stage_meta = None
+
+    if stage_meta is None:
+        stage_meta = {}
+        for stage_id, model in zip(stage_ids, stage_modules):
+            # TODO: Assumes prev_stage == rank - 1 and next_stage == rank + 1
+            prev_rank = (rank - 1) % world_size
+            next_rank = (rank + 1) % world_size
+
+            # first stage doesn't receive anything and uses a microbatch
+            if stage_id == 0:
+                if microbatch is None:
+                    raise RuntimeError("Microbatch is required for first stage")
+                example_fwd_inputs = _to_meta(_as_args(microbatch))
+            else:
+                # other stages must receive the metadata of their inputs
+                # TODO: send/recv should take a group, rather than use the default group
+                example_fwd_inputs = _as_args(recv_metadata(prev_rank, device))
+
+            # TODO: if forward fails raise a more descriptive error explaining which stage failed
+            fwd_outputs = _dry_run(model, example_fwd_inputs, device)
+
+            if stage_id != num_stages - 1:
+                send_metadata(fwd_outputs, next_rank, device)
+            stage_meta[stage_id] = (example_fwd_inputs, fwd_outputs)
+        if cache_file is not None:
+            _write_shape_cache(cache_file, cache_key, stage_meta)  # type: ignore[arg-type]
+    else:
+        logger.info(f"Using the stage shapes cached in {cache_file}")
+
+    stage_id_to_shapes: Dict[int, Dict[str, Any]] = {}
+    for stage_id, (inputs, outputs) in stage_meta.items():
+        stage_id_to_shapes[stage_id] = {
+            "inputs": [
+                t.shape
+                for t in tree_leaves(inputs)
+                if isinstance(t, torch.Tensor)
+            ],
+            "outputs": [
+                t.shape
+                for t in tree_leaves(outputs)
+                if isinstance(t, torch.Tensor)
+            ],
+            "input_meta": inputs,
+            "output_meta": outputs,
+        }
     logger.info(stage_id_to_shapes)
     return stage_id_to_shapes
 
@@ -191,6 +479,21 @@ class ManualPipelineStage(PipelineStageBase):
         input_args (Union[torch.Tensor, List[torch.tensor]], optional): The input arguments for the submodule.
         output_args (Union[torch.Tensor, List[torch.tensor]], optional): The output arguments for the submodule.
         group (dist.ProcessGroup, optional): The process group for distributed training. If None, default group.
+        flat_p2p (bool, optional): Pack the tensors sent to the same stage into one message. See `PipelineStageBase`.
+        dynamic_shapes (bool, optional): Allow the shapes of the tensors received to change between microbatches.
+            `input_args` and `output_args` then only give their dtypes and numbers of dimensions. See `PipelineStageBase`.
+        recompute (Union[bool, Sequence[str]], optional): Recompute the activations of the stage, or of the named
+            submodules, in backward. See `PipelineStageBase`.
+        offload (bool, optional): Offload the activations of microbatches waiting for their backward. See
+            `PipelineStageBase`.
+        offload_dir (str, optional): Directory of the memory-mapped files of `offload` on CPU.
+        act_codec (Codec, optional): Codec compressing the activations sent and received. See `pippy.Compression`.
+        grad_codec (Codec, optional): Codec compressing the gradients sent and received.
+        transport (SharedMemoryTransport, optional): Transport of the tensors exchanged with stages on the same host.
+            See `pippy.SharedMemoryTransport`.
+        warmup (bool, optional): Set up the communicators with the previous and next stages right away. See
+            `PipelineStageBase.init_p2p_neighbors`.
+        placement (Sequence[int], optional): Rank of each stage of the pipeline. See `PipelineStageBase`.
     """
 
     def __init__(
@@ -203,9 +506,33 @@ class ManualPipelineStage(PipelineStageBase):
         input_args: Union[torch.Tensor, List[torch.tensor]],
         output_args: Optional[Union[torch.Tensor, List[torch.tensor]]] = None,
         group: dist.ProcessGroup = None,
+        flat_p2p: bool = False,
+        dynamic_shapes: bool = False,
+        recompute: Union[bool, Sequence[str]] = False,
+        offload: bool = False,
+        offload_dir: Optional[str] = None,
+        act_codec: Optional[Codec] = None,
+        grad_codec: Optional[Codec] = None,
+        transport: Optional[SharedMemoryTransport] = None,
+        warmup: bool = False,
+        placement: Optional[Sequence[int]] = None,
     ):
         super().__init__(
-            submodule, stage_index, num_stages, device, num_microbatches, group
+            submodule,
+            stage_index,
+            num_stages,
+            device,
+            num_microbatches,
+            group,
+            flat_p2p,
+            dynamic_shapes,
+            recompute,
+            offload,
+            offload_dir,
+            act_codec,
+            grad_codec,
+            transport,
+            placement,
         )
         self.submod.to(self.device)
         # When we materialize the model partition on cuda, we call reset_parameters() if it is available
@@ -219,7 +546,8 @@ class ManualPipelineStage(PipelineStageBase):
             logger.info(
                 "output_args not provided, performing forward using input_args"
             )
-            self.outputs = self.submod(*self.inputs)
+            # on fake tensors, without computation
+            self.outputs = _dry_run(self.submod, self.inputs, self.device)
             # create buffers for the output so that the data is in the correct
             # shape in order to use in p2p op (send)
             self.outputs = create_empty_tensors(self.outputs, device)
@@ -232,40 +560,16 @@ class ManualPipelineStage(PipelineStageBase):
         # these are the buffers used in backwards send/recv, they are allocated later
         self.outputs_grad: List[torch.tensor] = []
 
-        def stage_global_rank(peer_rank):
-            return (
-                peer_rank
-                if self.group is None
-                else dist.get_global_rank(self.group, peer_rank)
-            )
-
-        self.prev_stage = stage_global_rank(
-            (self.group_rank - 1) % self.group_size
-        )
-        self.next_stage = stage_global_rank(
-            (self.group_rank + 1) % self.group_size
-        )
+        # Global ranks of the previous and next stages
+        self.prev_stage = self.stage_index_to_global_rank[
+            (self.stage_index - 1) % self.num_stages
+        ]
+        self.next_stage = self.stage_index_to_global_rank[
+            (self.stage_index + 1) % self.num_stages
+        ]
 
-        # Receive info during forward
-        # TODO: create args_recv_info lazily? (same needed for PipelineStage)
-        for chunk_id in range(self.chunks):
-            self.set_requires_grad[chunk_id] = False
-            if not self.is_first:
-                # We assume that we always receive from stage - 1
-                self.args_recv_info[chunk_id] = tuple(
-                    [
-                        RecvInfo(
-                            f"recv_for_{self.stage_index}_from_{self.stage_index - 1}",
-                            self.stage_index - 1,
-                            _make_tensor_from_meta(inp, self.device),
-                        )
-                        for inp in self.inputs
-                    ]
-                )  # type: ignore
-            else:
-                self.args_recv_info[chunk_id] = tuple(
-                    [RootArgPlaceholder() for _ in self.inputs]
-                )  # type: ignore
+        # Receive info during forward is created lazily per slot, see
+        # `_create_act_recv_info`
 
         # Send info during forward for each activation
         # only need the rank that is being sent to
@@ -286,58 +590,51 @@ class ManualPipelineStage(PipelineStageBase):
             """
         )
 
+        if warmup:
+            self.init_p2p_neighbors()
+
+    def _create_act_recv_info(self) -> Tuple[InputInfo, ...]:
+        if self.is_first:
+            return tuple([RootArgPlaceholder() for _ in self.inputs])
+        # We assume that we always receive from stage - 1
+        return tuple(
+            [
+                RecvInfo(
+                    f"recv_for_{self.stage_index}_from_{self.stage_index - 1}",
+                    self.stage_index - 1,
+                    _make_tensor_from_meta(inp, self.device),
+                    requires_grad=_can_require_grad(inp),
+                )
+                for inp in self.inputs
+            ]
+        )
+
     def _create_grad_recv_info(
         self,
         act_send_info: Dict,
     ) -> Tuple[RecvInfo, ...]:
         grad_recv_info: Tuple[RecvInfo, ...] = ()
+        # Outputs of integer dtypes get no gradient back
+        self.grad_recv_index = [
+            idx
+            for idx, dst_list in act_send_info.items()
+            if dst_list and _can_require_grad(self.outputs[idx])
+        ]
         if not self.is_last:
             # Receiving gradients from multiple sources is not supported
             # hence we only take the first destination
             grad_recv_info = tuple(
                 [
                     RecvInfo(
-                        f"recv_grad_for_{self.stage_index}_from_{dst_list[0]}",
-                        dst_list[0],
+                        f"recv_grad_for_{self.stage_index}_from_{act_send_info[idx][0]}",
+                        act_send_info[idx][0],
                         _make_tensor_from_meta(self.outputs[idx], self.device),
                     )
-                    for idx, dst_list in act_send_info.items()
+                    for idx in self.grad_recv_index
                 ]
             )
         return grad_recv_info
 
-    def init_p2p_neighbors(self):
-        """
-        Set up p2p communitors between previous and next stages
-        by sending a dummy tensor.
-
-        If this is used, must be called for all pipeline stages.
-        """
-        ops = []
-        recv_tensor = torch.zeros(1, device="cuda")
-        send_tensor = torch.ones(1, device="cuda")
-        # forward
-        if not self.is_first:
-            ops.append(
-                dist.P2POp(dist.irecv, recv_tensor, self.prev_stage, self.group)
-            )
-        if not self.is_last:
-            ops.append(
-                dist.P2POp(dist.isend, send_tensor, self.next_stage, self.group)
-            )
-
-        # backward
-        if not self.is_first:
-            ops.append(
-                dist.P2POp(dist.isend, send_tensor, self.prev_stage, self.group)
-            )
-        if not self.is_last:
-            ops.append(
-                dist.P2POp(dist.irecv, recv_tensor, self.next_stage, self.group)
-            )
-
-        return True
-
 
 def validate_stage_shapes(pipeline_stages: List[ManualPipelineStage]):
     """
@@ -2,40 +2,616 @@
 
 import logging
 from abc import ABC, abstractmethod
-from collections import defaultdict
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from collections import defaultdict, deque
+from enum import Enum
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import torch
 import torch.distributed as dist
 from torch.profiler import record_function
 
+from ._comm_engine import CommEngine
 from ._IR import Pipe
 from ._PipelineStage import PipelineStageBase
-from .microbatch import merge_chunks, split_args_kwargs_into_chunks
+from .SharedMemoryTransport import batch_isend_irecv
+from .microbatch import (
+    ChunkMerger,
+    merge_chunks,
+    split_args_kwargs_into_chunks,
+    SplitPlanCache,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class _ComputationType(Enum):
+    """
+    Kind of an `_Action` in a schedule program.
+    """
+
+    FORWARD = 1
+    BACKWARD = 2
+    SEND_F = 3
+    RECV_F = 4
+    SEND_B = 5
+    RECV_B = 6
+    # Split backward: input gradients, then deferred weight gradients
+    BACKWARD_INPUT = 7
+    BACKWARD_WEIGHT = 8
+
+    def __str__(self):
+        return self.name
+
+
+FORWARD = _ComputationType.FORWARD
+BACKWARD = _ComputationType.BACKWARD
+SEND_F = _ComputationType.SEND_F
+RECV_F = _ComputationType.RECV_F
+SEND_B = _ComputationType.SEND_B
+RECV_B = _ComputationType.RECV_B
+BACKWARD_INPUT = _ComputationType.BACKWARD_INPUT
+BACKWARD_WEIGHT = _ComputationType.BACKWARD_WEIGHT
+
+# Action types that post P2P ops rather than run computation
+_COMM_TYPES = frozenset([SEND_F, RECV_F, SEND_B, RECV_B])
+
+
+class _Action(NamedTuple):
+    """
+    One instruction of a schedule program: run `computation_type` for
+    microbatch `microbatch_index` of stage `stage_index`.
+
+    A program is the ordered tuple of actions a rank executes in one step.
+    Execution semantics (see `PipelineSchedule._run_program`):
+    - Consecutive communication actions are issued together when the next
+      computation action (or the end of the program) is reached (see
+      `PipelineSchedule._group_p2p` for how they are batched).
+    - A `FORWARD` (`BACKWARD` or `BACKWARD_INPUT`) waits only for the `RECV_F`
+      (`RECV_B`) of its own stage and microbatch, so receives can be posted
+      ahead of time.
+    - `BACKWARD_INPUT` computes and sends the input gradients only; the
+      weight gradients are computed by the matching `BACKWARD_WEIGHT`.
+    - Sends are waited for at the end of the program.
+    """
+
+    computation_type: _ComputationType
+    stage_index: int
+    microbatch_index: int
+
+    def __repr__(self):
+        return f"{self.computation_type}({self.stage_index}, {self.microbatch_index})"
+
+
+def _add_p2p_actions(
+    compute_actions: Sequence[_Action],
+    num_stages: int,
+    prefetch: bool = False,
+) -> Tuple[_Action, ...]:
+    """
+    Lower a list of computation actions into a program by placing, around
+    each computation, the receive it consumes and the send it produces.
+
+    With `prefetch`, the receive for a computation is instead posted before
+    the previous computation of the same stage and direction, so that the
+    transfer overlaps with it (double buffering: each microbatch has its own
+    receive buffers). This moves receives ahead of sends, so the resulting
+    programs should be checked against per-peer ordering of the P2P ops.
+    """
+
+    def recv_of(action: _Action) -> Optional[_Action]:
+        stage_index, mb_index = action.stage_index, action.microbatch_index
+        if action.computation_type == FORWARD:
+            if stage_index != 0:
+                return _Action(RECV_F, stage_index, mb_index)
+        elif action.computation_type in (BACKWARD, BACKWARD_INPUT):
+            if stage_index != num_stages - 1:
+                return _Action(RECV_B, stage_index, mb_index)
+        elif action.computation_type != BACKWARD_WEIGHT:
+            raise ValueError(f"Expected a computation action but got {action}")
+        return None
+
+    # Receives to post before each computation
+    recvs_before: List[List[_Action]] = [[] for _ in compute_actions]
+    # Index of the last computation per (stage, receive type)
+    last_index: Dict[Tuple[int, _ComputationType], int] = {}
+    for i, action in enumerate(compute_actions):
+        recv = recv_of(action)
+        if recv is None:
+            continue
+        key = (recv.stage_index, recv.computation_type)
+        if prefetch and key in last_index:
+            recvs_before[last_index[key]].append(recv)
+        else:
+            recvs_before[i].append(recv)
+        last_index[key] = i
+
+    program: List[_Action] = []
+    for action, recvs in zip(compute_actions, recvs_before):
+        program.extend(recvs)
+        program.append(action)
+        stage_index, mb_index = action.stage_index, action.microbatch_index
+        if action.computation_type == FORWARD:
+            if stage_index != num_stages - 1:
+                program.append(_Action(SEND_F, stage_index, mb_index))
+        elif action.computation_type in (BACKWARD, BACKWARD_INPUT):
+            if stage_index != 0:
+                program.append(_Action(SEND_B, stage_index, mb_index))
+    return tuple(program)
+
+
+@lru_cache(maxsize=None)
+def _without_prefetch(
+    program: Tuple[_Action, ...],
+    num_stages: int,
+) -> Tuple[_Action, ...]:
+    """
+    Lower the computations of a single-stage `program` again, with each
+    receive posted right before the computation consuming it. Stages with
+    dynamic shapes need it: their data receives can only be posted once the
+    shape header has arrived, so must not be overtaken by the header of the
+    next receive.
+    """
+    return _add_p2p_actions(
+        [a for a in program if a.computation_type not in _COMM_TYPES],
+        num_stages,
+    )
+
+
+@lru_cache(maxsize=None)
+def _gpipe_program(
+    n_microbatches: int,
+    num_stages: int,
+    stage_index: int,
+    has_backward: bool,
+) -> Tuple[_Action, ...]:
+    """
+    All forwards, then all backwards.
+    """
+    actions = [_Action(FORWARD, stage_index, i) for i in range(n_microbatches)]
+    if has_backward:
+        actions += [
+            _Action(BACKWARD, stage_index, i) for i in range(n_microbatches)
+        ]
+    return _add_p2p_actions(actions, num_stages, prefetch=True)
+
+
+@lru_cache(maxsize=None)
+def _1f1b_program(
+    n_microbatches: int,
+    num_stages: int,
+    stage_index: int,
+    has_backward: bool,
+) -> Tuple[_Action, ...]:
+    """
+    Forward-only warmup, then alternating forward/backward, then backward-only
+    cooldown.
+    """
+    # Example, 4 GPUs, 8 microbatches
+    # Stage 0: 6 warmup, 2 1f1b, 6 cooldown
+    # Stage 1: 4 warmup, 4 1f1b, 4 cooldown
+    # Stage 2: 2 warmup, 6 1f1b, 2 cooldown
+    # Stage 3: 0 warmup, 8 1f1b, 0 cooldown
+    # fwd only
+    warmup_steps = min(
+        n_microbatches,
+        2 * (num_stages - stage_index - 1),
+    )
+    # fwd + bwd
+    main_1f1b_steps = n_microbatches - warmup_steps
+    # bwd only
+    cooldown_steps = warmup_steps
+    total_steps = warmup_steps + main_1f1b_steps + cooldown_steps
+    logger.debug(
+        f"Stage {stage_index}: "
+        f"Warmup steps: {warmup_steps}, "
+        f"Main 1F1B steps: {main_1f1b_steps}, "
+        f"Cooldown steps: {cooldown_steps}, "
+        f"Total steps: {total_steps}"
+    )
+
+    actions: List[_Action] = []
+    bwd_mb_index = 0
+    for i in range(total_steps):
+        if i < n_microbatches:
+            actions.append(_Action(FORWARD, stage_index, i))
+        if i >= warmup_steps and has_backward:
+            actions.append(_Action(BACKWARD, stage_index, bwd_mb_index))
+            bwd_mb_index += 1
+    return _add_p2p_actions(actions, num_stages, prefetch=True)
+
+
+@lru_cache(maxsize=None)
+def _zero_bubble_h1_program(
+    n_microbatches: int,
+    num_stages: int,
+    stage_index: int,
+    has_backward: bool,
+) -> Tuple[_Action, ...]:
+    """
+    ZB-H1 (https://arxiv.org/abs/2401.10241): 1F1B with the backward split
+    into an input gradient pass, sent upstream right away, and a weight
+    gradient pass that does not gate any other stage. Stage `stage_index`
+    defers its weight passes by `stage_index` microbatches: the later stages
+    then run their input gradient passes earlier, and the deferred weight
+    passes fill the cooldown bubble. Every stage holds at most `num_stages`
+    microbatches, the peak of the first stage in 1F1B.
+    """
+    if not has_backward:
+        return _gpipe_program(n_microbatches, num_stages, stage_index, False)
+
+    # Example, 4 GPUs, 8 microbatches
+    # Stage 0: F0 F1 F2 F3 I0 W0 F4 I1 W1 F5 I2 W2 F6 I3 W3 F7 I4 W4 I5 W5 ...
+    # Stage 3: F0 I0 F1 I1 F2 I2 F3 I3 W0 F4 I4 W1 F5 I5 W2 ... I7 W4 W5 W6 W7
+    warmup_steps = min(n_microbatches, num_stages - stage_index - 1)
+
+    actions: List[_Action] = [
+        _Action(FORWARD, stage_index, i) for i in range(warmup_steps)
+    ]
+    pending_weights: List[int] = []
+    for i in range(n_microbatches):
+        if i + warmup_steps < n_microbatches:
+            actions.append(_Action(FORWARD, stage_index, i + warmup_steps))
+        actions.append(_Action(BACKWARD_INPUT, stage_index, i))
+        pending_weights.append(i)
+        if len(pending_weights) > stage_index:
+            actions.append(
+                _Action(BACKWARD_WEIGHT, stage_index, pending_weights.pop(0))
+            )
+    actions += [
+        _Action(BACKWARD_WEIGHT, stage_index, i) for i in pending_weights
+    ]
+    # Receives are not posted ahead: with the short warmup, neighbors would
+    # each post a receive ahead of a send to the other, which deadlocks when
+    # the P2P ops between two ranks run in order (e.g. on NCCL)
+    return _add_p2p_actions(actions, num_stages)
+
+
+@lru_cache(maxsize=None)
+def _looped_bfs_program(
+    n_microbatches: int,
+    num_stages: int,
+    stage_indices: Tuple[int, ...],
+    has_backward: bool,
+) -> Tuple[_Action, ...]:
+    """
+    All microbatches through each local stage in turn, forward in stage order
+    and backward in reverse stage order.
+    """
+    actions = [
+        _Action(FORWARD, stage_index, i)
+        for stage_index in stage_indices
+        for i in range(n_microbatches)
+    ]
+    if has_backward:
+        actions += [
+            _Action(BACKWARD, stage_index, i)
+            for stage_index in reversed(stage_indices)
+            for i in range(n_microbatches)
+        ]
+    return _add_p2p_actions(actions, num_stages)
+
+
+@lru_cache(maxsize=None)
+def _interleaved_1f1b_program(
+    n_microbatches: int,
+    num_stages: int,
+    group_size: int,
+    rank: int,
+    stage_indices: Tuple[int, ...],
+    has_backward: bool,
+) -> Tuple[_Action, ...]:
+    """
+    Interleaved 1F1B (https://arxiv.org/pdf/2104.04473.pdf).
+
+    Microbatches go through the local stages in rounds of `group_size`
+    microbatches (the last round may be shorter): the forwards of a round
+    run on each local stage in turn, and the backwards on each local stage
+    in reverse order.
+
+    Highest rank has a warmup (fwd only) count of [len(stages) - 1] * number of PP ranks
+    and each rank away from highest rank adds 2 warmup steps due to:
+        - one happened before highest rank's warmup started,
+        - one waiting for backward result to trickle down from highest rank
+
+    The sends of a step are posted together with the receives of the next
+    step so that fwd-bwd send/recvs among ranks stay aligned.
+    """
+    n_local_stages = len(stage_indices)
+    total_mbs = n_local_stages * n_microbatches
+    last_stage = num_stages - 1
+
+    def order(local_stages):
+        return [
+            (stage_index, mb_index)
+            for round_start in range(0, n_microbatches, group_size)
+            for stage_index in local_stages
+            for mb_index in range(
+                round_start, min(round_start + group_size, n_microbatches)
+            )
+        ]
+
+    fwd_order = order(stage_indices)
+    bwd_order = order(tuple(reversed(stage_indices)))
+
+    if not has_backward:
+        # Forward only: run through local stages in the same rotation
+        return _add_p2p_actions(
+            [_Action(FORWARD, *step) for step in fwd_order], num_stages
+        )
+
+    if n_microbatches % group_size != 0:
+        # The steps of the last, partial round do not line up across ranks
+        return _add_p2p_actions(
+            _interleaved_partial_round_orders(
+                n_microbatches, num_stages, group_size
+            )[rank],
+            num_stages,
+        )
+
+    # increment warmup_steps by 2 for each hop away
+    warmup_steps = (n_local_stages - 1) * group_size
+    warmup_steps += 2 * ((group_size - 1) - rank)
+    warmup_steps = min(warmup_steps, total_mbs)
+    fwd_bwd_steps = total_mbs - warmup_steps
+    cooldown_steps = total_mbs - fwd_bwd_steps
+
+    assert (
+        warmup_steps + fwd_bwd_steps * 2 + cooldown_steps
+        == n_local_stages * n_microbatches * 2
+    )
+    total_steps = warmup_steps + fwd_bwd_steps + cooldown_steps
+
+    logger.debug(
+        f"""
+        rank {rank}
+        warmup_steps {warmup_steps}
+        1f1b {fwd_bwd_steps}
+        cooldown_steps {cooldown_steps}
+        """
+    )
+
+    steps: List[Tuple[Optional[_Action], Optional[_Action]]] = []
+    for step in range(total_steps):
+        fwd: Optional[_Action] = None
+        bwd: Optional[_Action] = None
+        if step < warmup_steps + fwd_bwd_steps:
+            fwd = _Action(FORWARD, *fwd_order[step])
+        if step >= warmup_steps:
+            bwd = _Action(BACKWARD, *bwd_order[step - warmup_steps])
+        steps.append((fwd, bwd))
+
+    program: List[_Action] = []
+    for fwd, bwd in steps:
+        # Receives of this step
+        if fwd is not None and fwd.stage_index != 0:
+            program.append(
+                _Action(RECV_F, fwd.stage_index, fwd.microbatch_index)
+            )
+        if bwd is not None and bwd.stage_index != last_stage:
+            program.append(
+                _Action(RECV_B, bwd.stage_index, bwd.microbatch_index)
+            )
+        # Computation
+        if fwd is not None:
+            program.append(fwd)
+        if bwd is not None:
+            program.append(bwd)
+        # Sends of this step, issued in the same batch as the receives of the
+        # next step
+        if fwd is not None and fwd.stage_index != last_stage:
+            program.append(
+                _Action(SEND_F, fwd.stage_index, fwd.microbatch_index)
+            )
+        if bwd is not None and bwd.stage_index != 0:
+            program.append(
+                _Action(SEND_B, bwd.stage_index, bwd.microbatch_index)
+            )
+
+    return tuple(program)
+
+
+@lru_cache(maxsize=None)
+def _interleaved_partial_round_orders(
+    n_microbatches: int,
+    num_stages: int,
+    group_size: int,
+) -> Dict[int, List[_Action]]:
+    """
+    Computation order of each rank for interleaved 1F1B with backward when
+    the last round of microbatches is partial, for wrapped-around stages.
+
+    The fixed 1F1B steps can then make a rank wait on itself, so the order is
+    found by running the pipeline with unit costs instead: at each tick, each
+    rank runs its next backward if its gradients are there, or else its next
+    forward if its input is there and it holds fewer microbatches than the
+    1F1B warmup allows. Forwards and backwards each keep the rotation order
+    of the rounds. Sends are issued right after their computation, so the P2P
+    ops between two ranks are not posted in matching order: this needs
+    tag-matched P2P (see `ScheduleInterleaved1F1B`).
+    """
+    n_local_stages = num_stages // group_size
+    queues: Dict[int, Tuple[Deque[_Action], Deque[_Action]]] = {}
+    max_in_flight: Dict[int, int] = {}
+    for rank in range(group_size):
+        stage_indices = tuple(range(rank, num_stages, group_size))
+
+        def order(computation_type, local_stages):
+            return deque(
+                _Action(computation_type, stage_index, mb_index)
+                for round_start in range(0, n_microbatches, group_size)
+                for stage_index in local_stages
+                for mb_index in range(
+                    round_start, min(round_start + group_size, n_microbatches)
+                )
+            )
+
+        queues[rank] = (
+            order(FORWARD, stage_indices),
+            order(BACKWARD, tuple(reversed(stage_indices))),
+        )
+        max_in_flight[rank] = (
+            min(
+                (n_local_stages - 1) * group_size + 2 * (group_size - 1 - rank),
+                n_local_stages * n_microbatches,
+            )
+            + 1
+        )
+
+    orders: Dict[int, List[_Action]] = {rank: [] for rank in range(group_size)}
+    done: Set[_Action] = set()
+    in_flight = {rank: 0 for rank in range(group_size)}
+
+    def ready(action: _Action) -> bool:
+        stage_index, mb_index = action.stage_index, action.microbatch_index
+        if action.computation_type == FORWARD:
+            return (
+                stage_index == 0
+                or _Action(FORWARD, stage_index - 1, mb_index) in done
+            )
+        return _Action(FORWARD, stage_index, mb_index) in done and (
+            stage_index == num_stages - 1
+            or _Action(BACKWARD, stage_index + 1, mb_index) in done
+        )
+
+    while any(fwds or bwds for fwds, bwds in queues.values()):
+        ran: List[_Action] = []
+        for rank, (fwds, bwds) in queues.items():
+            if bwds and ready(bwds[0]):
+                action = bwds.popleft()
+                in_flight[rank] -= 1
+            elif (
+                fwds
+                and in_flight[rank] < max_in_flight[rank]
+                and ready(fwds[0])
+            ):
+                action = fwds.popleft()
+                in_flight[rank] += 1
+            else:
+                continue
+            orders[rank].append(action)
+            ran.append(action)
+        if not ran:
+            raise RuntimeError(
+                f"No interleaved 1F1B order found for {n_microbatches} "
+                f"microbatches, {num_stages} stages and {group_size} ranks"
+            )
+        # Finished at the end of the tick
+        done.update(ran)
+    return orders
+
+
+@lru_cache(maxsize=None)
+def _num_recv_slots(program: Tuple[_Action, ...], stage_index: int) -> int:
+    """
+    Number of receive buffer slots the stage needs to run `program` when
+    microbatch i receives into slot i % slots: the widest range of
+    microbatches whose activation (or gradient) receive buffers are in use
+    at the same time.
+
+    A receive buffer is in use from its receive until the computation of the
+    last action that reads it: the weight pass if the backward is split, the
+    backward otherwise, or the forward if there is no backward at all.
+    """
+    has_backward = any(
+        a.stage_index == stage_index
+        and a.computation_type in (BACKWARD, BACKWARD_INPUT)
+        for a in program
+    )
+    # Microbatches with activation and gradient buffers in use
+    in_use: Tuple[Set[int], Set[int]] = (set(), set())
+    num_slots = 1
+    for action in program:
+        if action.stage_index != stage_index:
+            continue
+        computation_type, mb_index = (
+            action.computation_type,
+            action.microbatch_index,
+        )
+        if computation_type in (RECV_F, RECV_B):
+            buffers = in_use[computation_type == RECV_B]
+            buffers.add(mb_index)
+            num_slots = max(num_slots, max(buffers) - min(buffers) + 1)
+        elif (
+            computation_type in (BACKWARD, BACKWARD_WEIGHT)
+            or computation_type == FORWARD
+            and not has_backward
+        ):
+            for buffers in in_use:
+                buffers.discard(mb_index)
+    return num_slots
+
+
 class PipelineSchedule(ABC):
+    # Whether a batch of P2P ops is issued as one coalesced operation across
+    # all peers instead of per peer batches (see `_group_p2p`)
+    _coalesce_p2p: bool = False
+
     def __init__(
         self,
         n_microbatches: int,
         loss_fn: Optional[Callable[..., torch.Tensor]] = None,
         output_merge_spec: Optional[Union[Dict[str, Any], Tuple[Any]]] = None,
+        comm_thread: bool = False,
+        return_outputs: Optional[bool] = None,
     ):
         # From arguments
         self._n_microbatches = n_microbatches
         self._loss_fn = loss_fn
         self._output_merge_spec = output_merge_spec
+        # With `comm_thread`, the P2P ops are issued and progressed by a
+        # dedicated thread while this one computes (see `CommEngine`)
+        self._comm_engine: Optional[CommEngine] = (
+            CommEngine() if comm_thread else None
+        )
         # Derived
         self._has_backward = self._loss_fn is not None
+        # Whether `step` returns the merged outputs of the last stage, which
+        # keeps them until then. By default, unless the loss sets
+        # `_return_outputs` to False, as the losses fused with the output
+        # projection do since the outputs are then only hidden states.
+        self._return_outputs = (
+            getattr(loss_fn, "_return_outputs", True)
+            if return_outputs is None
+            else return_outputs
+        )
         # To be filled by subclasses
         self._pipe_info: Optional[Pipe.PipeInfo] = None
+        # How inputs of the structures seen so far are split
+        self._split_plans = SplitPlanCache()
 
         # Holds the losses for each microbatch.
         self._internal_losses: List[torch.Tensor] = []
         logger.info(f"Using {self.__class__.__name__}")
 
+    def _init_last_stage(self, stage: PipelineStageBase) -> None:
+        """
+        Tell the last stage which outputs to keep, and the parameters of the
+        loss it computes the gradients of.
+        """
+        if not stage.is_last:
+            return
+        stage.keep_outputs = self._return_outputs
+        if (
+            isinstance(self._loss_fn, torch.nn.Module)
+            and self._has_backward
+            # Unless it computes the gradients of its parameters itself
+            and not getattr(self._loss_fn, "_computes_param_grads", False)
+        ):
+            stage.loss_parameters = list(self._loss_fn.parameters())
+
     def _maybe_compute_loss(self, stage, output, target_mbs, mb_index):
         if stage.is_last and self._has_backward:
             loss = self._compute_loss(output, target_mbs[mb_index])  # type: ignore[index]
@@ -117,9 +693,10 @@ class PipelineSchedule(ABC):
         kwarg_mbs: Optional[List] = None,
         target_mbs: Optional[List] = None,
         losses: Optional[List] = None,
-    ):
+    ) -> Tuple[List, List]:
         """
-        Pre-process/check inputs
+        Pre-process/check inputs, returning the args and kwargs of each
+        microbatch (empty ones if not given)
         """
 
         def check_type_and_len(mbs, name: str):
@@ -179,6 +756,7 @@ class PipelineSchedule(ABC):
                 self._n_microbatches,
                 args_chunk_spec,
                 kwargs_chunk_spec,
+                split_plans=self._split_plans,
             )
             return args_split, kwargs_split
         else:
@@ -186,14 +764,315 @@ class PipelineSchedule(ABC):
             # Return a list of empty tuples/dicts with matching length as chunks
             return [()] * self._n_microbatches, [{}] * self._n_microbatches
 
-    def _merge_outputs(self, output_chunks: List[Any]) -> Any:
+    def _start_output_merge(self, stage: PipelineStageBase) -> None:
+        """
+        Have the last stage write each of its output chunks into the outputs
+        of the whole batch, preallocated with the first one, as they come.
+        """
+        if stage.is_last and self._return_outputs:
+            stage.output_merger = ChunkMerger(
+                self._n_microbatches, self._output_merge_spec
+            )
+
+    def _merge_outputs(self, stage: PipelineStageBase) -> Any:
         """
         Merge output chunks back to a batch state.
         If output_merge_spec is None, the utility will merge output chunks by dimension 0 (batch dim).
         """
-        return merge_chunks(
-            output_chunks,
-            self._output_merge_spec,
+        merger = stage.output_merger
+        stage.output_merger = None
+        if merger is None:
+            # Chunks not merged as they came
+            return merge_chunks(stage.output_chunks, self._output_merge_spec)
+        return merger.merge()
+
+    @abstractmethod
+    def _get_program(self) -> Tuple[_Action, ...]:
+        """
+        Return the program (ordered `_Action`s) this rank executes in one
+        step.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    @abstractmethod
+    def _build_program(
+        cls,
+        n_microbatches: int,
+        num_stages: int,
+        stage_indices: Tuple[int, ...],
+        rank: int,
+        group_size: int,
+        has_backward: bool,
+    ) -> Tuple[_Action, ...]:
+        """
+        Build the program of pipeline rank `rank` (out of `group_size`)
+        running the stages `stage_indices` of a `num_stages` pipeline.
+        Implementations return the output of a cached program generator keyed
+        by these parameters, so it is computed once per configuration. It
+        does not need live stages, so programs can also be built offline
+        (see `ScheduleSimulator`).
+        """
+        raise NotImplementedError
+
+    def _group_p2p(
+        self,
+        pending: List[Tuple[_Action, List[dist.P2POp]]],
+        tag_matched: bool = False,
+    ) -> List[Tuple[List[_Action], List[dist.P2POp]]]:
+        """
+        Group the P2P ops of communication actions into the batches to issue
+        with `batch_isend_irecv`, in order. Returns the actions each batch
+        serves and its ops.
+
+        If the ops are matched by tag (`tag_matched`), the order they are
+        issued in does not matter, and each action gets its own batch.
+        Otherwise, by default there is one batch per peer, in sorted order of
+        the peers (to avoid hangs), holding the sends to that peer. Each
+        receive from the peer gets its own batch, so that waiting for a
+        receive does not wait for the ones posted ahead of time after it.
+        """
+        if tag_matched:
+            return [([action], ops) for action, ops in pending]
+        if self._coalesce_p2p:
+            # One coalesced operation across all peers
+            return [
+                (
+                    [action for action, _ in pending],
+                    [op for _, ops in pending for op in ops],
+                )
+            ]
+
+        # Dict[(peer, index of receive action), (actions, ops)]
+        batches: Dict[
+            Tuple[int, int], Tuple[List[_Action], List[dist.P2POp]]
+        ] = {}
+        n_recvs_by_peer: Dict[int, int] = defaultdict(int)
+        for action, ops in pending:
+            is_recv = action.computation_type in (RECV_F, RECV_B)
+            for peer in sorted({op.peer for op in ops}):
+                if is_recv:
+                    # Sends to the peer go with its first receive
+                    key = (peer, n_recvs_by_peer[peer])
+                    n_recvs_by_peer[peer] += 1
+                else:
+                    key = (peer, 0)
+                batch_actions, batch_ops = batches.setdefault(key, ([], []))
+                batch_actions.append(action)
+                batch_ops.extend(op for op in ops if op.peer == peer)
+        return [batches[key] for key in sorted(batches)]
+
+    def _run_program(
+        self,
+        stages: List[PipelineStageBase],
+        arg_mbs: List,
+        kwarg_mbs: List,
+        target_mbs: Optional[List] = None,
+        losses: Optional[List] = None,
+    ):
+        """
+        Execute this rank's program (see `_Action` for the semantics) on the
+        local `stages`.
+        """
+        stage_index_to_stage = {stage.stage_index: stage for stage in stages}
+        tag_matched = all(stage.tag_matched_p2p for stage in stages)
+        program = self._get_program()
+        for stage in stages:
+            # Only allocate the receive buffers of microbatches in flight
+            stage._set_num_microbatches(
+                self._n_microbatches,
+                _num_recv_slots(program, stage.stage_index),
+            )
+
+        # Map each computation to the next one, whose offloaded activations
+        # (if it is a backward) are brought back during it
+        compute_actions = [
+            a for a in program if a.computation_type not in _COMM_TYPES
+        ]
+        next_compute = dict(zip(compute_actions, compute_actions[1:]))
+
+        # A loss in which every rank takes part (e.g. a
+        # `VocabParallelCrossEntropyLoss`) defines `_begin_step`, called with
+        # the number of microbatches and the global rank of the last stage,
+        # `_progress`, called to move it forward whenever this rank is between
+        # two actions or waiting for a transfer, and `_end_step`, called once
+        # all the actions are done
+        step_loss: Any = (
+            self._loss_fn if hasattr(self._loss_fn, "_progress") else None
+        )
+        if step_loss is not None:
+            step_loss._begin_step(
+                self._n_microbatches,
+                stages[0].stage_index_to_global_rank[stages[0].num_stages - 1],
+            )
+
+        def wait_works(works):
+            if step_loss is not None:
+                while not all(work.is_completed() for work in works):
+                    step_loss._progress()
+            for work in works:
+                work.wait()
+
+        # Communication actions posted since the last computation, and their
+        # P2P ops
+        pending: List[Tuple[_Action, List[dist.P2POp]]] = []
+        # Works of issued receives, waited for by the computation consuming
+        # them
+        recv_works: Dict[_Action, List[dist.Work]] = {}
+        # Delay send waits: works of the issued sends, with their actions
+        sends_to_wait: List[Tuple[List[_Action], List[dist.Work]]] = []
+
+        def issue_pending_ops():
+            if not pending:
+                return
+            for batch_actions, batch_ops in self._group_p2p(
+                pending, tag_matched
+            ):
+                if self._comm_engine is not None:
+                    works = [self._comm_engine.submit(batch_ops)]
+                else:
+                    works = batch_isend_irecv(batch_ops)
+                send_actions = []
+                for action in batch_actions:
+                    if action.computation_type in (RECV_F, RECV_B):
+                        recv_works.setdefault(action, []).extend(works)
+                    else:
+                        send_actions.append(action)
+                if send_actions:
+                    sends_to_wait.append((send_actions, works))
+            pending.clear()
+
+        def release_sent(wait: bool = False):
+            # The stages no longer need to hold on to the outputs of the
+            # completed forward sends
+            remaining = []
+            for send_actions, works in sends_to_wait:
+                if not wait and not all(work.is_completed() for work in works):
+                    remaining.append((send_actions, works))
+                    continue
+                for work in works:
+                    work.wait()
+                for action in send_actions:
+                    if action.computation_type == SEND_F:
+                        stage_index_to_stage[
+                            action.stage_index
+                        ].release_fwd_outputs(action.microbatch_index)
+            sends_to_wait[:] = remaining
+
+        def wait_recv(computation_type, stage_index, mb_index):
+            recv_action = _Action(computation_type, stage_index, mb_index)
+            wait_works(recv_works.pop(recv_action, []))
+
+        for action in program:
+            computation_type, stage_index, mb_index = action
+            stage = stage_index_to_stage[stage_index]
+
+            if computation_type in _COMM_TYPES:
+                # Receives may be posted ahead of the computation consuming
+                # them, into the buffers of their own microbatch
+                if computation_type == RECV_F:
+                    action_ops = stage.get_fwd_recv_ops(mb_index)
+                elif computation_type == RECV_B:
+                    action_ops = stage.get_bwd_recv_ops(mb_index)
+                elif computation_type == SEND_F:
+                    action_ops = stage.get_fwd_send_ops()
+                else:
+                    action_ops = stage.get_bwd_send_ops()
+                if action_ops:
+                    pending.append((action, action_ops))
+                continue
+
+            # Computation: issue posted ops and wait for the input it needs
+            issue_pending_ops()
+            release_sent()
+            if step_loss is not None:
+                step_loss._progress()
+            next_action = next_compute.get(action)
+            if next_action is not None and next_action.computation_type in (
+                BACKWARD,
+                BACKWARD_INPUT,
+            ):
+                stage_index_to_stage[
+                    next_action.stage_index
+                ].prefetch_activations(next_action.microbatch_index)
+            with record_function(f"{action}"):
+                if computation_type == FORWARD:
+                    if stage.fwd_chunk_id != mb_index:
+                        raise RuntimeError(
+                            f"{action} is out of order, stage {stage_index} "
+                            f"is at forward chunk {stage.fwd_chunk_id}"
+                        )
+                    wait_recv(RECV_F, stage_index, mb_index)
+                    if stage.dynamic_shapes:
+                        # The shape headers have arrived, receive the data
+                        data_ops = stage.get_fwd_recv_data_ops(mb_index)
+                        if data_ops:
+                            wait_works(batch_isend_irecv(data_ops))
+                    output = stage.forward_one_chunk(
+                        arg_mbs[mb_index], kwarg_mbs[mb_index]
+                    )
+                    self._maybe_compute_loss(
+                        stage, output, target_mbs, mb_index
+                    )
+                elif computation_type in (BACKWARD, BACKWARD_INPUT):
+                    if stage.bwd_chunk_id != mb_index:
+                        raise RuntimeError(
+                            f"{action} is out of order, stage {stage_index} "
+                            f"is at backward chunk {stage.bwd_chunk_id}"
+                        )
+                    full_backward = computation_type == BACKWARD
+                    # set library-specific data-parallel config flags to
+                    # ensure gradient accumulation across microbatches. With a
+                    # split backward, the weight pass is the last one.
+                    stage._configure_data_parallel_mode(
+                        last_backward=full_backward
+                        and mb_index == self._n_microbatches - 1
+                    )
+                    wait_recv(RECV_B, stage_index, mb_index)
+                    loss = self._maybe_get_loss(stage, mb_index)
+                    stage.backward_one_chunk(
+                        loss=loss, full_backward=full_backward
+                    )
+                elif computation_type == BACKWARD_WEIGHT:
+                    if stage.bwd_weight_chunk_id != mb_index:
+                        raise RuntimeError(
+                            f"{action} is out of order, stage {stage_index} "
+                            f"is at weight chunk {stage.bwd_weight_chunk_id}"
+                        )
+                    stage._configure_data_parallel_mode(
+                        last_backward=(mb_index == self._n_microbatches - 1)
+                    )
+                    stage.backward_weight_one_chunk()
+                else:
+                    raise ValueError(f"Unknown action {action}")
+
+            logger.debug(f"[Rank {stage.group_rank}] Finished {action}")
+
+        # Flush remaining ops and make sure all of them are finished
+        issue_pending_ops()
+        for works in recv_works.values():
+            wait_works(works)
+        if step_loss is not None:
+            step_loss._end_step()
+        release_sent(wait=True)
+
+        # Return losses if there is a container passed in
+        self._update_losses(stages, losses)
+
+
+def _check_comm_thread(
+    stages: Sequence[PipelineStageBase],
+    comm_thread: bool,
+) -> None:
+    """
+    The P2P ops of a schedule can be issued from a dedicated thread only on
+    CPU, where they are not ordered on device streams.
+    """
+    if comm_thread and any(
+        torch.device(stage.device).type != "cpu" for stage in stages
+    ):
+        raise ValueError(
+            "The communication thread is only supported for CPU stages"
         )
 
 
@@ -225,8 +1104,8 @@ def sorted_batch_isend_irecv(p2p_ops: List[dist.P2POp]) -> Dict[int, dist.Work]:
 class PipelineScheduleSingle(PipelineSchedule):
     """
     Base class for single-stage schedules.
-    Implements the `step` method.
-    Derived classes should implement `_step_microbatches`.
+    Implements the `step` and `_step_microbatches` methods.
+    Derived classes should implement `_build_program`.
     """
 
     def __init__(
@@ -235,12 +1114,17 @@ class PipelineScheduleSingle(PipelineSchedule):
         n_microbatches: int,
         loss_fn: Optional[Callable] = None,
         output_merge_spec: Optional[Union[Dict[str, Any], Tuple[Any]]] = None,
+        comm_thread: bool = False,
+        return_outputs: Optional[bool] = None,
     ):
+        _check_comm_thread([stage], comm_thread)
         # Init parent
         super().__init__(
             n_microbatches=n_microbatches,
             loss_fn=loss_fn,
             output_merge_spec=output_merge_spec,
+            comm_thread=comm_thread,
+            return_outputs=return_outputs,
         )
         self._pipe_info = (
             stage.pipe_info if hasattr(stage, "pipe_info") else None  # type: ignore[attr-defined]
@@ -250,10 +1134,12 @@ class PipelineScheduleSingle(PipelineSchedule):
         self._num_stages = stage.num_stages
         # Set the same has_backward flag for stage object
         self._stage.has_backward = self._has_backward
+        self._init_last_stage(self._stage)
 
     def step(self, *args, target=None, losses: Optional[List] = None, **kwargs):
         # Clean per iteration
         self._stage.clear_runtime_states()
+        self._start_output_merge(self._stage)
 
         # Split inputs into microbatches
         args_split, kwargs_split = self._split_inputs(args, kwargs)
@@ -270,13 +1156,11 @@ class PipelineScheduleSingle(PipelineSchedule):
         self._step_microbatches(args_split, kwargs_split, targets_split, losses)
 
         # Return merged results per original format
-        if self._stage.is_last:
-            return self._merge_outputs(self._stage.output_chunks)
+        if self._stage.is_last and self._return_outputs:
+            return self._merge_outputs(self._stage)
         else:
             return None
 
-
-class ScheduleGPipe(PipelineScheduleSingle):
     def _step_microbatches(
         self,
         arg_mbs: Optional[List] = None,
@@ -287,173 +1171,86 @@ class ScheduleGPipe(PipelineScheduleSingle):
         arg_mbs, kwarg_mbs = self._check_inputs(
             arg_mbs, kwarg_mbs, target_mbs, losses
         )
+        self._run_program([self._stage], arg_mbs, kwarg_mbs, target_mbs, losses)
 
-        # Delay send waits
-        fwd_sends_to_wait: List[dist.Work] = []
-
-        # Run microbatches
-        for i in range(self._n_microbatches):
-            with record_function(f"Forward {i}"):
-                ops = self._stage.get_fwd_recv_ops()
-                works = sorted_batch_isend_irecv(ops)
-                for work in works.values():
-                    work.wait()
-
-                output = self._stage.forward_one_chunk(arg_mbs[i], kwarg_mbs[i])  # type: ignore[index]
-
-                ops = self._stage.get_fwd_send_ops()
-                works = sorted_batch_isend_irecv(ops)
-                fwd_sends_to_wait.extend(works.values())
-
-            logger.debug(
-                f"[{self._stage.stage_index}] Forwarded microbatch {i}"
-            )
-
-            self._maybe_compute_loss(self._stage, output, target_mbs, i)
-
-        # Wait for all forward sends to finish
-        # This should not have performance impact because by the time the first
-        # backward arrives all the forward sends should have been finished.
-        for work in fwd_sends_to_wait:
-            work.wait()
-
-        # No loss function, no need to run backward
-        if not self._has_backward:
-            return
-
-        # Run backward
-        # Delay send waits
-        bwd_sends_to_wait: List[dist.Work] = []
-        for i in range(self._n_microbatches):
-            # set library-specific data-parallel config flags to ensure gradient accumulation across microbatches
-            self._stage._configure_data_parallel_mode(
-                i == self._n_microbatches - 1
-            )
-
-            with record_function(f"Backward {i}"):
-                ops = self._stage.get_bwd_recv_ops()
-                works = sorted_batch_isend_irecv(ops)
-                for work in works.values():
-                    work.wait()
-
-                loss = self._maybe_get_loss(self._stage, i)
-                self._stage.backward_one_chunk(loss=loss)
-
-                ops = self._stage.get_bwd_send_ops()
-                works = sorted_batch_isend_irecv(ops)
-                bwd_sends_to_wait.extend(works.values())
-
-            logger.debug(
-                f"[{self._stage.stage_index}] Backwarded microbatch {i}"
-            )
-
-        # Return losses if there is a container passed in
-        self._update_losses(self._stage, losses)
-
-        # Wait for all backward sends to finish
-        for work in bwd_sends_to_wait:
-            work.wait()
-
-
-class Schedule1F1B(PipelineScheduleSingle):
-    def _step_microbatches(
-        self,
-        arg_mbs: Optional[List] = None,
-        kwarg_mbs: Optional[List] = None,
-        target_mbs: Optional[List] = None,
-        losses: Optional[List] = None,
-    ):
-        arg_mbs, kwarg_mbs = self._check_inputs(
-            arg_mbs, kwarg_mbs, target_mbs, losses
-        )
-
-        # forward for num_microbatches + backward for num_microbatches
-        total_ops = self._n_microbatches * 2
-
-        # Example, 4 GPUs, 8 microbatches
-        # Stage 0: 6 warmup, 2 1f1b, 6 cooldown
-        # Stage 1: 4 warmup, 4 1f1b, 4 cooldown
-        # Stage 2: 2 warmup, 6 1f1b, 2 cooldown
-        # Stage 3: 0 warmup, 8 1f1b, 0 cooldown
-        # fwd only
-        warmup_steps = min(
+    def _get_program(self) -> Tuple[_Action, ...]:
+        program = self._build_program(
             self._n_microbatches,
-            2 * (self._num_stages - self._stage.stage_index - 1),
-        )
-        # fwd + bwd
-        main_1f1b_steps = self._n_microbatches - warmup_steps
-        # bwd only
-        cooldown_steps = total_ops - (warmup_steps + (2 * main_1f1b_steps))
-        total_steps = warmup_steps + main_1f1b_steps + cooldown_steps
-        logger.debug(
-            f"Stage {self._stage.stage_index}: "
-            f"Warmup steps: {warmup_steps}, "
-            f"Main 1F1B steps: {main_1f1b_steps}, "
-            f"Cooldown steps: {cooldown_steps}, "
-            f"Total steps: {total_steps}"
+            self._num_stages,
+            (self._stage.stage_index,),
+            self._stage.group_rank,
+            self._stage.group_size,
+            self._has_backward,
         )
+        if self._stage.dynamic_shapes:
+            return _without_prefetch(program, self._num_stages)
+        return program
 
-        # Delay send waits
-        fwd_sends_to_wait: List[dist.Work] = []
-        bwd_sends_to_wait: List[dist.Work] = []
-
-        # bwd chunk counter
-        bwd_mb_index = 0
-        self._stage._configure_data_parallel_mode(last_backward=False)
-        for i in range(total_steps):
-            if i < self._n_microbatches:
-                # forward
-                with record_function(f"Forward {i}"):
-                    ops = self._stage.get_fwd_recv_ops()
-                    works = sorted_batch_isend_irecv(ops)
-                    for work in works.values():
-                        work.wait()
-
-                    output = self._stage.forward_one_chunk(arg_mbs[i], kwarg_mbs[i])  # type: ignore[index]
-
-                    ops = self._stage.get_fwd_send_ops()
-                    works = sorted_batch_isend_irecv(ops)
-                    fwd_sends_to_wait.extend(works.values())
-
-                self._maybe_compute_loss(self._stage, output, target_mbs, i)
-
-            if i >= warmup_steps and self._has_backward:
-                self._stage._configure_data_parallel_mode(
-                    last_backward=(i == total_steps - 1)
-                )
 
-                # backward
-                with record_function(f"Backward {bwd_mb_index}"):
-                    ops = self._stage.get_bwd_recv_ops()
-                    works = sorted_batch_isend_irecv(ops)
-                    for work in works.values():
-                        work.wait()
+class ScheduleGPipe(PipelineScheduleSingle):
+    @classmethod
+    def _build_program(
+        cls,
+        n_microbatches: int,
+        num_stages: int,
+        stage_indices: Tuple[int, ...],
+        rank: int,
+        group_size: int,
+        has_backward: bool,
+    ) -> Tuple[_Action, ...]:
+        (stage_index,) = stage_indices
+        return _gpipe_program(
+            n_microbatches, num_stages, stage_index, has_backward
+        )
 
-                    loss = self._maybe_get_loss(self._stage, bwd_mb_index)
-                    self._stage.backward_one_chunk(loss=loss)
 
-                    ops = self._stage.get_bwd_send_ops()
-                    works = sorted_batch_isend_irecv(ops)
-                    bwd_sends_to_wait.extend(works.values())
-                    bwd_mb_index += 1
+class Schedule1F1B(PipelineScheduleSingle):
+    @classmethod
+    def _build_program(
+        cls,
+        n_microbatches: int,
+        num_stages: int,
+        stage_indices: Tuple[int, ...],
+        rank: int,
+        group_size: int,
+        has_backward: bool,
+    ) -> Tuple[_Action, ...]:
+        (stage_index,) = stage_indices
+        return _1f1b_program(
+            n_microbatches, num_stages, stage_index, has_backward
+        )
 
-        # Wait for all forward sends to finish
-        for work in fwd_sends_to_wait:
-            work.wait()
 
-        # Wait for all backward sends to finish
-        for work in bwd_sends_to_wait:
-            work.wait()
+class ScheduleZeroBubbleH1(PipelineScheduleSingle):
+    """
+    Zero bubble schedule (ZB-H1). Uses the standard 1F1B warmup of one forward
+    per downstream stage, but the backward of each microbatch is split so
+    that the input gradients are sent to the previous stage before the weight
+    gradients are computed, and the weight passes fill the pipeline bubble.
+    Peak memory is `num_stages` microbatches on every stage.
+    """
 
-        # Return losses if there is a container passed in
-        self._update_losses(self._stage, losses)
+    @classmethod
+    def _build_program(
+        cls,
+        n_microbatches: int,
+        num_stages: int,
+        stage_indices: Tuple[int, ...],
+        rank: int,
+        group_size: int,
+        has_backward: bool,
+    ) -> Tuple[_Action, ...]:
+        (stage_index,) = stage_indices
+        return _zero_bubble_h1_program(
+            n_microbatches, num_stages, stage_index, has_backward
+        )
 
 
 class PipelineScheduleMulti(PipelineSchedule):
     """
     Base class for multi-stage schedules.
-    Implements the `step` method.
-    Derived classes should implement `_step_microbatches`.
+    Implements the `step` and `_step_microbatches` methods.
+    Derived classes should implement `_build_program`.
     """
 
     def __init__(
@@ -462,26 +1259,38 @@ class PipelineScheduleMulti(PipelineSchedule):
         n_microbatches: int,
         loss_fn: Optional[Callable] = None,
         output_merge_spec: Optional[Union[Dict[str, Any], Tuple[Any]]] = None,
+        comm_thread: bool = False,
+        return_outputs: Optional[bool] = None,
     ):
         if len(stages) <= 1:
             raise ValueError(
                 f"Multi-stage schedule expects at least two stages but got {len(stages)}"
             )
+        _check_comm_thread(stages, comm_thread)
         # Init parent
         super().__init__(
             n_microbatches=n_microbatches,
             loss_fn=loss_fn,
             output_merge_spec=output_merge_spec,
+            comm_thread=comm_thread,
+            return_outputs=return_outputs,
         )
         self._pipe_info = (
             stages[0].pipe_info if hasattr(stages[0], "pipe_info") else None  # type: ignore[attr-defined]
         )
+        if any(stage.dynamic_shapes for stage in stages):
+            # Multi-stage programs post receives ahead of the computation
+            # consuming them, see `_without_prefetch`
+            raise NotImplementedError(
+                "Multi-stage schedules do not support stages with dynamic shapes"
+            )
         # Self attributes
         self._stages = stages
         self._num_stages = stages[0].num_stages
         # Set the same has_backward flag for stage object
         for stage in self._stages:
             stage.has_backward = self._has_backward
+            self._init_last_stage(stage)
 
         self._should_compute_loss = (
             lambda stage: stage.is_last and self._loss_fn is not None
@@ -491,6 +1300,7 @@ class PipelineScheduleMulti(PipelineSchedule):
         # Clean per iteration
         for stage in self._stages:
             stage.clear_runtime_states()
+            self._start_output_merge(stage)
 
         # Split inputs into microbatches
         args_split, kwargs_split = self._split_inputs(args, kwargs)
@@ -508,271 +1318,141 @@ class PipelineScheduleMulti(PipelineSchedule):
 
         # Return merged results per original format
         for stage in self._stages:
-            if stage.is_last:
-                return self._merge_outputs(stage.output_chunks)
+            if stage.is_last and self._return_outputs:
+                return self._merge_outputs(stage)
         # Does not contain the last stage
         return None
 
+    def _step_microbatches(
+        self,
+        arg_mbs: Optional[List] = None,
+        kwarg_mbs: Optional[List] = None,
+        target_mbs: Optional[List] = None,
+        losses: Optional[List] = None,
+    ):
+        arg_mbs, kwarg_mbs = self._check_inputs(
+            arg_mbs, kwarg_mbs, target_mbs, losses
+        )
+        self._run_program(self._stages, arg_mbs, kwarg_mbs, target_mbs, losses)
+
+    def _get_program(self) -> Tuple[_Action, ...]:
+        return self._build_program(
+            self._n_microbatches,
+            self._num_stages,
+            tuple(stage.stage_index for stage in self._stages),
+            self._stages[0].group_rank,
+            self._stages[0].group_size,
+            self._has_backward,
+        )
+
 
 class ScheduleLoopedBFS(PipelineScheduleMulti):
     def _step_microbatches(
         self,
         arg_mbs: Optional[List] = None,
         kwarg_mbs: Optional[List] = None,
-        target_mbs: Optional[List] = None,  # TODO
-        losses: Optional[List] = None,  # TODO
+        target_mbs: Optional[List] = None,
+        losses: Optional[List] = None,
     ):
-        # Pre-process inputs
         if arg_mbs is not None:
             # TODO: fix this so it is preset
             self._n_microbatches = len(arg_mbs)
-            assert len(arg_mbs) == self._n_microbatches
-        else:
-            arg_mbs = [()] * self._n_microbatches
-
-        if kwarg_mbs is not None:
-            assert len(kwarg_mbs) == self._n_microbatches
-        else:
-            kwarg_mbs = [{}] * self._n_microbatches
+        super()._step_microbatches(arg_mbs, kwarg_mbs, target_mbs, losses)
 
-        for stage in self._stages:
-            for i in range(self._n_microbatches):
-                with record_function(f"Stage {stage.stage_index} Forward"):
-                    ops = stage.get_fwd_recv_ops()
-                    if ops:
-                        dist.batch_isend_irecv(ops).pop().wait()
-
-                    output = stage.forward_one_chunk(arg_mbs[i], kwarg_mbs[i])
-                    self._maybe_compute_loss(stage, output, target_mbs, i)
-
-                    ops = stage.get_fwd_send_ops()
-                    if ops:
-                        dist.batch_isend_irecv(ops)
-
-        for stage in reversed(self._stages):
-            for i in range(self._n_microbatches):
-                stage._configure_data_parallel_mode(
-                    i == self._n_microbatches - 1
-                )
-                with record_function(f"Stage {stage.stage_index} Backward"):
-                    ops = stage.get_bwd_recv_ops()
-                    if ops:
-                        dist.batch_isend_irecv(ops).pop().wait()
-
-                    loss = self._maybe_get_loss(stage, i)
-                    stage.backward_one_chunk(loss=loss)
-
-                    ops = stage.get_bwd_send_ops()
-                    if ops:
-                        dist.batch_isend_irecv(ops)
-
-        self._update_losses(self._stages, losses)
+    @classmethod
+    def _build_program(
+        cls,
+        n_microbatches: int,
+        num_stages: int,
+        stage_indices: Tuple[int, ...],
+        rank: int,
+        group_size: int,
+        has_backward: bool,
+    ) -> Tuple[_Action, ...]:
+        return _looped_bfs_program(
+            n_microbatches, num_stages, stage_indices, has_backward
+        )
 
 
 class ScheduleInterleaved1F1B(PipelineScheduleMulti):
+    _coalesce_p2p = True
+
     def __init__(
         self,
         stages: List[PipelineStageBase],
         n_microbatches: int,
         loss_fn: Optional[Callable] = None,
         output_merge_spec: Optional[Union[Dict[str, Any], Tuple[Any]]] = None,
+        comm_thread: bool = False,
+        return_outputs: Optional[bool] = None,
     ):
         self.pp_group_size = stages[0].group_size
-        # TODO: is this limitation a must?
-        if n_microbatches % self.pp_group_size != 0:
-            raise ValueError(
-                "Interleaved 1F1B requires the number of microbatches to be a "
-                f"multiple of the number of pipeline ranks ({self.pp_group_size}), "
-                f"but got {n_microbatches}."
-            )
+        # Without P2P ops matched by tag (e.g. on NCCL), the ops of a step
+        # are coalesced across peers, which requires the ranks to post them in
+        # the same order: only for full rounds of microbatches, and no skip
+        # connections
+        if not all(stage.tag_matched_p2p for stage in stages):
+            if n_microbatches % self.pp_group_size != 0:
+                raise ValueError(
+                    "Interleaved 1F1B requires the number of microbatches to be a "
+                    f"multiple of the number of pipeline ranks ({self.pp_group_size}), "
+                    f"but got {n_microbatches}, unless the backend matches "
+                    "P2P ops by tag (gloo, mpi)."
+                )
+            for stage in stages:
+                for dsts in stage.act_send_info.values():
+                    if any(dst != stage.stage_index + 1 for dst in dsts):
+                        raise NotImplementedError(
+                            "Interleaved 1F1B does not support skip connections "
+                            f"(stage {stage.stage_index} sends to stages {dsts}), "
+                            "unless the backend matches P2P ops by tag (gloo, mpi)."
+                        )
+        for stage in stages:
+            if any(
+                peer_rank != i % self.pp_group_size
+                for i, peer_rank in stage.stage_index_to_group_rank.items()
+            ):
+                raise NotImplementedError(
+                    "Interleaved 1F1B requires the stages to be placed on "
+                    "ranks in a wrapped-around fashion (stage i on rank "
+                    f"i % {self.pp_group_size})"
+                )
 
         super().__init__(
             stages=stages,
             n_microbatches=n_microbatches,
             loss_fn=loss_fn,
             output_merge_spec=output_merge_spec,
+            comm_thread=comm_thread,
+            return_outputs=return_outputs,
         )
 
         self.n_local_stages = len(stages)
         self.rank = stages[0].group_rank
 
-    def _step_microbatches(
-        self,
-        arg_mbs: Optional[List] = None,
-        kwarg_mbs: Optional[List] = None,
-        target_mbs: Optional[List] = None,
-        losses: Optional[List] = None,
-    ):
+    @classmethod
+    def _build_program(
+        cls,
+        n_microbatches: int,
+        num_stages: int,
+        stage_indices: Tuple[int, ...],
+        rank: int,
+        group_size: int,
+        has_backward: bool,
+    ) -> Tuple[_Action, ...]:
         """
-        Operate on the microbatches for interleaved 1f1b schedule (https://arxiv.org/pdf/2104.04473.pdf).
-
-        Highest rank has a warmup (fwd only) count of [len(stages) - 1] * number of PP ranks
-        and each rank away from highest rank adds 2 warmup steps due to:
-            - one happened before highest rank's warmup started,
-            - one waiting for backward result to trickle down from highest rank
-
-        TODO: Interleaved 1F1B does not support using sorted_batch_isend_irecv()
-        because it requires recvs and sends from different peers
-        to execute in the same coalesced operation. As a result, this schedule does
-        not support models with skip connections.
+        If the number of microbatches is not a multiple of `group_size`, the
+        last round of microbatches is partial, and the program comes from a
+        greedy ordering of the computations, whose P2P ops are only deadlock
+        free when matched by tag (see `_interleaved_partial_round_orders`).
+        Skip connections require tag matching as well: without it, the ops of
+        a step are coalesced across peers, in the same order on all ranks.
         """
-        arg_mbs, kwarg_mbs = self._check_inputs(
-            arg_mbs, kwarg_mbs, target_mbs, losses
+        return _interleaved_1f1b_program(
+            n_microbatches,
+            num_stages,
+            group_size,
+            rank,
+            stage_indices,
+            has_backward,
         )
-
-        # increment warmup_steps by 2 for each hop away
-        warmup_steps = (self.n_local_stages - 1) * self.pp_group_size
-        warmup_steps += 2 * ((self.pp_group_size - 1) - self.rank)
-        warmup_steps = min(
-            warmup_steps, self._n_microbatches * self.n_local_stages
-        )
-        fwd_bwd_steps = (
-            self.n_local_stages * self._n_microbatches
-        ) - warmup_steps
-        cooldown_steps = (
-            self.n_local_stages * self._n_microbatches
-        ) - fwd_bwd_steps
-
-        assert (
-            warmup_steps + fwd_bwd_steps * 2 + cooldown_steps
-            == self.n_local_stages * self._n_microbatches * 2
-        )
-        total_steps = warmup_steps + fwd_bwd_steps + cooldown_steps
-
-        logger.debug(
-            f"""
-            rank {self.rank}
-            warmup_steps {warmup_steps}
-            1f1b {fwd_bwd_steps}
-            cooldown_steps {cooldown_steps}
-            """
-        )
-
-        def forward_stage_local_index(step):
-            return (step // self.pp_group_size) % self.n_local_stages
-
-        def backward_stage_local_index(step):
-            return (
-                self.n_local_stages
-                - 1
-                - ((step - warmup_steps) // self.pp_group_size)
-                % self.n_local_stages
-            )
-
-        fwd_stage_mb_index: Dict[PipelineStageBase, int] = defaultdict(int)
-        bwd_stage_mb_index: Dict[PipelineStageBase, int] = defaultdict(int)
-
-        # Delay send waits
-        sends_to_wait: List[dist.Work] = []
-
-        # Store ops (potentially across steps)
-        ops: List[dist.P2POp] = []
-
-        # Warmup Phase (forward only)
-        for step in range(warmup_steps):
-            fwd_stage = self._stages[forward_stage_local_index(step)]
-
-            # This will assign the current microbatch index and update it for future steps
-            fwd_stage_mb_index[fwd_stage] = (
-                mb_index := fwd_stage_mb_index[fwd_stage]
-            ) + 1
-
-            logger.debug(
-                f"Rank {self.rank}: {step=}, {fwd_stage.stage_index=}, {mb_index=}"
-            )
-
-            with record_function(f"Forward {step}"):
-                ops.extend(fwd_stage.get_fwd_recv_ops())
-                if ops:
-                    work = dist.batch_isend_irecv(ops).pop()
-                    work.wait()
-                    ops.clear()
-
-                output = fwd_stage.forward_one_chunk(arg_mbs[mb_index], kwarg_mbs[mb_index])  # type: ignore[index]
-
-                ops.extend(fwd_stage.get_fwd_send_ops())
-                # If we are right before the fwd-bwd step, then we need to delay the send to the next step,
-                # This is because fwd-bwd send/recvs among ranks need to be aligned to prevent a hang.
-                # In the edge cases where there are no fwd_bwds and cooldown is immediate, then no delay is needed
-                if ops and (step != warmup_steps - 1 or fwd_bwd_steps == 0):
-                    work = dist.batch_isend_irecv(ops).pop()
-                    sends_to_wait.append(work)
-                    ops.clear()
-
-                self._maybe_compute_loss(
-                    fwd_stage, output, target_mbs, mb_index
-                )
-
-        # 1F1B Phase (forward and backward)
-        for step in range(warmup_steps, warmup_steps + fwd_bwd_steps):
-            fwd_stage = self._stages[forward_stage_local_index(step)]
-            bwd_stage = self._stages[backward_stage_local_index(step)]
-
-            fwd_stage_mb_index[fwd_stage] = (
-                fwd_mb_index := fwd_stage_mb_index[fwd_stage]
-            ) + 1
-            bwd_stage_mb_index[bwd_stage] = (
-                bwd_mb_index := bwd_stage_mb_index[bwd_stage]
-            ) + 1
-
-            bwd_stage._configure_data_parallel_mode(
-                bwd_mb_index == self._n_microbatches - 1
-            )
-            logger.debug(
-                f"Rank {self.rank}: {step=}, {fwd_stage.stage_index=}, {bwd_stage.stage_index=}, {fwd_mb_index=}, {bwd_mb_index=}"
-            )
-            with record_function(f"1F1B {step}"):
-                ops.extend(fwd_stage.get_fwd_recv_ops())
-                ops.extend(bwd_stage.get_bwd_recv_ops())
-                if ops:
-                    work = dist.batch_isend_irecv(ops).pop()
-                    work.wait()
-                    ops.clear()
-
-                # Forward
-                output = fwd_stage.forward_one_chunk(arg_mbs[fwd_mb_index], kwarg_mbs[fwd_mb_index])  # type: ignore[index]
-                ops.extend(fwd_stage.get_fwd_send_ops())
-                self._maybe_compute_loss(
-                    fwd_stage, output, target_mbs, fwd_mb_index
-                )
-
-                # Backward
-                loss = self._maybe_get_loss(bwd_stage, bwd_mb_index)
-                bwd_stage.backward_one_chunk(loss=loss)
-                ops.extend(bwd_stage.get_bwd_send_ops())
-
-        # Cooldown Phase (backward only)
-        for step in range(warmup_steps + fwd_bwd_steps, total_steps):
-            bwd_stage = self._stages[backward_stage_local_index(step)]
-            bwd_stage_mb_index[bwd_stage] = (
-                bwd_mb_index := bwd_stage_mb_index[bwd_stage]
-            ) + 1
-            bwd_stage._configure_data_parallel_mode(
-                bwd_mb_index == self._n_microbatches - 1
-            )
-
-            logger.debug(
-                f"Rank {self.rank}: {step=}, {bwd_stage.stage_index=}, {bwd_mb_index=}"
-            )
-            with record_function(f"Cooldown {step}"):
-                ops.extend(bwd_stage.get_bwd_recv_ops())
-                if ops:
-                    work = dist.batch_isend_irecv(ops).pop()
-                    work.wait()
-                    ops.clear()
-
-                loss = self._maybe_get_loss(bwd_stage, bwd_mb_index)
-                bwd_stage.backward_one_chunk(loss=loss)
-
-                ops.extend(bwd_stage.get_bwd_send_ops())
-                if ops:
-                    work = dist.batch_isend_irecv(ops).pop()
-                    sends_to_wait.append(work)
-                    ops.clear()
-
-        # Make sure all sends are finished
-        for work in sends_to_wait:
-            work.wait()
-
-        # Return losses if there is a container passed in
-        self._update_losses(self._stages, losses)
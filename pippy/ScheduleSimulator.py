@@ -0,0 +1,404 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Offline simulator for pipeline schedules.
+
+Replays the exact per-rank programs a schedule executes (see `_Action`) in a
+single process, with user-provided costs instead of real computation and
+communication, to compare schedules and microbatch counts before launching a
+job.
+
+Model:
+- Computation actions of a rank run back to back, each taking the cost of its
+  stage (forward, backward, or the input / weight part of a split backward).
+- A transfer starts once both the send and the matching receive have been
+  issued, and takes `latency + bytes / bandwidth`. Links are not contended.
+- A computation consuming a receive starts once the transfer has finished.
+"""
+
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Type
+
+import torch
+import torch.fx as fx
+
+from ._IR import Pipe
+from ._utils import flatten_args
+from .PipelineSchedule import (
+    _Action,
+    _COMM_TYPES,
+    BACKWARD,
+    BACKWARD_INPUT,
+    BACKWARD_WEIGHT,
+    FORWARD,
+    PipelineSchedule,
+    PipelineScheduleSingle,
+    RECV_B,
+    RECV_F,
+    SEND_B,
+    SEND_F,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PipelineCosts:
+    """
+    Costs of one microbatch for each stage of a pipeline.
+    """
+
+    # Forward time of each stage, in seconds
+    forward_time: List[float]
+    # Backward time of each stage, in seconds
+    backward_time: List[float]
+    # Bytes sent by each stage to the next one during forward. The gradients
+    # sent back during backward have the same size.
+    activation_bytes: List[float]
+    # Fraction of `backward_time` spent computing input gradients, for
+    # schedules splitting the backward into input and weight passes
+    backward_input_fraction: float = 0.5
+    # Per-message link latency, in seconds
+    latency: float = 0.0
+    # Link bandwidth, in bytes per second
+    bandwidth: float = float("inf")
+
+    def __post_init__(self):
+        if not (
+            len(self.forward_time)
+            == len(self.backward_time)
+            == len(self.activation_bytes)
+        ):
+            raise ValueError(
+                "Expected costs for the same number of stages, but got "
+                f"{len(self.forward_time)} forward times, "
+                f"{len(self.backward_time)} backward times and "
+                f"{len(self.activation_bytes)} activation sizes"
+            )
+
+    @property
+    def num_stages(self) -> int:
+        return len(self.forward_time)
+
+    def compute_time(self, action: _Action) -> float:
+        stage_index = action.stage_index
+        if action.computation_type == FORWARD:
+            return self.forward_time[stage_index]
+        elif action.computation_type == BACKWARD:
+            return self.backward_time[stage_index]
+        elif action.computation_type == BACKWARD_INPUT:
+            return (
+                self.backward_time[stage_index] * self.backward_input_fraction
+            )
+        elif action.computation_type == BACKWARD_WEIGHT:
+            return self.backward_time[stage_index] * (
+                1 - self.backward_input_fraction
+            )
+        raise ValueError(f"Expected a computation action but got {action}")
+
+    def transfer_time(self, send: _Action) -> float:
+        # Gradients of a stage's inputs have the size of the activations
+        # received from the previous stage
+        boundary = (
+            send.stage_index
+            if send.computation_type == SEND_F
+            else send.stage_index - 1
+        )
+        return self.latency + self.activation_bytes[boundary] / self.bandwidth
+
+
+@dataclass
+class SimulationResult:
+    """
+    Outcome of simulating one step of a schedule.
+    """
+
+    # Time until the last rank finishes, in seconds
+    step_time: float
+    # Fraction of rank time spent idle
+    bubble_fraction: float
+    # Computation time of each rank
+    busy_time: Dict[int, float]
+    # Peak number of microbatches whose activations are held by each rank:
+    # forwarded but not yet fully backwarded (`fwd_cache`, plus the state kept
+    # for deferred weight passes)
+    peak_live_microbatches: Dict[int, int]
+    # (rank, action, start, end) of each computation
+    timeline: List[Tuple[int, _Action, float, float]] = field(
+        default_factory=list
+    )
+
+
+def _matching_send(recv: _Action) -> _Action:
+    """
+    The send matching a receive.
+    """
+    if recv.computation_type == RECV_F:
+        return _Action(SEND_F, recv.stage_index - 1, recv.microbatch_index)
+    return _Action(SEND_B, recv.stage_index + 1, recv.microbatch_index)
+
+
+def _consumed_recv(action: _Action, num_stages: int) -> Optional[_Action]:
+    """
+    The receive a computation waits for, if any.
+    """
+    stage_index, mb_index = action.stage_index, action.microbatch_index
+    if action.computation_type == FORWARD and stage_index != 0:
+        return _Action(RECV_F, stage_index, mb_index)
+    if (
+        action.computation_type in (BACKWARD, BACKWARD_INPUT)
+        and stage_index != num_stages - 1
+    ):
+        return _Action(RECV_B, stage_index, mb_index)
+    return None
+
+
+def simulate_programs(
+    programs: Dict[int, Tuple[_Action, ...]],
+    costs: PipelineCosts,
+) -> SimulationResult:
+    """
+    Simulate one step of the given per-rank programs.
+    Raises `RuntimeError` if the programs would hang: a computation waiting
+    for a message that is never sent, or sends and receives that do not
+    match.
+    """
+    num_stages = costs.num_stages
+    pcs = {rank: 0 for rank in programs}
+    clocks = {rank: 0.0 for rank in programs}
+    # Communication actions waiting to be issued at the next computation
+    pending: Dict[int, List[_Action]] = {rank: [] for rank in programs}
+    # Issue time of sends and receives, and the rank issuing them
+    send_times: Dict[_Action, Tuple[int, float]] = {}
+    recv_times: Dict[_Action, Tuple[int, float]] = {}
+    busy_time: Dict[int, float] = defaultdict(float)
+    live: Dict[int, int] = defaultdict(int)
+    peak_live: Dict[int, int] = defaultdict(int)
+    timeline: List[Tuple[int, _Action, float, float]] = []
+
+    def issue(rank):
+        for action in pending[rank]:
+            if action.computation_type in (SEND_F, SEND_B):
+                times = send_times
+            else:
+                times = recv_times
+            if action in times:
+                raise RuntimeError(f"{action} is issued twice")
+            times[action] = (rank, clocks[rank])
+        pending[rank].clear()
+
+    def arrival(recv):
+        send = _matching_send(recv)
+        return max(
+            send_times[send][1], recv_times[recv][1]
+        ) + costs.transfer_time(send)
+
+    progress = True
+    while progress:
+        progress = False
+        for rank, program in programs.items():
+            while pcs[rank] < len(program):
+                action = program[pcs[rank]]
+                if action.computation_type in _COMM_TYPES:
+                    pending[rank].append(action)
+                    pcs[rank] += 1
+                    continue
+
+                issue(rank)
+                start = clocks[rank]
+                recv = _consumed_recv(action, num_stages)
+                if recv is not None:
+                    if recv not in recv_times:
+                        raise RuntimeError(
+                            f"Rank {rank} runs {action} without posting {recv}"
+                        )
+                    if _matching_send(recv) not in send_times:
+                        # Wait for the peer to make progress
+                        break
+                    start = max(start, arrival(recv))
+
+                duration = costs.compute_time(action)
+                clocks[rank] = start + duration
+                busy_time[rank] += duration
+                timeline.append((rank, action, start, clocks[rank]))
+
+                if action.computation_type == FORWARD:
+                    live[rank] += 1
+                    peak_live[rank] = max(peak_live[rank], live[rank])
+                elif action.computation_type in (BACKWARD, BACKWARD_WEIGHT):
+                    live[rank] -= 1
+
+                pcs[rank] += 1
+                progress = True
+
+            if pcs[rank] == len(program):
+                issue(rank)
+
+    stuck = {
+        rank: program[pcs[rank]]
+        for rank, program in programs.items()
+        if pcs[rank] < len(program)
+    }
+    if stuck:
+        raise RuntimeError(f"Schedule would hang, ranks are stuck at {stuck}")
+
+    unmatched_sends = set(send_times) - {_matching_send(r) for r in recv_times}
+    unmatched_recvs = {
+        r for r in recv_times if _matching_send(r) not in send_times
+    }
+    if unmatched_sends or unmatched_recvs:
+        raise RuntimeError(
+            "Schedule would hang, unmatched sends: "
+            f"{sorted(unmatched_sends, key=str)}, unmatched receives: "
+            f"{sorted(unmatched_recvs, key=str)}"
+        )
+
+    # A rank finishes once its computation and its messages are done
+    finish = dict(clocks)
+    for recv, (recv_rank, _) in recv_times.items():
+        send_rank, _ = send_times[_matching_send(recv)]
+        done = arrival(recv)
+        finish[recv_rank] = max(finish[recv_rank], done)
+        finish[send_rank] = max(finish[send_rank], done)
+
+    step_time = max(finish.values(), default=0.0)
+    total_busy = sum(busy_time.values())
+    bubble_fraction = (
+        1 - total_busy / (step_time * len(programs)) if step_time > 0 else 0.0
+    )
+    return SimulationResult(
+        step_time=step_time,
+        bubble_fraction=bubble_fraction,
+        busy_time={rank: busy_time[rank] for rank in programs},
+        peak_live_microbatches={rank: peak_live[rank] for rank in programs},
+        timeline=timeline,
+    )
+
+
+def get_schedule_programs(
+    schedule_class: Type[PipelineSchedule],
+    n_microbatches: int,
+    num_stages: int,
+    num_ranks: Optional[int] = None,
+    has_backward: bool = True,
+) -> Dict[int, Tuple[_Action, ...]]:
+    """
+    Build the program of each rank for a schedule class, with stages placed
+    on ranks in a wrapped-around fashion (rank `r` runs stages `r`,
+    `r + num_ranks`, ...). `num_ranks` defaults to `num_stages` for
+    single-stage schedules.
+    """
+    if num_ranks is None:
+        num_ranks = num_stages
+    if issubclass(schedule_class, PipelineScheduleSingle):
+        if num_ranks != num_stages:
+            raise ValueError(
+                f"{schedule_class.__name__} runs one stage per rank, but got "
+                f"{num_stages} stages for {num_ranks} ranks"
+            )
+    elif num_stages % num_ranks != 0:
+        raise ValueError(
+            f"Number of stages ({num_stages}) must be a multiple of the "
+            f"number of ranks ({num_ranks})"
+        )
+    return {
+        rank: schedule_class._build_program(
+            n_microbatches,
+            num_stages,
+            tuple(range(rank, num_stages, num_ranks)),
+            rank,
+            num_ranks,
+            has_backward,
+        )
+        for rank in range(num_ranks)
+    }
+
+
+def simulate_schedule(
+    schedule_class: Type[PipelineSchedule],
+    n_microbatches: int,
+    costs: PipelineCosts,
+    num_ranks: Optional[int] = None,
+    has_backward: bool = True,
+) -> SimulationResult:
+    """
+    Simulate one step of `schedule_class` with `n_microbatches` microbatches,
+    for a pipeline with the stage costs in `costs`.
+
+    Example:
+        costs = costs_from_pipe(pipe, time_per_param=1e-9)
+        for schedule in (ScheduleGPipe, Schedule1F1B):
+            result = simulate_schedule(schedule, 8, costs)
+            print(schedule.__name__, result.step_time, result.bubble_fraction)
+    """
+    programs = get_schedule_programs(
+        schedule_class,
+        n_microbatches,
+        costs.num_stages,
+        num_ranks,
+        has_backward,
+    )
+    result = simulate_programs(programs, costs)
+    logger.info(
+        f"{schedule_class.__name__} with {n_microbatches} microbatches: "
+        f"step time {result.step_time}, "
+        f"bubble fraction {result.bubble_fraction:.3f}, "
+        f"peak live microbatches {result.peak_live_microbatches}"
+    )
+    return result
+
+
+def _value_bytes(val) -> int:
+    if isinstance(val, torch.Tensor):
+        return val.numel() * val.element_size()
+    if isinstance(val, (tuple, list)):
+        return sum(_value_bytes(v) for v in val)
+    if isinstance(val, dict):
+        return sum(_value_bytes(v) for v in val.values())
+    return 0
+
+
+def costs_from_pipe(
+    pipe: Pipe,
+    time_per_param: float,
+    backward_ratio: float = 2.0,
+    latency: float = 0.0,
+    bandwidth: float = float("inf"),
+) -> PipelineCosts:
+    """
+    Estimate the stage costs of a `Pipe` from its structure:
+    - the forward time of a stage is proportional to its number of
+      parameters (`time_per_param` seconds per parameter for one microbatch),
+      and the backward time is `backward_ratio` times that;
+    - the bytes a stage sends are the size of its outputs, as recorded in
+      `meta["val"]` when the model was traced with a microbatch.
+    """
+    forward_time: List[float] = []
+    activation_bytes: List[float] = []
+    for stage_index in range(pipe.num_stages):
+        submod = pipe.get_stage_module(stage_index)
+        num_params = sum(p.numel() for p in submod.parameters())
+        forward_time.append(num_params * time_per_param)
+
+        sent = 0
+        if stage_index != pipe.num_stages - 1 and isinstance(
+            submod, fx.GraphModule
+        ):
+            for node in submod.graph.nodes:
+                if node.op == "output":
+                    sent = sum(
+                        _value_bytes(arg.meta.get("val"))
+                        for arg in flatten_args(node.args)
+                        if isinstance(arg, fx.Node)
+                    )
+        activation_bytes.append(sent)
+
+    return PipelineCosts(
+        forward_time=forward_time,
+        backward_time=[t * backward_ratio for t in forward_time],
+        activation_bytes=activation_bytes,
+        latency=latency,
+        bandwidth=bandwidth,
+    )
@@ -0,0 +1,407 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Shared memory transport between pipeline ranks on the same host.
+
+Tensors from a co-located peer are received into buffers allocated by the
+receiver in shared memory files, which the sender maps and writes into: the
+receive buffers are used as is by the stage, without copy out of a transport
+buffer, and the data crosses processes with a single copy. Ranks on other
+hosts keep using the process group.
+
+Each ordered pair of co-located ranks has a channel per tag: a ring of
+control records in a shared memory file owned by the receiver, created on
+the first receive with the tag. The n-th receive posted on a channel fills
+record n % `ring_size` with the location of its buffer, then marks it
+posted; the n-th send waits for the record to be posted, copies the tensor
+in and marks it done. As with the gloo process group, the sends and
+receives of a pair are matched by tag, then in the order they are issued.
+Sends are completed by a progress thread, so that they do not block the
+sender until the receive is posted.
+"""
+
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from typing import cast, Deque, Dict, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+
+from ._loopback import LoopbackP2POp
+
+logger = logging.getLogger(__name__)
+
+# Fields of a control record
+_POSTED = 0
+_BUFFER_ID = 1
+_OFFSET = 2
+_NBYTES = 3
+_DONE = 4
+_RECORD_LEN = 8
+
+# Seconds to sleep between polls once busy polling is not worth it
+_POLL_INTERVAL = 1e-5
+# Number of busy polls before sleeping
+_SPIN_POLLS = 1000
+
+
+def _map_file(path: str, nbytes: int, create: bool) -> torch.Tensor:
+    """
+    Map the file `path` as a uint8 tensor shared between processes, creating
+    it with `nbytes` zero bytes if `create`.
+    """
+    if create:
+        with open(path, "wb") as f:
+            f.truncate(nbytes)
+    return torch.from_file(path, shared=True, size=nbytes, dtype=torch.uint8)
+
+
+def _as_bytes(tensor: torch.Tensor) -> torch.Tensor:
+    return tensor.detach().contiguous().reshape(-1).view(torch.uint8)
+
+
+def _poll(ready) -> None:
+    """
+    Wait until `ready()` is true.
+    """
+    polls = 0
+    while not ready():
+        polls += 1
+        if polls > _SPIN_POLLS:
+            time.sleep(_POLL_INTERVAL)
+
+
+class _Channel:
+    """
+    Control records of the messages from rank `src` to rank `dst`.
+    """
+
+    def __init__(self, path: str, ring_size: int, create: bool):
+        self.path = path
+        self.ring_size = ring_size
+        nbytes = ring_size * _RECORD_LEN * 8
+        if create:
+            # Created under a temporary name, so that the sender does not
+            # open it before it has its full size
+            _map_file(path + ".tmp", nbytes, True)
+            os.rename(path + ".tmp", path)
+        self.records = (
+            _map_file(path, nbytes, False)
+            .view(torch.int64)
+            .view(ring_size, _RECORD_LEN)
+        )
+        # Number of messages issued on this side of the channel
+        self.num_issued = 0
+
+    def record(self, seq: int) -> torch.Tensor:
+        return self.records[seq % self.ring_size]
+
+
+class SharedMemoryWork:
+    """
+    Work of a transport op, waited for like the works of the process group.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._error: Optional[Exception] = None
+        # For receives, polls the control record instead of the event
+        self._ready = None
+
+    def is_completed(self) -> bool:
+        if self._ready is not None:
+            return self._ready()
+        return self._done.is_set()
+
+    def wait(self) -> bool:
+        if self._ready is not None:
+            _poll(self._ready)
+        else:
+            self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return True
+
+
+class SharedMemoryP2POp:
+    """
+    A send or receive through a `SharedMemoryTransport`, used like a
+    `dist.P2POp`: see `batch_isend_irecv`.
+    """
+
+    def __init__(
+        self,
+        op,
+        tensor: torch.Tensor,
+        peer: int,
+        transport: "SharedMemoryTransport",
+        tag: int = 0,
+    ):
+        self.op = op
+        self.tensor = tensor
+        self.peer = peer
+        self.transport = transport
+        self.tag = tag
+
+    def issue(self) -> SharedMemoryWork:
+        if self.op is dist.isend:
+            return self.transport._isend(self.tensor, self.peer, self.tag)
+        return self.transport._irecv(self.tensor, self.peer, self.tag)
+
+
+class SharedMemoryTransport:
+    """
+    Transport of the tensors exchanged by pipeline ranks on the same host,
+    through shared memory (see the module documentation). Created
+    collectively by all ranks of `group`, and passed to the stages of this
+    rank. Only for CPU stages. The stages build their ops to co-located peers
+    as `SharedMemoryP2POp`s.
+
+    Args:
+        group (Optional[dist.ProcessGroup]): The process group of the pipeline.
+            If `None`, the default process group.
+        ring_size (int): Number of receives with the same tag that can be
+            posted and not yet completed on a channel.
+        shm_dir (Optional[str]): Directory of the shared memory files. By
+            default `/dev/shm` if it exists, the temporary directory otherwise.
+    """
+
+    def __init__(
+        self,
+        group: Optional[dist.ProcessGroup] = None,
+        ring_size: int = 1024,
+        shm_dir: Optional[str] = None,
+    ):
+        self.group = group
+        self.ring_size = ring_size
+        if shm_dir is None:
+            shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            shm_dir = shm_dir or tempfile.gettempdir()
+        self.rank = dist.get_rank()
+
+        # Find the co-located ranks, and a name for the files of this run
+        group_size = dist.get_world_size(group)
+        hosts: List[Optional[Tuple[int, str]]] = [None] * group_size
+        dist.all_gather_object(
+            hosts, (self.rank, socket.gethostname()), group=group
+        )
+        names: List[Optional[str]] = [uuid.uuid4().hex]
+        src = 0 if group is None else dist.get_global_rank(group, 0)
+        dist.broadcast_object_list(names, src=src, group=group)
+        self._prefix = os.path.join(shm_dir, f"pippy_{names[0]}")
+        my_host = socket.gethostname()
+        self.local_peers = {
+            rank
+            for rank, host in cast(List[Tuple[int, str]], hosts)
+            if host == my_host and rank != self.rank
+        }
+        logger.info(
+            f"[Rank {self.rank}] Shared memory transport with ranks "
+            f"{sorted(self.local_peers)}"
+        )
+
+        # Channels from peers, owned by this rank, and to peers, by (peer,
+        # tag). Created on first use.
+        self._recv_channels: Dict[Tuple[int, int], _Channel] = {}
+        self._send_channels: Dict[Tuple[int, int], _Channel] = {}
+        # Number of sends issued, by (peer, tag)
+        self._num_sends: Dict[Tuple[int, int], int] = {}
+
+        # Receive buffers allocated by this rank, by peer: (storage data
+        # pointer, buffer id) and the paths of their files
+        self._buffer_ids: Dict[int, Dict[int, int]] = {
+            peer: {} for peer in self.local_peers
+        }
+        self._buffer_paths: List[str] = []
+        # Receive buffers of peers mapped by this rank, by (peer, buffer id)
+        self._peer_buffers: Dict[Tuple[int, int], torch.Tensor] = {}
+
+        # Sends waiting for their receive to be posted, in order per (peer,
+        # tag)
+        self._pending: Dict[
+            Tuple[int, int], Deque[Tuple[int, torch.Tensor, SharedMemoryWork]]
+        ] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._progress_loop, name="pippy-shm", daemon=True
+        )
+        self._thread.start()
+
+    def _path(self, src: int, dst: int, suffix: str) -> str:
+        return f"{self._prefix}_{src}_{dst}_{suffix}"
+
+    def handles(self, peer: int) -> bool:
+        """
+        Whether the tensors exchanged with global rank `peer` go through this
+        transport.
+        """
+        return peer in self.local_peers
+
+    def empty(
+        self,
+        size: torch.Size,
+        dtype: torch.dtype,
+        peer: int,
+    ) -> torch.Tensor:
+        """
+        Allocate a buffer in shared memory, to receive tensors from `peer`
+        into. Views of it can be received into as well.
+        """
+        buffers = self._buffer_ids[peer]
+        buffer_id = len(buffers)
+        path = self._path(peer, self.rank, str(buffer_id))
+        numel = 1
+        for d in size:
+            numel *= d
+        nbytes = max(numel * torch.empty((), dtype=dtype).element_size(), 1)
+        flat = _map_file(path, nbytes, True)
+        self._buffer_paths.append(path)
+        buffers[flat.untyped_storage().data_ptr()] = buffer_id
+        return flat[: nbytes if numel else 0].view(dtype).view(size)
+
+    def _irecv(
+        self, tensor: torch.Tensor, peer: int, tag: int
+    ) -> SharedMemoryWork:
+        storage = tensor.untyped_storage()
+        buffer_id = self._buffer_ids[peer].get(storage.data_ptr())
+        if buffer_id is None:
+            raise RuntimeError(
+                f"Receive buffer from rank {peer} was not allocated by the transport"
+            )
+        key = (peer, tag)
+        if key not in self._recv_channels:
+            self._recv_channels[key] = _Channel(
+                self._path(peer, self.rank, f"ctrl{tag}"), self.ring_size, True
+            )
+        channel = self._recv_channels[key]
+        seq = channel.num_issued
+        channel.num_issued += 1
+        record = channel.record(seq)
+        if seq >= channel.ring_size:
+            # The record is reused, its previous message must be received
+            _poll(lambda: record[_DONE].item() == seq - channel.ring_size + 1)
+        record[_BUFFER_ID] = buffer_id
+        record[_OFFSET] = tensor.storage_offset() * tensor.element_size()
+        record[_NBYTES] = tensor.numel() * tensor.element_size()
+        # Published last: the sender reads the fields above once it is set
+        record[_POSTED] = seq + 1
+
+        work = SharedMemoryWork()
+        work._ready = lambda: record[_DONE].item() == seq + 1
+        return work
+
+    def _isend(
+        self, tensor: torch.Tensor, peer: int, tag: int
+    ) -> SharedMemoryWork:
+        key = (peer, tag)
+        seq = self._num_sends.get(key, 0)
+        self._num_sends[key] = seq + 1
+        work = SharedMemoryWork()
+        with self._cond:
+            self._pending.setdefault(key, deque()).append(
+                (seq, _as_bytes(tensor), work)
+            )
+            self._cond.notify()
+        return work
+
+    def _try_send(self, key: Tuple[int, int]) -> bool:
+        """
+        Complete the first pending send to (peer, tag) `key` if its receive is
+        posted.
+        """
+        with self._cond:
+            if not self._pending[key]:
+                return False
+            seq, data, work = self._pending[key][0]
+        peer, tag = key
+        if key not in self._send_channels:
+            path = self._path(self.rank, peer, f"ctrl{tag}")
+            if not os.path.exists(path):
+                # No receive posted with this tag yet
+                return False
+            self._send_channels[key] = _Channel(path, self.ring_size, False)
+        record = self._send_channels[key].record(seq)
+        if record[_POSTED].item() != seq + 1:
+            return False
+
+        buffer_id, offset, nbytes = record[_BUFFER_ID:_DONE].tolist()
+        try:
+            if nbytes != data.numel():
+                raise RuntimeError(
+                    f"Rank {peer} posted a receive of {nbytes} bytes for a "
+                    f"send of {data.numel()} bytes"
+                )
+            buffer_key = (peer, buffer_id)
+            if buffer_key not in self._peer_buffers:
+                path = self._path(self.rank, peer, str(buffer_id))
+                self._peer_buffers[buffer_key] = _map_file(
+                    path, os.path.getsize(path), False
+                )
+            buffer = self._peer_buffers[buffer_key]
+            buffer[offset : offset + nbytes].copy_(data)
+            record[_DONE] = seq + 1
+        except Exception as e:
+            work._error = e
+        with self._cond:
+            self._pending[key].popleft()
+        work._done.set()
+        return True
+
+    def _progress_loop(self) -> None:
+        polls = 0
+        while True:
+            with self._cond:
+                while not self._closed and not any(self._pending.values()):
+                    self._cond.wait()
+                if self._closed:
+                    return
+            progressed = False
+            with self._cond:
+                keys = list(self._pending)
+            for key in keys:
+                while self._try_send(key):
+                    progressed = True
+            polls = 0 if progressed else polls + 1
+            if polls > _SPIN_POLLS:
+                time.sleep(_POLL_INTERVAL)
+
+    def close(self) -> None:
+        """
+        Stop the progress thread and remove the shared memory files of this
+        rank. Pending sends are dropped.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        for path in self._buffer_paths + [
+            channel.path for channel in self._recv_channels.values()
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __del__(self):
+        if hasattr(self, "_thread"):
+            self.close()
+
+
+def batch_isend_irecv(ops: List) -> List:
+    """
+    `dist.batch_isend_irecv`, where the ops can also be `SharedMemoryP2POp`s,
+    issued by their transport, or `LoopbackP2POp`s between stages of this
+    rank. Returns the works of all ops.
+    """
+    local_types = (SharedMemoryP2POp, LoopbackP2POp)
+    works: List = [op.issue() for op in ops if isinstance(op, local_types)]
+    dist_ops = [op for op in ops if not isinstance(op, local_types)]
+    if dist_ops:
+        works.extend(dist.batch_isend_irecv(dist_ops))
+    return works
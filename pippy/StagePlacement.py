@@ -0,0 +1,282 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Topology-aware placement of pipeline stages on ranks.
+
+`measure_links` probes the latency and bandwidth between every pair of ranks,
+`stage_traffic` sums the bytes exchanged by every pair of stages of a `Pipe`,
+and `place_stages` assigns the stages to ranks so that the boundaries with
+the most traffic go over the fastest links, typically within a host. The
+placement is passed to the stages (see `PipelineStageBase`).
+
+Example:
+    links = measure_links(device)
+    placement = place_stages(stage_traffic(pipe), pipe.num_stages, links)
+    stage = PipelineStage(
+        pipe, placement.index(rank), device, placement=placement
+    )
+"""
+
+import logging
+import operator
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.fx as fx
+
+from ._IR import Pipe
+from ._utils import flatten_args
+from .ScheduleSimulator import _value_bytes
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LinkCosts:
+    """
+    Costs of the links between the ranks of a process group.
+    """
+
+    # Per-message latency between each pair of ranks, in seconds
+    latency: List[List[float]]
+    # Bandwidth between each pair of ranks, in bytes per second
+    bandwidth: List[List[float]]
+
+    def __post_init__(self):
+        n = len(self.latency)
+        if len(self.bandwidth) != n or not all(
+            len(row) == n for row in self.latency + self.bandwidth
+        ):
+            raise ValueError(
+                f"Expected {n} x {n} latencies and bandwidths, but got "
+                f"{[len(row) for row in self.latency]} and "
+                f"{[len(row) for row in self.bandwidth]}"
+            )
+
+    @property
+    def num_ranks(self) -> int:
+        return len(self.latency)
+
+    def transfer_time(self, src: int, dst: int, nbytes: float) -> float:
+        """
+        Time to send `nbytes` bytes from rank `src` to rank `dst`: none
+        within a rank.
+        """
+        if src == dst or nbytes == 0:
+            return 0.0
+        return self.latency[src][dst] + nbytes / self.bandwidth[src][dst]
+
+
+def _round_robin_pairs(num_ranks: int) -> List[List[Tuple[int, int]]]:
+    """
+    Rounds in which every pair of ranks meets once, each rank being in at
+    most one pair per round (circle method).
+    """
+    n = num_ranks + num_ranks % 2
+    ranks = list(range(n))
+    rounds = []
+    for _ in range(n - 1):
+        rounds.append(
+            [
+                (min(a, b), max(a, b))
+                for a, b in zip(ranks[: n // 2], reversed(ranks[n // 2 :]))
+                if a < num_ranks and b < num_ranks
+            ]
+        )
+        # Keep the first rank, rotate the others
+        ranks = [ranks[0], ranks[-1]] + ranks[1:-1]
+    return rounds
+
+
+def _ping_pong(
+    tensor: torch.Tensor,
+    peer: int,
+    first: bool,
+    iters: int,
+    group: Optional[dist.ProcessGroup],
+) -> float:
+    """
+    Time of a one-way transfer of `tensor` with global rank `peer`, averaged
+    over `iters` round trips. The `first` rank of the pair sends first.
+    """
+    start = time.perf_counter()
+    for _ in range(iters):
+        if first:
+            dist.send(tensor, peer, group)
+            dist.recv(tensor, peer, group)
+        else:
+            dist.recv(tensor, peer, group)
+            dist.send(tensor, peer, group)
+    # Copying to the host synchronizes with the device, whichever it is
+    tensor[0].item()
+    return (time.perf_counter() - start) / (2 * iters)
+
+
+def measure_links(
+    device: torch.device,
+    group: Optional[dist.ProcessGroup] = None,
+    nbytes: int = 1 << 22,
+    iters: int = 5,
+) -> LinkCosts:
+    """
+    Measure the latency and bandwidth between every pair of ranks of `group`
+    (by default the default process group), by round trips of a one byte
+    and an `nbytes` bytes tensor on `device`. Collective: the pairs are
+    probed in rounds, each rank being in one pair at most per round, and the
+    results are gathered on all ranks.
+    """
+    rank = dist.get_rank(group)
+    num_ranks = dist.get_world_size(group)
+    latency = torch.zeros(num_ranks, dtype=torch.float64, device=device)
+    bandwidth = torch.full(
+        (num_ranks,), float("inf"), dtype=torch.float64, device=device
+    )
+    small = torch.zeros(1, dtype=torch.uint8, device=device)
+    large = torch.zeros(nbytes, dtype=torch.uint8, device=device)
+
+    for pairs in _round_robin_pairs(num_ranks):
+        for a, b in pairs:
+            if rank not in (a, b):
+                continue
+            peer_rank = b if rank == a else a
+            peer = (
+                peer_rank
+                if group is None
+                else dist.get_global_rank(group, peer_rank)
+            )
+            # Warm up the connection, then measure
+            _ping_pong(small, peer, rank == a, 1, group)
+            t_small = _ping_pong(small, peer, rank == a, iters, group)
+            t_large = _ping_pong(large, peer, rank == a, iters, group)
+            latency[peer_rank] = t_small
+            bandwidth[peer_rank] = nbytes / max(t_large - t_small, 1e-12)
+
+    latencies = [torch.empty_like(latency) for _ in range(num_ranks)]
+    bandwidths = [torch.empty_like(bandwidth) for _ in range(num_ranks)]
+    dist.all_gather(latencies, latency, group)
+    dist.all_gather(bandwidths, bandwidth, group)
+    links = LinkCosts(
+        latency=[t.tolist() for t in latencies],
+        bandwidth=[t.tolist() for t in bandwidths],
+    )
+    logger.info(f"Link latencies: {links.latency}")
+    logger.info(f"Link bandwidths: {links.bandwidth}")
+    return links
+
+
+def _output_bytes(submod: torch.nn.Module) -> List[int]:
+    """
+    Size in bytes of each output of a stage module, as recorded in
+    `meta["val"]` when the model was traced with a microbatch.
+    """
+    if not isinstance(submod, fx.GraphModule):
+        return []
+    for node in submod.graph.nodes:
+        if node.op == "output":
+            return [
+                _value_bytes(arg.meta.get("val"))
+                if isinstance(arg, fx.Node)
+                else 0
+                for arg in flatten_args(node.args)
+            ]
+    return []
+
+
+def stage_traffic(pipe: Pipe) -> Dict[Tuple[int, int], float]:
+    """
+    Bytes sent by each stage of `pipe` to each other stage for one
+    microbatch, keyed by (source stage, destination stage), skip connections
+    included. The gradients sent back have the same size.
+    """
+    submod_nodes = [
+        node for node in pipe.split_gm.graph.nodes if node.op == "call_module"
+    ]
+    stage_of = {node: i for i, node in enumerate(submod_nodes)}
+    traffic: Dict[Tuple[int, int], float] = defaultdict(float)
+    for src, node in enumerate(submod_nodes):
+        out_bytes = _output_bytes(pipe.get_stage_module(src))
+        # Outputs of a stage with several of them are taken by `getitem`
+        values = [
+            (user, user.args[1])
+            for user in node.users
+            if user.op == "call_function" and user.target is operator.getitem
+        ]
+        if not values:
+            values = [(node, None)]
+        for value, idx in values:
+            if idx is None:
+                nbytes = sum(out_bytes)
+            elif isinstance(idx, int) and idx < len(out_bytes):
+                nbytes = out_bytes[idx]
+            else:
+                nbytes = 0
+            for dst in {stage_of.get(user) for user in value.users}:
+                if dst is not None and dst != src:
+                    traffic[(src, dst)] += nbytes
+    return dict(traffic)
+
+
+def _placement_cost(
+    placement: List[int],
+    traffic: Dict[Tuple[int, int], float],
+    links: LinkCosts,
+) -> float:
+    """
+    Time spent transferring the activations and gradients of one microbatch
+    with `placement`, links not being contended.
+    """
+    return sum(
+        links.transfer_time(placement[src], placement[dst], nbytes)
+        + links.transfer_time(placement[dst], placement[src], nbytes)
+        for (src, dst), nbytes in traffic.items()
+    )
+
+
+def place_stages(
+    traffic: Dict[Tuple[int, int], float],
+    num_stages: int,
+    links: LinkCosts,
+) -> List[int]:
+    """
+    Assign the `num_stages` stages of a pipeline, exchanging `traffic` (see
+    `stage_traffic`), to the ranks of `links` (see `measure_links`), each
+    rank running `num_stages / num_ranks` stages. Returns the rank of each
+    stage, to pass as the `placement` of the stages.
+
+    Starting from the wrapped-around placement, stages are swapped between
+    ranks as long as it lowers the transfer time of a microbatch, so that
+    the boundaries with the most traffic go over the fastest links. The
+    result is deterministic, hence the same on all ranks given the same
+    inputs. Computation is not modeled: with several stages per rank,
+    consecutive stages may end up on the same rank, where their transfers
+    are free but they run one after the other.
+    """
+    num_ranks = links.num_ranks
+    if num_stages % num_ranks != 0:
+        raise ValueError(
+            f"Number of stages ({num_stages}) must be a multiple of the "
+            f"number of ranks ({num_ranks})"
+        )
+    placement = [i % num_ranks for i in range(num_stages)]
+    cost = _placement_cost(placement, traffic, links)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(num_stages):
+            for j in range(i + 1, num_stages):
+                if placement[i] == placement[j]:
+                    continue
+                placement[i], placement[j] = placement[j], placement[i]
+                new_cost = _placement_cost(placement, traffic, links)
+                # Only take significant improvements, so that it terminates
+                if new_cost < cost * (1 - 1e-9):
+                    cost = new_cost
+                    improved = True
+                else:
+                    placement[i], placement[j] = placement[j], placement[i]
+    logger.info(f"Stage placement {placement}, transfer time {cost}")
+    return placement
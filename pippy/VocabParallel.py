@@ -0,0 +1,366 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Output projection and cross entropy sharded over the vocabulary across all
+pipeline ranks.
+
+With a large vocabulary, the output projection (the "head") and the loss
+make the last stage much heavier than the others. A
+`VocabParallelCrossEntropyLoss`, passed as the `loss_fn` of a schedule on
+every rank, holds a slice of the vocabulary of the head on each rank. The
+last stage returns the hidden states, and each microbatch then goes through
+collectives on a process group of their own, so that they do not get in the
+way of the P2P ops of the pipeline:
+
+1. the hidden states and targets are broadcast from the last stage;
+2. each rank computes the logits of its slice, and their max, sum of
+   exponentials and target logit per token, which are all-gathered to
+   combine into the loss;
+3. each rank computes the gradients of its slice and of the hidden states,
+   which are reduced to the last stage for its backward.
+
+The collectives are issued asynchronously, and the computations in between
+run whenever the schedule is between two actions or waits for a transfer
+(see `_progress`), hence mostly in its bubbles on the ranks other than the
+last. The microbatches go through the steps in order on every rank, which
+keeps the collectives in the same order everywhere.
+
+Example:
+    head = torch.nn.Linear(hidden_dim, vocab_size)  # same on every rank
+    loss_fn = VocabParallelCrossEntropyLoss(head)
+    schedule = Schedule1F1B(stage, chunks, loss_fn=loss_fn)
+"""
+
+from typing import List, Optional
+
+import torch
+import torch.distributed as dist
+
+from ._backward import _accumulate_grad
+
+
+class _MicrobatchState:
+    """
+    Where a microbatch is in the steps of a `VocabParallelCrossEntropyLoss`.
+    """
+
+    # Steps, each issuing collectives once the ones of the previous step are
+    # done
+    HEADER, DATA, STATS, GRAD, DONE = range(5)
+
+    def __init__(self):
+        self.step = self.HEADER
+        self.works: List[dist.Work] = []
+        # On the last stage, set by the forward of the loss
+        self.hidden: Optional[torch.Tensor] = None
+        self.target: Optional[torch.Tensor] = None
+        self.loss: Optional[torch.Tensor] = None
+        # Buffers of the collectives and values kept between the steps
+        self.header: Optional[torch.Tensor] = None
+        self.logits: Optional[torch.Tensor] = None
+        self.stats: List[torch.Tensor] = []
+        self.grad_hidden: Optional[torch.Tensor] = None
+
+
+class _VocabParallelLoss(torch.autograd.Function):
+    """
+    Loss of a microbatch on the last stage. Its value is filled in once the
+    ranks have combined their statistics, and its backward waits for the
+    gradients of the hidden states.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, loss_fn, state):
+        ctx.loss_fn = loss_fn
+        ctx.state = state
+        ctx.hidden_shape = hidden.shape
+        ctx.hidden_dtype = hidden.dtype
+        state.loss = torch.zeros((), dtype=torch.float32, device=hidden.device)
+        return state.loss
+
+    @staticmethod
+    def backward(ctx, grad):
+        state = ctx.state
+        ctx.loss_fn._wait(state)
+        grad_hidden = state.grad_hidden * grad
+        state.grad_hidden = None
+        return (
+            grad_hidden.reshape(ctx.hidden_shape).to(ctx.hidden_dtype),
+            None,
+            None,
+        )
+
+
+class VocabParallelCrossEntropyLoss(torch.nn.Module):
+    """
+    Cross entropy of the logits of the output projection `head`, sharded
+    over the vocabulary across the ranks of the pipeline group `group` (by
+    default the default process group). Collective: to create on every rank,
+    with the same `head`, of which each rank keeps its slice of the
+    vocabulary, and to pass as the `loss_fn` of the schedule of every rank.
+
+    `reduction` is "mean", over the tokens whose target is not
+    `ignore_index`, or "sum". The gradients of the slices are accumulated
+    as soon as the loss of a microbatch is known, for a gradient of 1 for
+    the loss, as the backward of the schedules gives it.
+    """
+
+    # The schedules do not return the outputs of the last stage by default,
+    # and leave the gradients of the slices to the loss, which accumulates
+    # them as it goes
+    _return_outputs = False
+    _computes_param_grads = True
+
+    def __init__(
+        self,
+        head: torch.nn.Linear,
+        group: Optional[dist.ProcessGroup] = None,
+        ignore_index: int = -100,
+        reduction: str = "mean",
+    ):
+        super().__init__()
+        if reduction not in ("mean", "sum"):
+            raise ValueError(
+                f"Expected reduction 'mean' or 'sum' but got {reduction!r}"
+            )
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        vocab_size = head.out_features
+        if vocab_size < self.world_size:
+            raise ValueError(
+                f"Vocabulary of size {vocab_size} cannot be sharded across {self.world_size} ranks"
+            )
+        # Slices as even as possible, the first ones one larger
+        sizes = [
+            vocab_size // self.world_size + (r < vocab_size % self.world_size)
+            for r in range(self.world_size)
+        ]
+        self.vocab_start = sum(sizes[: self.rank])
+        self.vocab_end = self.vocab_start + sizes[self.rank]
+        self.weight = torch.nn.Parameter(
+            head.weight.detach()[self.vocab_start : self.vocab_end].clone()
+        )
+        self.bias = (
+            torch.nn.Parameter(
+                head.bias.detach()[self.vocab_start : self.vocab_end].clone()
+            )
+            if head.bias is not None
+            else None
+        )
+        self.ignore_index = ignore_index
+        self.reduction = reduction
+
+        # A process group of its own, whose collectives are not ordered with
+        # the P2P ops of the pipeline
+        self.group = dist.new_group(
+            dist.get_process_group_ranks(group) if group is not None else None
+        )
+        # Global rank of the last stage
+        self._src: Optional[int] = None
+        # State of each microbatch of the current step, the first one not
+        # done, and the next one to forward on the last stage
+        self._microbatches: List[_MicrobatchState] = []
+        self._head = 0
+        self._next_forward = 0
+
+    def _begin_step(self, n_microbatches: int, src: int) -> None:
+        """
+        Prepare for a step of `n_microbatches` microbatches, the last stage
+        being on global rank `src`.
+        """
+        self._src = src
+        self._microbatches = [_MicrobatchState() for _ in range(n_microbatches)]
+        self._head = 0
+        self._next_forward = 0
+
+    @property
+    def _is_src(self) -> bool:
+        return dist.get_rank() == self._src
+
+    def forward(
+        self, hidden: torch.Tensor, target: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        On the last stage, the loss of the next microbatch of hidden states
+        `hidden` (`[..., hidden_dim]`) and targets `target` (their leading
+        dimensions). Its value is only available once the ranks have
+        combined their statistics (e.g. at the end of the step).
+        """
+        if not self._microbatches or not self._is_src:
+            raise RuntimeError(
+                "VocabParallelCrossEntropyLoss can only be called on the last stage of a schedule"
+            )
+        if hidden.shape[:-1] != target.shape:
+            raise ValueError(
+                f"Hidden states of shape {list(hidden.shape)} do not match targets of shape {list(target.shape)}"
+            )
+        state = self._microbatches[self._next_forward]
+        self._next_forward += 1
+        state.hidden = (
+            hidden.detach()
+            .reshape(-1, hidden.size(-1))
+            .to(self.weight.dtype)
+            .contiguous()
+        )
+        state.target = target.detach().reshape(-1).to(torch.int64).contiguous()
+        loss = _VocabParallelLoss.apply(hidden, self, state)
+        # Get going right away
+        self._progress()
+        return loss
+
+    def _advance(self, state: _MicrobatchState) -> None:
+        """
+        Run the step of `state`, whose collectives are done, and issue the
+        collectives of the next one.
+        """
+        device = self.weight.device
+        if state.step == state.HEADER:
+            if self._is_src:
+                state.header = torch.tensor(
+                    list(state.hidden.shape), device=device  # type: ignore[union-attr]
+                )
+            else:
+                state.header = torch.empty(2, dtype=torch.int64, device=device)
+            state.works = [
+                dist.broadcast(
+                    state.header, self._src, self.group, async_op=True
+                )
+            ]
+        elif state.step == state.DATA:
+            if not self._is_src:
+                num_tokens, hidden_dim = state.header.tolist()  # type: ignore[union-attr]
+                state.hidden = torch.empty(
+                    num_tokens,
+                    hidden_dim,
+                    dtype=self.weight.dtype,
+                    device=device,
+                )
+                state.target = torch.empty(
+                    num_tokens, dtype=torch.int64, device=device
+                )
+            state.works = [
+                dist.broadcast(t, self._src, self.group, async_op=True)
+                for t in (state.hidden, state.target)
+            ]
+        elif state.step == state.STATS:
+            with torch.no_grad():
+                logits = torch.nn.functional.linear(
+                    state.hidden, self.weight, self.bias  # type: ignore[arg-type]
+                ).float()
+                target = state.target
+                in_slice = (target >= self.vocab_start) & (
+                    target < self.vocab_end
+                )
+                local_target = (target - self.vocab_start).clamp(
+                    0, logits.size(-1) - 1
+                )
+                max_logits = logits.max(dim=-1).values
+                sum_exp = (logits - max_logits[:, None]).exp().sum(dim=-1)
+                target_logits = (
+                    logits.gather(1, local_target[:, None]).squeeze(1)
+                    * in_slice
+                )
+                stats = torch.stack([max_logits, sum_exp, target_logits])
+            state.logits = logits
+            state.stats = [
+                torch.empty_like(stats) for _ in range(self.world_size)
+            ]
+            state.works = [
+                dist.all_gather(state.stats, stats, self.group, async_op=True)
+            ]
+        elif state.step == state.GRAD:
+            assert state.target is not None and state.logits is not None
+            with torch.no_grad():
+                max_logits, sum_exp, target_logits = torch.stack(
+                    state.stats
+                ).unbind(1)
+                lse = torch.logsumexp(max_logits + sum_exp.log(), dim=0)
+                target = state.target
+                valid = target != self.ignore_index
+                scale = valid.float()
+                if self.reduction == "mean":
+                    # As `F.cross_entropy`, nan if all targets are ignored
+                    scale = scale / valid.sum()
+                if state.loss is not None:
+                    state.loss.copy_(
+                        ((lse - target_logits.sum(dim=0)) * scale).sum()
+                    )
+
+                # Gradients of the logits of the slice
+                grad_logits = (state.logits - lse[:, None]).exp()
+                in_slice = (
+                    valid
+                    & (target >= self.vocab_start)
+                    & (target < self.vocab_end)
+                )
+                rows = in_slice.nonzero().squeeze(1)
+                grad_logits[rows, target[rows] - self.vocab_start] -= 1
+                grad_logits = (grad_logits * scale[:, None]).to(
+                    self.weight.dtype
+                )
+                _accumulate_grad(self.weight, grad_logits.t() @ state.hidden)
+                if self.bias is not None:
+                    _accumulate_grad(self.bias, grad_logits.sum(dim=0))
+                state.grad_hidden = grad_logits @ self.weight
+            state.logits = None
+            state.stats = []
+            state.works = [
+                dist.reduce(
+                    state.grad_hidden,
+                    self._src,
+                    group=self.group,
+                    async_op=True,
+                )
+            ]
+        state.step += 1
+
+    def _progress(self, block: bool = False, until: Optional[int] = None):
+        """
+        Move the microbatches through their steps, in order, as far as their
+        collectives are done, or waiting for them with `block`, until
+        microbatch `until` (by default all of them) is done.
+        """
+        last = len(self._microbatches) - 1 if until is None else until
+        while self._head <= last:
+            state = self._microbatches[self._head]
+            if state.works:
+                if not block and not all(
+                    work.is_completed() for work in state.works
+                ):
+                    return
+                for work in state.works:
+                    work.wait()
+                state.works = []
+            if state.step == state.DONE:
+                # Release what is not needed by the backward
+                state.hidden = None
+                state.target = None
+                state.header = None
+                if not self._is_src:
+                    state.grad_hidden = None
+                self._head += 1
+            elif self._is_src and state.hidden is None:
+                # Not forwarded yet
+                return
+            else:
+                self._advance(state)
+
+    def _wait(self, state: _MicrobatchState) -> None:
+        """
+        Block until microbatch `state` is done.
+        """
+        until = self._microbatches.index(state)
+        self._progress(block=True, until=until)
+        if self._head <= until:
+            raise RuntimeError(
+                f"Microbatch {until} of the vocabulary parallel loss cannot complete before its forward"
+            )
+
+    def _end_step(self) -> None:
+        """
+        Complete all the microbatches of the step.
+        """
+        self._progress(block=True)
+        if self._head < len(self._microbatches):
+            raise RuntimeError(
+                f"Only {self._head} of {len(self._microbatches)} microbatches went through the vocabulary parallel loss"
+            )
@@ -514,6 +514,8 @@ class Pipe(QualnameMapMixin, torch.nn.Module):
         has_loss_and_backward: bool
         args_chunk_spec: Optional[Tuple[Any, ...]] = None
         kwargs_chunk_spec: Optional[Dict[str, Any]] = None
+        # Whether the stages were traced with dynamic shapes
+        has_dynamic_shapes: bool = False
 
     def __init__(
         self,
@@ -1136,12 +1138,14 @@ class Pipe(QualnameMapMixin, torch.nn.Module):
         mod: torch.nn.Module,
         example_args: Tuple[Any, ...],
         example_kwargs: Optional[Dict[str, Any]] = None,
+        dynamic_shapes: Optional[Union[Dict[str, Any], Tuple[Any, ...]]] = None,
     ) -> ExportedProgram:
         logger.info("Tracing model ...")
         ep = torch.export.export(
             mod,
             example_args,
             example_kwargs,
+            dynamic_shapes=dynamic_shapes,
         )
         return ep
 
@@ -1154,6 +1158,7 @@ class Pipe(QualnameMapMixin, torch.nn.Module):
         split_policy: Optional[
             Callable[[fx.GraphModule], fx.GraphModule]
         ] = None,
+        dynamic_shapes: Optional[Union[Dict[str, Any], Tuple[Any, ...]]] = None,
     ):
         # If a param will be used in multiple pipeline stages, we default the strategy to REPLICATE'ing the param across
         # stages instead of TRANSMIT'ting it
@@ -1182,6 +1187,7 @@ class Pipe(QualnameMapMixin, torch.nn.Module):
             mod,
             example_args=args_split[0],
             example_kwargs=kwargs_split[0],
+            dynamic_shapes=dynamic_shapes,
         )
 
         pipe = Pipe._from_traced(
@@ -1228,6 +1234,7 @@ class Pipe(QualnameMapMixin, torch.nn.Module):
             has_loss_and_backward=pipe.has_loss_and_backward,
             args_chunk_spec=Pipe.args_chunk_spec,
             kwargs_chunk_spec=Pipe.kwargs_chunk_spec,
+            has_dynamic_shapes=dynamic_shapes is not None,
         )
         return pipe
 
@@ -1345,6 +1352,7 @@ def pipeline(
     example_kwargs: Optional[Dict[str, Any]] = None,
     split_spec: Optional[Dict[str, SplitPoint]] = None,
     split_policy: Optional[Callable[[fx.GraphModule], fx.GraphModule]] = None,
+    dynamic_shapes: Optional[Union[Dict[str, Any], Tuple[Any, ...]]] = None,
 ) -> Pipe:
     """
     Creates a pipeline representation for the provided module.
@@ -1365,6 +1373,10 @@ def pipeline(
         A dictionary mapping module names to `SplitPoint`s. (default: `None`)
     split_policy:
         The policy to use for splitting the module. (default: `None`)
+    dynamic_shapes:
+        Dynamic dimensions of the inputs of one microbatch, in the format of
+        `torch.export.export`. If given, the stages accept microbatches whose
+        shapes vary along these dimensions. (default: `None`)
 
     Returns
     -------
@@ -1383,6 +1395,7 @@ def pipeline(
             num_chunks=num_chunks,
             example_args=example_args,
             example_kwargs=example_kwargs,
+            dynamic_shapes=dynamic_shapes,
         )
     else:
         # Use split policy
@@ -1392,6 +1405,7 @@ def pipeline(
             example_args=example_args,
             example_kwargs=example_kwargs,
             split_policy=split_policy,
+            dynamic_shapes=dynamic_shapes,
         )
 
 
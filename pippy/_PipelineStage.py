@@ -1,8 +1,11 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates
 import logging
+import math
 import operator
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Tuple, Union
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
 
 import torch
 import torch.distributed as dist
@@ -11,11 +14,25 @@ from torch._subclasses.fake_tensor import FakeTensor
 from torch.distributed._composable.fsdp.fully_shard import FSDPModule
 from torch.fx.node import map_aggregate
 from torch.nn.parallel import DistributedDataParallel
+from torch.utils.checkpoint import checkpoint
 
-from ._backward import stage_backward
+from ._backward import (
+    stage_backward,
+    stage_backward_input,
+    stage_backward_weight,
+)
 from ._debug import map_debug_info
 from ._IR import Pipe
-from ._utils import flatten_args, modify_graph_op_device
+from ._loopback import LoopbackP2POp
+from ._offload import ActivationOffloader
+from .Compression import Codec
+from .microbatch import ChunkMerger
+from .SharedMemoryTransport import SharedMemoryP2POp, SharedMemoryTransport
+from ._utils import (
+    flatten_args,
+    modify_graph_op_device,
+    values_requiring_grad,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +55,8 @@ class RecvInfo:
         input_name: str,
         source: int,
         buffer: torch.Tensor,
+        order: int = 0,
+        requires_grad: bool = True,
     ):
         # Name of this input
         self.input_name = input_name
@@ -45,6 +64,14 @@ class RecvInfo:
         self.source = source
         # Buffer to receive the input into.
         self.buffer = buffer
+        # Sort key of this input among the ones from the same source, which
+        # sends them in that order (see `PipelineStageBase._send_order`)
+        self.order = order
+        # Whether the input requires gradient: only then is its buffer set to
+        # require gradient, and its gradient sent back
+        self.requires_grad = requires_grad
+        # With a codec, the tensors received and decoded into `buffer`
+        self.wire_buffers: Optional[List[torch.Tensor]] = None
 
     def __repr__(self):
         return f"RecvInfo(input={self.input_name}, source={self.source}, shape={self.buffer.size()})"
@@ -59,16 +86,145 @@ def _make_tensor_from_meta(
     device: torch.device,
 ) -> torch.Tensor:
     """
-    Create a real tensor from a fake tensor.
+    Create a real tensor from a fake tensor. Symbolic (dynamic) dimensions are
+    created empty, the tensor being resized to the shapes seen at run time.
     """
     return torch.empty(
-        example.size(),
+        [d if isinstance(d, int) else 0 for d in example.size()],
         dtype=example.dtype,
         layout=example.layout,
         device=device,
     )
 
 
+# Alignment, in bytes, of the tensors packed into a flat P2P buffer
+_FLAT_P2P_ALIGNMENT = 16
+
+
+def _sorted_recv_infos(recv_infos: Sequence[InputInfo]) -> List[RecvInfo]:
+    """
+    The `RecvInfo`s of `recv_infos`, in the order their tensors are sent by
+    their source stages.
+    """
+    return sorted(
+        (info for info in recv_infos if isinstance(info, RecvInfo)),
+        key=lambda info: info.order,
+    )
+
+
+def _recv_tensors(info: RecvInfo) -> List[torch.Tensor]:
+    """
+    The tensors to receive for `info`: its wire buffers with a codec, its
+    buffer otherwise.
+    """
+    return [info.buffer] if info.wire_buffers is None else info.wire_buffers
+
+
+def _p2p_tag(src_stage: int, dst_stage: int, k: int, num_stages: int) -> int:
+    """
+    Tag of the P2P ops of the `k`-th tensor sent from stage `src_stage` to
+    stage `dst_stage` for a microbatch (-1 for the shape header of dynamic
+    shapes). Activations and gradients go in opposite directions, so have
+    different tags. On backends matching P2P ops by tag, the ops of two ranks
+    can then be posted in any order: successive ops with the same tag are for
+    successive microbatches, which both sides post in microbatch order.
+    """
+    return ((k + 1) * num_stages + src_stage) * num_stages + dst_stage
+
+
+def _bucket_numel(numel: int) -> int:
+    """
+    Round `numel` up to a power of two: the receive buffers of dynamic shapes
+    are shared by all shapes of the same bucket.
+    """
+    return 1 << max(numel - 1, 0).bit_length()
+
+
+def _flat_layout(tensors: Sequence[torch.Tensor]) -> Tuple[List[int], int]:
+    """
+    Compute the byte offsets of `tensors` packed one after another into a
+    flat buffer, and the size of that buffer.
+    """
+    offsets: List[int] = []
+    size = 0
+    for t in tensors:
+        # Round up so that every tensor can be viewed with its own dtype
+        size = -(-size // _FLAT_P2P_ALIGNMENT) * _FLAT_P2P_ALIGNMENT
+        offsets.append(size)
+        size += t.numel() * t.element_size()
+    return offsets, size
+
+
+def _flat_views(
+    flat: torch.Tensor,
+    tensors: Sequence[torch.Tensor],
+    offsets: Sequence[int],
+) -> List[torch.Tensor]:
+    """
+    Views into the uint8 buffer `flat` with the dtypes and shapes of `tensors`.
+    """
+    return [
+        flat[offset : offset + t.numel() * t.element_size()]
+        .view(t.dtype)
+        .view(t.size())
+        for t, offset in zip(tensors, offsets)
+    ]
+
+
+def _pack_flat(tensors: Sequence[torch.Tensor]) -> torch.Tensor:
+    """
+    Copy `tensors` into a new flat uint8 buffer, laid out by `_flat_layout`.
+    A single contiguous tensor is viewed as such a buffer instead.
+    """
+    if len(tensors) == 1 and tensors[0].is_contiguous():
+        # Already laid out, no need to copy
+        return tensors[0].detach().view(-1).view(torch.uint8)
+    offsets, size = _flat_layout(tensors)
+    flat = torch.empty(size, dtype=torch.uint8, device=tensors[0].device)
+    with torch.no_grad():
+        for view, t in zip(_flat_views(flat, tensors, offsets), tensors):
+            view.copy_(t)
+    return flat
+
+
+def _checkpoint_submodule(mod: torch.nn.Module) -> None:
+    """
+    Make `mod` save only its inputs for backward: its forward is run again,
+    with the same RNG state, when its gradients are computed.
+    """
+    forward = mod.forward
+
+    def checkpointed_forward(*args, **kwargs):
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+
+    mod.forward = checkpointed_forward
+
+
+def _get_rng_state(
+    device: torch.device,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    The CPU RNG state, and the RNG state of `device` if it is a GPU.
+    """
+    return (
+        torch.get_rng_state(),
+        torch.cuda.get_rng_state(device) if device.type == "cuda" else None,
+    )
+
+
+def _set_rng_state(
+    device: torch.device,
+    rng_state: Tuple[torch.Tensor, Optional[torch.Tensor]],
+) -> None:
+    """
+    Restore an RNG state returned by `_get_rng_state`.
+    """
+    cpu_state, device_state = rng_state
+    torch.set_rng_state(cpu_state)
+    if device_state is not None:
+        torch.cuda.set_rng_state(device_state, device)
+
+
 class PipelineStageBase(ABC):
     """
     Base class for pipeline stages.
@@ -83,6 +239,15 @@ class PipelineStageBase(ABC):
         device: torch.device,
         num_microbatches: int,
         group: Optional[dist.ProcessGroup] = None,
+        flat_p2p: bool = False,
+        dynamic_shapes: bool = False,
+        recompute: Union[bool, Sequence[str]] = False,
+        offload: bool = False,
+        offload_dir: Optional[str] = None,
+        act_codec: Optional[Codec] = None,
+        grad_codec: Optional[Codec] = None,
+        transport: Optional[SharedMemoryTransport] = None,
+        placement: Optional[Sequence[int]] = None,
     ):
         """
         Args:
@@ -94,6 +259,48 @@ class PipelineStageBase(ABC):
             group (Optional[dist.ProcessGroup]): The process group to use for communication.
                 If `None`, the default process group will be used.
                 Default: `None`.
+            flat_p2p (bool): If `True`, the tensors sent to the same stage for a microbatch are
+                packed into one flat buffer and sent as a single message. All stages of the
+                pipeline must use the same setting.
+                Default: `False`.
+            dynamic_shapes (bool): If `True`, the shapes of the tensors received by this stage
+                may change from one microbatch to the next. Activations are sent with a
+                header holding their shapes, and received into buffers cached by shape
+                bucket. All stages of the pipeline must use the same setting.
+                Default: `False`.
+            recompute (Union[bool, Sequence[str]]): Recompute activations in backward instead
+                of keeping them from the forward. If `True`, the forward of each microbatch
+                only saves the stage inputs and RNG state, and is run again right before its
+                backward. The last stage always keeps its activations, which the loss is
+                computed from. If a list of names, only the named submodules of the stage
+                module are recomputed.
+                Default: `False`.
+            offload (bool): If `True`, the activations saved by the forward of each microbatch
+                are moved out of device memory until its backward, and prefetched back
+                during the computation before it: to pinned host memory on GPUs, to
+                memory-mapped files on CPU.
+                Default: `False`.
+            offload_dir (Optional[str]): Directory of the memory-mapped files of `offload` on
+                CPU. If `None`, a temporary directory is used.
+                Default: `None`.
+            act_codec (Optional[Codec]): Codec compressing the activations sent and received
+                by this stage (see `pippy.Compression`). All stages of the pipeline must use
+                the same codec.
+                Default: `None`.
+            grad_codec (Optional[Codec]): Codec compressing the gradients sent and received
+                by this stage. All stages of the pipeline must use the same codec.
+                Default: `None`.
+            transport (Optional[SharedMemoryTransport]): Transport of the tensors exchanged
+                with stages on ranks of the same host, through shared memory. The other
+                stages are reached through the process group. Only for CPU stages.
+                Default: `None`.
+            placement (Optional[Sequence[int]]): Rank in `group` of each stage of the pipeline,
+                which can run several stages, for instance in a V shape or to keep the
+                boundaries with the most traffic within a host (see `pippy.StagePlacement`).
+                Stages of the same rank exchange tensors within the process. All stages of
+                the pipeline must use the same placement. If `None`, stages are placed in
+                a wrapped-around fashion: stage `i` on rank `i % group size`.
+                Default: `None`.
         """
         super().__init__()
         if stage_index >= num_stages:
@@ -107,10 +314,33 @@ class PipelineStageBase(ABC):
         self.device = device
         self.chunks = num_microbatches
         self.group = group
+        self.flat_p2p = flat_p2p
+        self.recompute = recompute
+        self.dynamic_shapes = dynamic_shapes
+        if flat_p2p and dynamic_shapes:
+            raise ValueError(
+                "flat_p2p is not supported together with dynamic_shapes"
+            )
+        self.act_codec = act_codec
+        self.grad_codec = grad_codec
+        if dynamic_shapes and (act_codec or grad_codec):
+            raise ValueError(
+                "Codecs are not supported together with dynamic_shapes"
+            )
+        self.transport = transport
+        if transport is not None and (
+            dynamic_shapes or torch.device(device).type != "cpu"
+        ):
+            raise ValueError(
+                "The shared memory transport only supports CPU stages without dynamic_shapes"
+            )
 
         # `group_rank` is rank in process group `group`.
         self.group_rank = dist.get_rank(self.group)
         self.group_size = dist.get_world_size(self.group)
+        # Whether the backend matches P2P ops by tag (see `_p2p_tag`), rather
+        # than in the order they are posted in between two ranks
+        self.tag_matched_p2p = dist.get_backend(self.group) in ("gloo", "mpi")
         if self.group_size > self.num_stages:
             raise RuntimeError(
                 f"Pipeline group size {self.group_size} cannot be larger than number of stages {self.num_stages}"
@@ -123,17 +353,82 @@ class PipelineStageBase(ABC):
         self.fwd_chunk_id: int = 0
         # Current backward chunk id
         self.bwd_chunk_id: int = 0
-        # Caching chunk outputs for final output merge or reduction
+        # map microbatch ID to the state deferred to the weight gradient pass
+        # when the backward is split
+        self.bwd_weight_cache: Dict[int, Tuple[Dict, Any]] = {}
+        # Current weight gradient chunk id
+        self.bwd_weight_chunk_id: int = 0
+        # Caching chunk outputs for final output merge or reduction, on the
+        # last stage only, and unless the schedule only needs the losses
         self.output_chunks: List[Any] = []
+        self.keep_outputs: bool = True
+        # When set, the outputs are merged into the full batch as they come
+        # instead (see `ChunkMerger`)
+        self.output_merger: Optional[ChunkMerger] = None
+        # Parameters of the loss computed on the outputs of the last stage,
+        # whose gradients its backward also computes (e.g. the output
+        # projection of a `ChunkedCrossEntropyLoss`)
+        self.loss_parameters: List[torch.nn.Parameter] = []
+        # map microbatch ID to its outputs to send in forward, released once
+        # their sends complete (see `release_fwd_outputs`)
+        self.fwd_send_outputs: Dict[int, Tuple[Any, ...]] = {}
+        # With dynamic shapes, map microbatch ID to the shapes of the tensors
+        # it sends in forward, which its received gradients have
+        self._fwd_send_shapes: Dict[int, List[torch.Size]] = {}
+        # Most bytes held by the caches above at once in a step (see
+        # `retained_bytes`)
+        self.peak_retained_bytes: int = 0
+        # map microbatch ID to the inputs and RNG state to recompute its
+        # forward with
+        self.recompute_cache: Dict[
+            int,
+            Tuple[
+                Tuple[Any, ...],
+                Dict[str, Any],
+                Tuple[torch.Tensor, Optional[torch.Tensor]],
+            ],
+        ] = {}
+
+        self.offloader: Optional[ActivationOffloader] = (
+            ActivationOffloader(device, offload_dir) if offload else None
+        )
+
+        if not isinstance(recompute, bool):
+            for name in recompute:
+                try:
+                    submod = self.submod.get_submodule(name)
+                except AttributeError as e:
+                    raise ValueError(
+                        f"Cannot recompute {name}, not a submodule of stage {stage_index}"
+                    ) from e
+                _checkpoint_submodule(submod)
 
         # Create stage id to group rank mapping
-        # In interleaved case, `group_rank` is stage index % group size.
-        self.stage_index_to_group_rank: Dict[int, int] = {}
-        pg_world_size = dist.get_world_size(group)
-        for i in range(self.num_stages):
-            # We only support wrapped-around interleaving
-            peer_rank = i % pg_world_size
-            self.stage_index_to_group_rank.setdefault(i, peer_rank)
+        if placement is None:
+            # Wrapped-around: in interleaved case, `group_rank` is stage
+            # index % group size.
+            placement = [i % self.group_size for i in range(self.num_stages)]
+        else:
+            if len(placement) != self.num_stages or not all(
+                0 <= peer_rank < self.group_size for peer_rank in placement
+            ):
+                raise ValueError(
+                    f"Placement {list(placement)} must map each of the {self.num_stages} stages to a rank of the group of size {self.group_size}"
+                )
+            if placement[stage_index] != self.group_rank:
+                raise ValueError(
+                    f"Stage {stage_index} is placed on rank {placement[stage_index]}, not on this rank {self.group_rank}"
+                )
+        self.stage_index_to_group_rank: Dict[int, int] = dict(
+            enumerate(placement)
+        )
+        # Global ranks of the stages, for P2P ops
+        self.stage_index_to_global_rank: Dict[int, int] = {
+            i: peer_rank
+            if self.group is None
+            else dist.get_global_rank(self.group, peer_rank)
+            for i, peer_rank in self.stage_index_to_group_rank.items()
+        }
 
         # Initialize has_backward to false; this will be set to true if loss
         # function is passed to pipeline schedule
@@ -141,14 +436,49 @@ class PipelineStageBase(ABC):
         # Log prefix
         self.log_prefix = f"[Stage {self.stage_index}]"
 
-        # Forward infra
-        self.args_recv_info: Dict[int, Tuple[InputInfo]] = {}
+        # Receive buffers are allocated per slot and reused round-robin:
+        # microbatch i receives into the buffers of slot i % `num_recv_slots`.
+        # Schedules lower it to the number of microbatches in flight (see
+        # `_set_num_microbatches`).
+        self.num_recv_slots = num_microbatches
+
+        # Forward infra, created lazily per slot
+        self.args_recv_info: Dict[int, Tuple[InputInfo, ...]] = {}
         self.set_requires_grad: Dict[int, bool] = {}
         self.act_send_info: Dict[int, List] = {}
+        # Map index of an input to the stages it is relayed to, when the
+        # stages consuming a tensor forward it from one to the next (see
+        # `_PipelineStage`)
+        self.act_relay_info: Dict[int, List[int]] = {}
 
         # Backward infra will created lazily
         self.grad_recv_info: Dict = {}
         self.grad_send_info: Optional[List] = None
+        # Index of the tensor sent in forward (see `_get_fwd_send_tensors`)
+        # that each gradient recv info is the gradient of. If `None`, one per
+        # output with destinations, in order.
+        self.grad_recv_index: Optional[List[int]] = None
+
+        # Communication plan, built on first use and reused across
+        # microbatches and steps (see `_clear_comm_plan`):
+        # map slot to its recv ops, which always use the same buffers
+        self._fwd_recv_ops: Dict[int, List[dist.P2POp]] = {}
+        self._bwd_recv_ops: Dict[int, List[dist.P2POp]] = {}
+        # (destination stage, indices of the tensors) of each message to send
+        self._fwd_send_plan: Optional[List[Tuple[int, List[int]]]] = None
+        self._bwd_send_plan: Optional[List[Tuple[int, List[int]]]] = None
+
+        # With dynamic shapes, map slot to the shape header received from
+        # each source stage, and to the storage of its receive buffers, keyed
+        # by (is gradient, index of the tensor, bucket of its size)
+        self._fwd_shape_headers: Dict[int, Dict[int, torch.Tensor]] = {}
+        self._recv_storage: Dict[
+            int, Dict[Tuple[bool, int, int], torch.Tensor]
+        ] = {}
+
+        # Time the warmup exchange with each peer took, by global rank (see
+        # `warmup_p2p`)
+        self.p2p_warmup_latency: Dict[int, float] = {}
 
     @property
     def has_backward(self) -> bool:
@@ -186,9 +516,9 @@ class PipelineStageBase(ABC):
 
         def map_recv_to_send(a):
             # Note: we send gradients back to previous stage as long as in
-            # forward it is a received input, regardless of whether it requires
-            # grad. It is up to the previous stage to disgard this gradient.
-            if isinstance(a, RecvInfo):
+            # forward it is a received input requiring grad, which the
+            # previous stage expects a gradient for.
+            if isinstance(a, RecvInfo) and a.requires_grad:
                 grad_send_info.append(a.source)
                 return a.source
             else:
@@ -200,6 +530,10 @@ class PipelineStageBase(ABC):
         logger.debug(f"{self.log_prefix} " f"Grad send info: {grad_send_info}")
         return grad_send_info
 
+    @abstractmethod
+    def _create_act_recv_info(self) -> Tuple[InputInfo, ...]:
+        raise NotImplementedError
+
     @abstractmethod
     def _create_grad_recv_info(
         self,
@@ -207,97 +541,563 @@ class PipelineStageBase(ABC):
     ) -> Tuple[RecvInfo, ...]:
         raise NotImplementedError
 
+    def _set_num_microbatches(
+        self,
+        num_microbatches: int,
+        num_recv_slots: int,
+    ) -> None:
+        """
+        Prepare the stage to run `num_microbatches` microbatches, of which at
+        most `num_recv_slots` consecutive ones need their receive buffers at
+        the same time. The buffers of slots no longer used are freed. Must not
+        be called in the middle of a step.
+        """
+        self.chunks = num_microbatches
+        if num_recv_slots == self.num_recv_slots:
+            return
+        self.num_recv_slots = num_recv_slots
+        for slots in (
+            self.args_recv_info,
+            self.grad_recv_info,
+            self.set_requires_grad,
+            self._fwd_recv_ops,
+            self._bwd_recv_ops,
+            self._fwd_shape_headers,
+            self._recv_storage,
+        ):
+            for slot in [slot for slot in slots if slot >= num_recv_slots]:
+                del slots[slot]
+
+    def _get_args_recv_info(self, chunk_id: int) -> Tuple[InputInfo, ...]:
+        """
+        Returns the recv infos for the inputs of chunk `chunk_id`, from the
+        slot of the chunk.
+        """
+        slot = chunk_id % self.num_recv_slots
+        if slot not in self.args_recv_info:
+            self.args_recv_info[slot] = self._create_act_recv_info()
+        return self.args_recv_info[slot]
+
+    def _get_grad_recv_info(self, chunk_id: int) -> Tuple[RecvInfo, ...]:
+        """
+        Returns the recv infos for the output gradients of chunk `chunk_id`,
+        from the slot of the chunk.
+        """
+        slot = chunk_id % self.num_recv_slots
+        if slot not in self.grad_recv_info:
+            # `grad_recv_info` is a mirror of `act_send_info`
+            self.grad_recv_info[slot] = self._create_grad_recv_info(
+                self.act_send_info
+            )
+        return self.grad_recv_info[slot]
+
+    def _uses_transport(self, peer: int) -> bool:
+        """
+        Whether the tensors exchanged with global rank `peer` go through the
+        shared memory transport.
+        """
+        return self.transport is not None and self.transport.handles(peer)
+
+    def _p2p_peers(self) -> List[int]:
+        """
+        The stages this stage exchanges tensors with, in forward or backward.
+        """
+        peers: Set[int] = set()
+        for dsts in list(self.act_send_info.values()) + list(
+            self.act_relay_info.values()
+        ):
+            peers.update(dst for dst in dsts if dst is not None)
+        for info in self._get_args_recv_info(0):
+            if isinstance(info, RecvInfo):
+                peers.add(info.source)
+        return sorted(peers)
+
+    def init_p2p_neighbors(self) -> Dict[int, float]:
+        """
+        Set up the communicators with all the ranks this stage exchanges
+        tensors with (see `warmup_p2p`). Only for ranks running one stage:
+        otherwise, call `warmup_p2p` with all the stages of the rank.
+
+        If this is used, must be called for all pipeline stages.
+        """
+        return warmup_p2p([self])
+
+    def _p2p_op(
+        self,
+        op,
+        tensor: torch.Tensor,
+        stage: int,
+        k: int = 0,
+    ) -> Union[dist.P2POp, SharedMemoryP2POp]:
+        """
+        Create a P2P op for the `k`-th tensor exchanged with stage `stage`,
+        through the shared memory transport if it handles the peer, or
+        within the process if the stage is on this rank.
+        """
+        peer = self.stage_index_to_global_rank[stage]
+        if op is dist.isend:
+            tag = _p2p_tag(self.stage_index, stage, k, self.num_stages)
+        else:
+            tag = _p2p_tag(stage, self.stage_index, k, self.num_stages)
+        if peer == self.stage_index_to_global_rank[self.stage_index]:
+            return LoopbackP2POp(op, tensor, peer, self.group, tag)  # type: ignore[return-value]
+        if self._uses_transport(peer):
+            return SharedMemoryP2POp(op, tensor, peer, self.transport, tag)  # type: ignore[arg-type]
+        return dist.P2POp(op, tensor, peer, self.group, tag)
+
+    def _create_flat_recv_buffers(
+        self,
+        recv_infos: Tuple[InputInfo, ...],
+    ) -> Dict[int, torch.Tensor]:
+        """
+        Replace the buffers (or wire buffers) of `recv_infos` by views into one
+        flat buffer per source stage, laid out in the order the source sends
+        the tensors. Returns the flat buffers.
+        """
+        infos_by_source: Dict[int, List[RecvInfo]] = defaultdict(list)
+        for info in _sorted_recv_infos(recv_infos):
+            infos_by_source[info.source].append(info)
+
+        flat_buffers: Dict[int, torch.Tensor] = {}
+        for source, infos in infos_by_source.items():
+            buffers = [t for info in infos for t in _recv_tensors(info)]
+            offsets, size = _flat_layout(buffers)
+            peer = self.stage_index_to_global_rank[source]
+            if self._uses_transport(peer):
+                flat = self.transport.empty(  # type: ignore[union-attr]
+                    torch.Size([size]), torch.uint8, peer
+                )
+            else:
+                flat = torch.empty(size, dtype=torch.uint8, device=self.device)
+            views = iter(_flat_views(flat, buffers, offsets))
+            for info in infos:
+                if info.wire_buffers is None:
+                    info.buffer = next(views)
+                else:
+                    info.wire_buffers = [next(views) for _ in info.wire_buffers]
+            flat_buffers[source] = flat
+        return flat_buffers
+
     def _get_recv_ops(
         self,
-        recv_infos: Tuple[InputInfo],
+        recv_infos: Tuple[InputInfo, ...],
+        codec: Optional[Codec] = None,
     ) -> List[dist.P2POp]:
         """
         Helper function shared by `get_fwd_recv_ops` and `get_bwd_recv_ops`.
-        Returns a list of ops that correspond to the recv infos.
+        Returns a list of ops that correspond to the recv infos. With a
+        `codec`, the ops receive into wire buffers, decoded into the buffers
+        by `_decode_recv_buffers`. With `flat_p2p`, there is one op per source
+        stage, receiving into a flat buffer backing the tensors to receive.
         """
+        if codec is not None:
+            for info in recv_infos:
+                if isinstance(info, RecvInfo):
+                    info.wire_buffers = codec.wire_buffers(info.buffer)
+
+        if self.flat_p2p:
+            return [
+                self._p2p_op(dist.irecv, flat, source)
+                for source, flat in self._create_flat_recv_buffers(
+                    recv_infos
+                ).items()
+            ]
+
         ops: List[dist.P2POp] = []
+        # Number of tensors received from each source stage so far
+        num_received: Dict[int, int] = defaultdict(int)
+        for info in _sorted_recv_infos(recv_infos):
+            peer = self.stage_index_to_global_rank[info.source]
+            if self._uses_transport(peer):
+                # Receive into shared memory, in place of the buffers
+                if info.wire_buffers is None:
+                    info.buffer = self.transport.empty(  # type: ignore[union-attr]
+                        info.buffer.size(), info.buffer.dtype, peer
+                    )
+                else:
+                    info.wire_buffers = [
+                        self.transport.empty(t.size(), t.dtype, peer)  # type: ignore[union-attr]
+                        for t in info.wire_buffers
+                    ]
+            for tensor in _recv_tensors(info):
+                k = num_received[info.source]
+                num_received[info.source] += 1
+                ops.append(self._p2p_op(dist.irecv, tensor, info.source, k))
+
+        return ops
+
+    def _decode_recv_buffers(
+        self,
+        recv_infos: Tuple[InputInfo, ...],
+        codec: Optional[Codec],
+    ) -> None:
+        """
+        Decode the wire buffers received for `recv_infos` into their buffers.
+        """
+        if codec is None:
+            return
+        with torch.no_grad():
+            for info in recv_infos:
+                if isinstance(info, RecvInfo):
+                    assert info.wire_buffers is not None
+                    codec.decode(info.wire_buffers, info.buffer)
+
+    def _send_order(self, idx: int, is_grad: bool) -> int:
+        """
+        Sort key of the `idx`-th tensor sent in forward (see
+        `_get_fwd_send_tensors`), or of the gradient of the `idx`-th input,
+        among the tensors sent to the same stage. The receiving stage posts
+        its receives in the same order, see `RecvInfo.order`. By default, the
+        order of the indices.
+        """
+        return idx
+
+    def _create_send_plan(
+        self,
+        dst_stages: List[List[int]],
+        is_grad: bool,
+    ) -> List[Tuple[int, List[int]]]:
+        """
+        Helper function shared by `get_fwd_send_ops` and `get_bwd_send_ops`.
+        Given the destination stages of each tensor to send, returns the
+        messages to send, as (destination stage, indices of the tensors in the
+        message). The tensors to the same stage are sent in `_send_order`.
+        With `flat_p2p`, they are packed, in order, into one message.
+        """
+        indices_by_dst: Dict[int, List[int]] = defaultdict(list)
+        for idx, dsts in enumerate(dst_stages):
+            for dst in dsts:
+                indices_by_dst[dst].append(idx)
+        for indices in indices_by_dst.values():
+            indices.sort(key=lambda idx: self._send_order(idx, is_grad))
+
+        if not self.flat_p2p:
+            return [
+                (dst, [idx])
+                for dst, indices in indices_by_dst.items()
+                for idx in indices
+            ]
+        return list(indices_by_dst.items())
+
+    def _get_send_ops(
+        self,
+        tensors: Sequence[torch.Tensor],
+        send_plan: List[Tuple[int, List[int]]],
+        codec: Optional[Codec] = None,
+        is_grad: bool = False,
+        relayed: Optional[Dict[int, List[torch.Tensor]]] = None,
+    ) -> List[dist.P2POp]:
+        """
+        Returns the ops sending `tensors` as planned by `_create_send_plan`.
+        With a `codec`, each tensor is sent as the wire tensors it is encoded
+        into. The tensors in `relayed` are sent as the given wire tensors, as
+        they were received.
+        """
+        wire: Dict[int, List[torch.Tensor]] = dict(relayed or {})
+        for _, indices in send_plan:
+            for idx in indices:
+                if idx in wire:
+                    continue
+                if codec is None:
+                    wire[idx] = [tensors[idx]]
+                else:
+                    # Encode each tensor once, even if sent to several stages
+                    wire[idx] = codec.encode(
+                        tensors[idx], (self.stage_index, is_grad, idx)
+                    )
+
+        if not self.flat_p2p:
+            ops: List[dist.P2POp] = []
+            # Number of tensors sent to each destination stage so far
+            num_sent: Dict[int, int] = defaultdict(int)
+            for dst, indices in send_plan:
+                for idx in indices:
+                    for tensor in wire[idx]:
+                        ops.append(
+                            self._p2p_op(dist.isend, tensor, dst, num_sent[dst])
+                        )
+                        num_sent[dst] += 1
+            return ops
+        return [
+            self._p2p_op(
+                dist.isend,
+                _pack_flat([t for idx in indices for t in wire[idx]]),
+                dst,
+            )
+            for dst, indices in send_plan
+        ]
+
+    def _clear_comm_plan(self) -> None:
+        """
+        Drop the cached P2P ops and send plans, to be rebuilt on next use. Must
+        be called if the recv infos or send infos of the stage are replaced.
+        """
+        self._fwd_recv_ops.clear()
+        self._bwd_recv_ops.clear()
+        self._fwd_send_plan = None
+        self._bwd_send_plan = None
+        self._fwd_shape_headers.clear()
+
+    def _get_shape_header_recv_ops(
+        self,
+        slot: int,
+        recv_infos: Tuple[InputInfo, ...],
+    ) -> List[dist.P2POp]:
+        """
+        With dynamic shapes, create the shape headers of slot `slot`, one per
+        source stage holding the dimensions of the tensors it sends, and
+        return the ops receiving them.
+        """
+        ndims_by_source: Dict[int, int] = defaultdict(int)
         for info in recv_infos:
-            if not isinstance(info, RecvInfo):
-                continue
+            if isinstance(info, RecvInfo):
+                ndims_by_source[info.source] += info.buffer.dim()
+        headers = {
+            source: torch.empty(ndims, dtype=torch.int64, device=self.device)
+            for source, ndims in ndims_by_source.items()
+        }
+        self._fwd_shape_headers[slot] = headers
+        return [
+            self._p2p_op(dist.irecv, header, source, -1)
+            for source, header in headers.items()
+        ]
 
-            peer_rank = self.stage_index_to_group_rank[info.source]
-            peer_global_rank = (
-                peer_rank
-                if self.group is None
-                else dist.get_global_rank(self.group, peer_rank)
-            )  # TODO
-            ops.append(
-                dist.P2POp(
-                    dist.irecv, info.buffer, peer_global_rank, self.group
-                )
+    def _get_shape_header_send_ops(
+        self,
+        tensors: Sequence[torch.Tensor],
+    ) -> List[dist.P2POp]:
+        """
+        With dynamic shapes, returns the ops sending to each destination stage
+        the dimensions of the tensors sent to it in forward, in order.
+        """
+        assert self._fwd_send_plan is not None
+        dims_by_dst: Dict[int, List[int]] = defaultdict(list)
+        for dst, indices in self._fwd_send_plan:
+            for idx in indices:
+                dims_by_dst[dst].extend(tensors[idx].shape)
+        return [
+            self._p2p_op(
+                dist.isend,
+                torch.tensor(dims, dtype=torch.int64, device=self.device),
+                dst,
+                -1,
             )
+            for dst, dims in dims_by_dst.items()
+        ]
 
-        return ops
+    def _resize_recv_buffers(
+        self,
+        chunk_id: int,
+        recv_infos: List[RecvInfo],
+        shapes: List[Sequence[int]],
+        is_grad: bool,
+    ) -> None:
+        """
+        With dynamic shapes, replace the buffers of `recv_infos` by views of
+        `shapes` into the storage of their size bucket, in the slot of chunk
+        `chunk_id`. Storages are allocated on first use of a bucket.
+        """
+        storage = self._recv_storage.setdefault(
+            chunk_id % self.num_recv_slots, {}
+        )
+        for idx, (info, shape) in enumerate(zip(recv_infos, shapes)):
+            numel = math.prod(shape)
+            key = (is_grad, idx, _bucket_numel(numel))
+            if key not in storage:
+                storage[key] = torch.empty(
+                    key[2], dtype=info.buffer.dtype, device=self.device
+                )
+            info.buffer = storage[key][:numel].view(shape)
 
-    def get_fwd_recv_ops(self) -> List[dist.P2POp]:
+    def get_fwd_recv_ops(
+        self, fwd_chunk_id: Optional[int] = None
+    ) -> List[dist.P2POp]:
         """
         Returns a list of ops that are needed to receive the input arguments
-        for this stage.
+        for this stage. By default for the current forward chunk; a later
+        chunk can be given to post its receive ahead of time, as every chunk
+        has its own receive buffers.
         """
-        recv_infos: Tuple[InputInfo] = self.args_recv_info[self.fwd_chunk_id]
+        if fwd_chunk_id is None:
+            fwd_chunk_id = self.fwd_chunk_id
+        slot = fwd_chunk_id % self.num_recv_slots
+        recv_infos = self._get_args_recv_info(fwd_chunk_id)
+        ops = self._fwd_recv_ops.get(slot)
+        if ops is None:
+            # First use of this slot's buffers, build its ops
+            if self.dynamic_shapes:
+                ops = self._get_shape_header_recv_ops(slot, recv_infos)
+            else:
+                ops = self._get_recv_ops(recv_infos, self.act_codec)
+            self._fwd_recv_ops[slot] = ops
+        if self.dynamic_shapes:
+            # Only the shape headers, see `get_fwd_recv_data_ops`
+            return ops
 
         # In case there is backward pass, set requires_grad for receive buffers
         # before first forward
-        if self.has_backward and not self.set_requires_grad[self.fwd_chunk_id]:
+        if self.has_backward and not self.set_requires_grad.get(slot, False):
             for a in recv_infos:
-                if isinstance(a, RecvInfo):
+                if isinstance(a, RecvInfo) and a.requires_grad:
                     a.buffer.requires_grad_(True)
+            self.set_requires_grad[slot] = True
+        elif fwd_chunk_id >= self.num_recv_slots:
+            # The buffers are reused from an earlier chunk of this step, whose
+            # input gradients must not be accumulated into
+            for a in recv_infos:
+                if isinstance(a, RecvInfo):
+                    a.buffer.grad = None
 
-        return self._get_recv_ops(recv_infos)
+        return ops
+
+    def get_fwd_recv_data_ops(
+        self, fwd_chunk_id: Optional[int] = None
+    ) -> List[dist.P2POp]:
+        """
+        With dynamic shapes, returns the ops receiving the input arguments of a
+        chunk, to be issued once the shape headers received by the ops of
+        `get_fwd_recv_ops` have arrived. The receive buffers are resized to
+        the shapes in the headers. Without dynamic shapes, the input arguments
+        are received by the ops of `get_fwd_recv_ops` and this returns nothing.
+        """
+        if not self.dynamic_shapes or self.is_first:
+            return []
 
-    def get_bwd_recv_ops(self) -> List[dist.P2POp]:
+        if fwd_chunk_id is None:
+            fwd_chunk_id = self.fwd_chunk_id
+        slot = fwd_chunk_id % self.num_recv_slots
+        recv_infos = _sorted_recv_infos(self._get_args_recv_info(fwd_chunk_id))
+        dims_by_source = {
+            source: header.tolist()
+            for source, header in self._fwd_shape_headers[slot].items()
+        }
+        shapes: List[Sequence[int]] = []
+        for info in recv_infos:
+            dims = dims_by_source[info.source]
+            ndim = info.buffer.dim()
+            shapes.append(dims[:ndim])
+            dims_by_source[info.source] = dims[ndim:]
+        self._resize_recv_buffers(fwd_chunk_id, recv_infos, shapes, False)
+
+        if self.has_backward:
+            for info in recv_infos:
+                if info.requires_grad:
+                    info.buffer.requires_grad_(True)
+        return self._get_recv_ops(tuple(recv_infos))
+
+    def get_bwd_recv_ops(
+        self, bwd_chunk_id: Optional[int] = None
+    ) -> List[dist.P2POp]:
         """
         Returns a list of ops that are needed to receive the gradients
-        for this stage.
+        for this stage. By default for the current backward chunk; a later
+        chunk can be given to post its receive ahead of time.
         """
         if not self.has_backward or self.is_last:
             return []
 
-        # Create bwd recv infra lazily
-        recv_infos = self.grad_recv_info.setdefault(
-            self.bwd_chunk_id,
-            # `grad_recv_info` is a mirror of `act_send_info`
-            self._create_grad_recv_info(self.act_send_info),
-        )
+        if bwd_chunk_id is None:
+            bwd_chunk_id = self.bwd_chunk_id
+        if self.dynamic_shapes:
+            # The gradients have the shapes of the outputs of the chunk
+            recv_infos = self._get_grad_recv_info(bwd_chunk_id)
+            sent_shapes = self._fwd_send_shapes[bwd_chunk_id]
+            self._resize_recv_buffers(
+                bwd_chunk_id,
+                list(recv_infos),
+                [sent_shapes[idx] for idx in self._get_grad_recv_index()],
+                True,
+            )
+            return self._get_recv_ops(recv_infos)
+
+        slot = bwd_chunk_id % self.num_recv_slots
+        ops = self._bwd_recv_ops.get(slot)
+        if ops is None:
+            # Create bwd recv infra lazily
+            ops = self._get_recv_ops(
+                self._get_grad_recv_info(bwd_chunk_id), self.grad_codec
+            )
+            self._bwd_recv_ops[slot] = ops
+
+        return ops
 
-        return self._get_recv_ops(recv_infos)
+    def _get_fwd_send_tensors(
+        self,
+        output_tuple: Tuple[torch.Tensor, ...],
+        chunk_id: int,
+    ) -> List[torch.Tensor]:
+        """
+        The tensors sent in forward for chunk `chunk_id`, of outputs
+        `output_tuple`: the outputs, then the relayed inputs, by input index
+        (see `act_relay_info`).
+        """
+        if not self.act_relay_info:
+            return list(output_tuple)
+        recv_infos = self._get_args_recv_info(chunk_id)
+        return list(output_tuple) + [
+            recv_infos[idx].buffer  # type: ignore[union-attr]
+            for idx in sorted(self.act_relay_info)
+        ]
+
+    def _get_grad_recv_index(self) -> List[int]:
+        """
+        Index of the tensor sent in forward that each gradient recv info is
+        the gradient of (see `grad_recv_index`).
+        """
+        if self.grad_recv_index is not None:
+            return self.grad_recv_index
+        return [idx for idx, dsts in self.act_send_info.items() if dsts]
 
     def get_fwd_send_ops(self) -> List[dist.P2POp]:
         """
         Get the activation send ops for current stage's forward.
         """
-        # Use "-1" to get the outputs created by the last chunk
-        output = self.output_chunks[-1]
-        # Unify output form to tuple for easy correspondance with
-        # `act_send_info`
-        output_tuple = output if type(output) is tuple else (output,)
-
-        ops: List[dist.P2POp] = []
+        if self.is_last:
+            return []
 
-        for idx, out in enumerate(output_tuple):
-            dst_stages = self.act_send_info[idx]
-            for dst in dst_stages:
-                if dst is None:
-                    continue
-                logger.debug(
-                    f"{self.log_prefix} "
-                    f"Sending tensor to Stage {dst}: {out.size()}"
-                )
-                peer_rank = self.stage_index_to_group_rank[dst]
-                peer_global_rank = (
-                    peer_rank
-                    if self.group is None
-                    else dist.get_global_rank(self.group, peer_rank)
-                )  # TODO
-                ops.append(
-                    dist.P2POp(dist.isend, out, peer_global_rank, self.group)
-                )
+        if self._fwd_send_plan is None:
+            self._fwd_send_plan = self._create_send_plan(
+                [
+                    [dst for dst in self.act_send_info[idx] if dst is not None]
+                    for idx in range(len(self.act_send_info))
+                ]
+                + [
+                    self.act_relay_info[idx]
+                    for idx in sorted(self.act_relay_info)
+                ],
+                False,
+            )
+            logger.debug(
+                f"{self.log_prefix} "
+                f"Activation send plan: {self._fwd_send_plan}"
+            )
 
+        # The outputs created by the last chunk
+        chunk_id = self.fwd_chunk_id - 1
+        if chunk_id not in self.fwd_send_outputs:
+            raise RuntimeError(
+                f"{self.log_prefix} The outputs of chunk {chunk_id} are not available to send, they have been sent already"
+            )
+        output_tuple = self.fwd_send_outputs[chunk_id]
+        tensors = self._get_fwd_send_tensors(output_tuple, chunk_id)
+
+        # Relayed inputs are sent as received, without encoding them again
+        relayed: Dict[int, List[torch.Tensor]] = {}
+        for i, idx in enumerate(sorted(self.act_relay_info)):
+            info = self._get_args_recv_info(chunk_id)[idx]
+            wire = _recv_tensors(info)  # type: ignore[arg-type]
+            if not self.has_backward:
+                # Without backward, the receive buffers can be reused by a
+                # later chunk before the send completes
+                wire = [t.detach().clone() for t in wire]
+            relayed[len(output_tuple) + i] = wire
+
+        ops = self._get_send_ops(
+            tensors, self._fwd_send_plan, self.act_codec, relayed=relayed
+        )
+        if self.dynamic_shapes:
+            # Each shape header goes ahead of the tensors it describes
+            ops = self._get_shape_header_send_ops(tensors) + ops
         return ops
 
     def get_bwd_send_ops(self) -> List[dist.P2POp]:
@@ -314,31 +1114,67 @@ class PipelineStageBase(ABC):
             # Can be None if an input has no grad
             # `grad_send_info` is a mirror of `args_recv_info`
             self.grad_send_info = self._create_grad_send_info(
-                self.args_recv_info[0]
+                self._get_args_recv_info(0)
+            )
+        if self._bwd_send_plan is None:
+            self._bwd_send_plan = self._create_send_plan(
+                [
+                    [] if grad_recv_stage is None else [grad_recv_stage]
+                    for grad_recv_stage in self.grad_send_info
+                ],
+                True,
+            )
+            logger.debug(
+                f"{self.log_prefix} "
+                f"Gradient send plan: {self._bwd_send_plan}"
             )
 
-        ops: List[dist.P2POp] = []
-        for grad, grad_recv_stage in zip(self.grads_input, self.grad_send_info):
-            if isinstance(grad, torch.Tensor) and grad_recv_stage is not None:
-                logger.debug(
-                    f"{self.log_prefix} "
-                    f"Sending gradient to Stage {grad_recv_stage}: {grad.size()}"
-                )
-                peer_rank = self.stage_index_to_group_rank[grad_recv_stage]
-                peer_global_rank = (
-                    peer_rank
-                    if self.group is None
-                    else dist.get_global_rank(self.group, peer_rank)
-                )  # TODO
-                ops.append(
-                    dist.P2POp(dist.isend, grad, peer_global_rank, self.group)
-                )
-            else:
-                if not (grad is None and grad_recv_stage is None):
+        for _, indices in self._bwd_send_plan:
+            for idx in indices:
+                if not isinstance(self.grads_input[idx], torch.Tensor):
                     raise RuntimeError(
-                        f"[{self.stage_index}] for chunk {self.bwd_chunk_id - 1} has gradients {grad} and is expecting to send gradients to stage {grad_recv_stage}"
+                        f"[{self.stage_index}] for chunk {self.bwd_chunk_id - 1} has gradients {self.grads_input[idx]} and is expecting to send gradients to stage {self.grad_send_info[idx]}"
                     )
-        return ops
+        return self._get_send_ops(
+            self.grads_input, self._bwd_send_plan, self.grad_codec, True
+        )
+
+    def release_fwd_outputs(self, chunk_id: int) -> None:
+        """
+        Drop the reference to the outputs of chunk `chunk_id` kept for its
+        forward sends, once they are complete. The outputs are only retained
+        further by autograd, for backward.
+        """
+        self.fwd_send_outputs.pop(chunk_id, None)
+
+    def retained_bytes(self) -> int:
+        """
+        Bytes of the tensors held by the run time states of the stage for the
+        microbatches of the current step: the inputs and outputs kept for
+        backward, outputs not sent yet and, on the last stage, outputs to
+        merge. Tensors referenced only by autograd (e.g. saved for backward)
+        are not counted.
+        """
+        seen: Dict[int, int] = {}
+
+        def count(a):
+            if isinstance(a, torch.Tensor):
+                seen[id(a)] = a.numel() * a.element_size()
+            return a
+
+        map_aggregate(
+            (
+                list(self.fwd_cache.values()),
+                list(self.fwd_send_outputs.values()),
+                self.output_chunks,
+                self.output_merger.values
+                if self.output_merger is not None
+                else [],
+                [args for args, _, _ in self.recompute_cache.values()],
+            ),
+            count,
+        )
+        return sum(seen.values())
 
     def clear_runtime_states(self) -> None:
         """
@@ -347,10 +1183,19 @@ class PipelineStageBase(ABC):
         # Reset pointers
         self.fwd_chunk_id = 0
         self.bwd_chunk_id = 0
+        self.bwd_weight_chunk_id = 0
         # map microbatch ID to list of forward tensor args
         self.fwd_cache.clear()
+        self.bwd_weight_cache.clear()
+        self.recompute_cache.clear()
+        if self.offloader is not None:
+            self.offloader.clear()
         # Caching chunk outputs for final output merge or reduction
         self.output_chunks.clear()
+        self.output_merger = None
+        self.fwd_send_outputs.clear()
+        self._fwd_send_shapes.clear()
+        self.peak_retained_bytes = 0
 
         # Clear grad of input buffers in between schedule steps. This is because
         # `torch.autograd.backward()` will accumulate gradients into leaf
@@ -367,7 +1212,7 @@ class PipelineStageBase(ABC):
 
     def _map_tensor_from_recv_info(
         self,
-        recv_infos: Tuple[InputInfo],
+        recv_infos: Tuple[InputInfo, ...],
     ):
         """
         Map tensors from recv infos to a list.
@@ -392,19 +1237,39 @@ class PipelineStageBase(ABC):
         """
         Retrieve the activations received for the current stage during forward.
         """
-        recv_infos = self.args_recv_info[self.fwd_chunk_id]
+        recv_infos = self._get_args_recv_info(self.fwd_chunk_id)
+        self._decode_recv_buffers(recv_infos, self.act_codec)
         activations = self._map_tensor_from_recv_info(recv_infos)
         return activations
 
     def _retrieve_recv_grads(
         self,
-    ):
+    ) -> Tuple[Tuple[Optional[torch.Tensor], ...], Dict[int, torch.Tensor]]:
         """
         Retrieve the gradients received for the current stage during backward.
+        The gradients of a tensor sent to several stages are summed. Returns
+        the gradients of the outputs with destinations, and of the relayed
+        inputs by input index.
         """
-        recv_infos = self.grad_recv_info[self.bwd_chunk_id]
-        grads = self._map_tensor_from_recv_info(recv_infos)
-        return grads
+        recv_infos = self._get_grad_recv_info(self.bwd_chunk_id)
+        self._decode_recv_buffers(recv_infos, self.grad_codec)
+        grads: Dict[int, torch.Tensor] = {}
+        for idx, info in zip(self._get_grad_recv_index(), recv_infos):
+            grads[idx] = (
+                info.buffer if idx not in grads else grads[idx] + info.buffer
+            )
+
+        num_outputs = len(self.act_send_info)
+        # Outputs not requiring gradient get none back
+        output_grads = tuple(
+            grads.get(idx) for idx, dsts in self.act_send_info.items() if dsts
+        )
+        relay_grads = {
+            idx: grads[num_outputs + i]
+            for i, idx in enumerate(sorted(self.act_relay_info))
+            if num_outputs + i in grads
+        }
+        return output_grads, relay_grads
 
     def _configure_data_parallel_mode(self, last_backward: bool):
         """
@@ -470,10 +1335,32 @@ class PipelineStageBase(ABC):
             composite_kwargs = {}
 
         # Compute forward
+        recompute = (
+            self.recompute is True and self.has_backward and not self.is_last
+        )
         try:
-            output = self.forward_maybe_with_nosync(
-                *composite_args, **composite_kwargs
-            )
+            if recompute:
+                # Only keep what is needed to run this forward again
+                self.recompute_cache[self.fwd_chunk_id] = (
+                    composite_args,
+                    composite_kwargs,
+                    _get_rng_state(self.device),
+                )
+                with torch.no_grad():
+                    output = self.forward_maybe_with_nosync(
+                        *composite_args, **composite_kwargs
+                    )
+            elif self.offloader is not None and self.has_backward:
+                with self.offloader.save(self.fwd_chunk_id):
+                    output = self.forward_maybe_with_nosync(
+                        *composite_args, **composite_kwargs
+                    )
+                # Keep the saved tensors out of device memory until backward
+                self.offloader.offload(self.fwd_chunk_id)
+            else:
+                output = self.forward_maybe_with_nosync(
+                    *composite_args, **composite_kwargs
+                )
 
         except Exception as e:
             exc_msg = f"""
@@ -491,16 +1378,46 @@ class PipelineStageBase(ABC):
         # Unify output form to tuple for easy correspondance with
         # `act_send_info`
         output_tuple = output if type(output) is tuple else (output,)
-        # Prepare for final output merge or reduction
-        self.output_chunks.append(output)
-
-        # Save activations and inputs for backward
-        flat_args = flatten_args(composite_args)
-        flat_kwargs = flatten_args(composite_kwargs)
-        flatten_input_tensors = flat_args + flat_kwargs
-        self.fwd_cache[self.fwd_chunk_id] = (
-            output_tuple,  # stage_output
-            flatten_input_tensors,  # input_values
+        if self.is_last:
+            if self.output_merger is not None:
+                # Written into its slice of the full batch right away
+                self.output_merger.add(output)
+            elif self.keep_outputs:
+                # Prepare for final output merge or reduction
+                self.output_chunks.append(output)
+        else:
+            # Until sent (see `get_fwd_send_ops`)
+            self.fwd_send_outputs[self.fwd_chunk_id] = output_tuple
+            if self.dynamic_shapes and self.has_backward:
+                self._fwd_send_shapes[self.fwd_chunk_id] = [
+                    t.shape
+                    for t in self._get_fwd_send_tensors(
+                        output_tuple, self.fwd_chunk_id
+                    )
+                ]
+
+        if self.has_backward:
+            # Save the autograd roots and the inputs to compute gradients
+            # for, keeping the positions of the others as None. The last
+            # stage goes back from the loss, and a recomputed forward gives
+            # its own outputs.
+            def if_requires_grad(a):
+                if isinstance(a, torch.Tensor) and a.requires_grad:
+                    return a
+                return None
+
+            flat_args = flatten_args(composite_args)
+            flat_kwargs = flatten_args(composite_kwargs)
+            self.fwd_cache[self.fwd_chunk_id] = (
+                None  # stage_output
+                if self.is_last or recompute
+                else map_aggregate(output_tuple, if_requires_grad),
+                [
+                    if_requires_grad(a) for a in flat_args + flat_kwargs
+                ],  # input_values
+            )
+        self.peak_retained_bytes = max(
+            self.peak_retained_bytes, self.retained_bytes()
         )
 
         logger.debug(
@@ -509,20 +1426,56 @@ class PipelineStageBase(ABC):
         self.fwd_chunk_id += 1
         return output
 
+    def prefetch_activations(self, chunk_id: int) -> None:
+        """
+        With `offload`, start moving the activations saved by the forward of
+        chunk `chunk_id` back to device memory, ahead of its backward.
+        """
+        if self.offloader is not None:
+            self.offloader.prefetch(chunk_id)
+
+    def _recompute_forward(self, chunk_id: int) -> Tuple[Any, ...]:
+        """
+        Run the forward of chunk `chunk_id` again, with the inputs and RNG
+        state saved by `forward_one_chunk`, to get its autograd graph.
+        Returns the outputs as a tuple.
+        """
+        args, kwargs, rng_state = self.recompute_cache.pop(chunk_id)
+        devices = [self.device] if self.device.type == "cuda" else []
+        # Replay the RNG state of the forward (e.g. for dropout), without
+        # disturbing the RNG of the chunks that follow
+        with torch.random.fork_rng(devices=devices):
+            _set_rng_state(self.device, rng_state)
+            output = self.forward_maybe_with_nosync(*args, **kwargs)
+        if type(output) is list:
+            output = tuple(output)
+        return output if type(output) is tuple else (output,)
+
     def backward_one_chunk(
         self,
         loss=None,
+        full_backward: bool = True,
     ):
         """
         Perform backward pass on the module.
         This should only be called once per microbatch.
+
+        If `full_backward` is False, only the gradients for the stage inputs
+        are computed, so that they can be sent to the previous stage without
+        waiting for the weight gradients. The weight gradients must then be
+        computed by a later call to `backward_weight_one_chunk`.
         """
         (
             stage_output,
             input_values,
         ) = self.fwd_cache.pop(self.bwd_chunk_id)
+        self._fwd_send_shapes.pop(self.bwd_chunk_id, None)
+        if self.bwd_chunk_id in self.recompute_cache:
+            stage_output = self._recompute_forward(self.bwd_chunk_id)
+        self.prefetch_activations(self.bwd_chunk_id)
 
         # Compute backward
+        relay_grads: Dict[int, torch.Tensor] = {}
         if self.is_last:
             # Last stage computes gradients from loss and has no gradients from
             # next stage
@@ -533,7 +1486,7 @@ class PipelineStageBase(ABC):
             }
         else:
             # Otherwise, receive gradients from next stage
-            grads_output = self._retrieve_recv_grads()
+            grads_output, relay_grads = self._retrieve_recv_grads()
             # If an input to the pipeline requires gradient,
             # `torch.autograd.backward` will accumulate the gradient into the
             # `.grad` field of such input
@@ -543,12 +1496,59 @@ class PipelineStageBase(ABC):
                 "input_values": input_values,
             }
 
-        self.grads_input = self.backward_maybe_with_nosync(
-            bwd_kwargs, self.bwd_chunk_id
-        )
+        if full_backward:
+            self.grads_input = self.backward_maybe_with_nosync(
+                bwd_kwargs, self.bwd_chunk_id
+            )
+        else:
+            if isinstance(self.submod, DistributedDataParallel):
+                # DDP reduces gradients from hooks on gradient accumulation,
+                # which the weight gradient pass does not go through
+                raise NotImplementedError(
+                    "Split backward is not supported with DDP"
+                )
+            self.grads_input, param_groups = stage_backward_input(
+                **bwd_kwargs,
+                weights=[
+                    p
+                    for p in list(self.submod.parameters())
+                    + self.loss_parameters
+                    if p.requires_grad
+                ],
+            )
+            self.bwd_weight_cache[self.bwd_chunk_id] = (
+                bwd_kwargs,
+                param_groups,
+            )
+        if relay_grads:
+            # The stages an input was relayed to contribute to its gradient
+            self.grads_input = list(self.grads_input)
+            for idx, grad in relay_grads.items():
+                own_grad = self.grads_input[idx]
+                self.grads_input[idx] = (
+                    grad if own_grad is None else own_grad + grad
+                )
         logger.debug(f"{self.log_prefix} Backwarded chunk {self.bwd_chunk_id}")
         self.bwd_chunk_id += 1
 
+    def backward_weight_one_chunk(self):
+        """
+        Compute the weight gradients deferred by `backward_one_chunk` with
+        `full_backward=False`. Chunks are processed in backward order.
+        """
+        bwd_kwargs, param_groups = self.bwd_weight_cache.pop(
+            self.bwd_weight_chunk_id
+        )
+        if param_groups is None:
+            # No input gradient was needed, so the backward was not split
+            stage_backward(**bwd_kwargs)
+        else:
+            stage_backward_weight(param_groups)
+        logger.debug(
+            f"{self.log_prefix} Backwarded weights of chunk {self.bwd_weight_chunk_id}"
+        )
+        self.bwd_weight_chunk_id += 1
+
 
 class _PipelineStage(PipelineStageBase):
     def __init__(
@@ -558,10 +1558,31 @@ class _PipelineStage(PipelineStageBase):
         pipe_info: Pipe.PipeInfo,
         device: torch.device,
         group: Optional[dist.ProcessGroup] = None,
+        flat_p2p: bool = False,
+        recompute: Union[bool, Sequence[str]] = False,
+        offload: bool = False,
+        offload_dir: Optional[str] = None,
+        act_codec: Optional[Codec] = None,
+        grad_codec: Optional[Codec] = None,
+        transport: Optional[SharedMemoryTransport] = None,
+        multicast: bool = False,
+        warmup: bool = False,
+        placement: Optional[Sequence[int]] = None,
     ):
         """
         Create a pipeline stage given a stage_module to be wrapped by this stage
         and a `pipe_info` describing the stage relationship of the pipeline.
+
+        With `multicast`, a tensor consumed by several stages is not sent by
+        its producer to each of them: it is sent to the first consumer, which
+        relays it to the next one, and so on, so that each tensor crosses a
+        link once. In backward, each consumer adds the gradient from the next
+        one to its own before sending it back, so that the producer receives
+        the reduced gradient. All stages of the pipeline must use the same
+        setting.
+
+        With `warmup`, the communicators with the peers of the stage are set
+        up right away (see `init_p2p_neighbors`).
         """
         PipelineStageBase.__init__(
             self,
@@ -571,8 +1592,26 @@ class _PipelineStage(PipelineStageBase):
             device,
             pipe_info.num_chunks,
             group,
+            flat_p2p,
+            pipe_info.has_dynamic_shapes,
+            recompute,
+            offload,
+            offload_dir,
+            act_codec,
+            grad_codec,
+            transport,
+            placement,
         )
         self.pipe_info = pipe_info
+        self.multicast = multicast
+        # Position of each node in the pipe graph, which orders the tensors
+        # exchanged between two stages (see `_send_order`)
+        self._node_order: Dict[fx.Node, int] = {
+            node: i for i, node in enumerate(pipe_info.graph.nodes)
+        }
+        # Values of the pipe graph requiring gradient, the only ones whose
+        # gradients are sent back (`None` if unknown, meaning all of them)
+        self._grad_values = values_requiring_grad(pipe_info.graph)
 
         # Find stage nodes in graph
         submod_nodes = [
@@ -604,6 +1643,9 @@ class _PipelineStage(PipelineStageBase):
         # Move ops argument to device
         self._move_ops_to_device()
 
+        if warmup:
+            self.init_p2p_neighbors()
+
     def _move_submod_to_device(self):
         # Move submodule to indicated device if possible
         # Note: we cannot move meta module to real devices because meta tensors
@@ -631,14 +1673,12 @@ class _PipelineStage(PipelineStageBase):
         """
         Create send/recv infrastructures for activations (during forward)
         """
-        # Flag per chunk to keep track of whether we have set `requires_grad`
-        # for receive buffers. Format: {chunk : Boolean}
-        for chunk in range(self.chunks):
-            self.args_recv_info[chunk] = self._create_act_recv_info()
-            self.set_requires_grad[chunk] = False
+        # Receive infos are created lazily per slot, see `_get_args_recv_info`
 
         # Send info during forward for each activation
         self.act_send_info = self._create_act_send_info()
+        # Inputs to relay to the next stage consuming them
+        self.act_relay_info = self._create_act_relay_info()
 
     def get_stage_index_of_submod(
         self,
@@ -669,6 +1709,7 @@ class _PipelineStage(PipelineStageBase):
                 return RootArgPlaceholder()
 
             # Figure out the source stage of this input
+            value = arg_node
             while arg_node.target is operator.getitem:
                 # If the input is a getitem, we need to go deeper
                 arg_node = arg_node.args[0]
@@ -677,6 +1718,12 @@ class _PipelineStage(PipelineStageBase):
                 arg_node.op == "call_module"
             ), f"Expecting call_module, got {arg_node.op}"
             src_stage = self.get_stage_index_of_submod(arg_node.name)
+            if self.multicast:
+                # Relayed by the previous stage consuming it, if any
+                consumers = self._consumer_stages(value)
+                position = consumers.index(self.stage_index)
+                if position > 0:
+                    src_stage = consumers[position - 1]
 
             # Create a receive buffer for this placeholder
             example_value = placeholder.meta["val"]
@@ -691,6 +1738,8 @@ class _PipelineStage(PipelineStageBase):
                 arg_node.name,
                 src_stage,
                 buffer,
+                self._node_order[value],
+                self._requires_grad(value),
             )
 
         args_recv_info: List[InputInfo] = []
@@ -732,6 +1781,34 @@ class _PipelineStage(PipelineStageBase):
             #   should be re-calucated in case of activation checkpointing
             return None
 
+    def _requires_grad(self, value: fx.Node) -> bool:
+        """
+        Whether the value of node `value` of the pipe graph requires gradient.
+        """
+        return self._grad_values is None or value in self._grad_values
+
+    def _consumer_stages(self, value: fx.Node) -> List[int]:
+        """
+        The stages consuming the value of node `value` of the pipe graph, in
+        order.
+        """
+        return sorted(
+            dst
+            for dst in map(self.find_dst_rank, value.users)
+            if dst is not None
+        )
+
+    def _output_values(self) -> List[fx.Node]:
+        """
+        The nodes of the pipe graph holding the outputs of this stage, by
+        output index: the `getitem`s of the stage node for multiple outputs,
+        the stage node itself for a single output.
+        """
+        getitems = [
+            user for user in self.node.users if user.target is operator.getitem
+        ]
+        return getitems if getitems else [self.node]
+
     def _create_act_send_info(self):
         """
         Create a dict of send info for activations.
@@ -741,32 +1818,51 @@ class _PipelineStage(PipelineStageBase):
             ...
         }
         where the list of `dst_rank`s covers the case where an output value may
-        be consumed by multiple stages.
+        be consumed by multiple stages. With `multicast`, an output is only
+        sent to the first stage consuming it, which relays it.
         """
         # Output index: List of receiver ranks
         act_send_info: Dict[int, List] = {}
-        out_idx = 0
-
-        for user in self.node.users:
-            if user.target is operator.getitem:
-                # Recursively find the real destination
-                gi_dsts = act_send_info.setdefault(out_idx, [])
-                for gi_user in user.users:
-                    dst_rank = self.find_dst_rank(gi_user)
-                    if dst_rank is not None:
-                        gi_dsts.append(dst_rank)
-                # Next `getitem` will point to the next output index
-                out_idx += 1
-            else:
-                # In case of single output value, `out_idx` will not increase
-                dsts = act_send_info.setdefault(out_idx, [])
-                dst_rank = self.find_dst_rank(user)
-                if dst_rank is not None:
-                    dsts.append(dst_rank)
+        for out_idx, value in enumerate(self._output_values()):
+            dsts = self._consumer_stages(value)
+            act_send_info[out_idx] = dsts[:1] if self.multicast else dsts
 
         logger.debug(f"{self.log_prefix} " f"Send info: {act_send_info}")
         return act_send_info
 
+    def _create_act_relay_info(self) -> Dict[int, List[int]]:
+        """
+        With `multicast`, map the index of each input consumed by later stages
+        as well to the next of them, which this stage relays the input to.
+        """
+        act_relay_info: Dict[int, List[int]] = {}
+        if not self.multicast:
+            return act_relay_info
+        for idx, value in enumerate(self.node.args):
+            if not isinstance(value, fx.Node) or value.op == "placeholder":
+                continue
+            consumers = self._consumer_stages(value)
+            position = consumers.index(self.stage_index)
+            if position + 1 < len(consumers):
+                act_relay_info[idx] = [consumers[position + 1]]
+
+        logger.debug(f"{self.log_prefix} " f"Relay info: {act_relay_info}")
+        return act_relay_info
+
+    def _send_order(self, idx: int, is_grad: bool) -> int:
+        """
+        Tensors exchanged between two stages are sent in the order of their
+        values in the pipe graph, which both stages know.
+        """
+        if is_grad:
+            value = self.node.args[idx]
+        elif idx < len(self.act_send_info):
+            value = self._output_values()[idx]
+        else:
+            relayed = sorted(self.act_relay_info)
+            value = self.node.args[relayed[idx - len(self.act_send_info)]]
+        return self._node_order[value]  # type: ignore[index]
+
     def _create_grad_recv_info(
         self,
         act_send_info: Dict,
@@ -774,8 +1870,11 @@ class _PipelineStage(PipelineStageBase):
         """
         Create a tuple of `RecvInfo` for gradients.
         """
-        # Dict[output_index, RecvInfo]
-        grad_recv_info: Dict[int, RecvInfo] = {}
+        # One per tensor sent in forward and stage it was sent to. The
+        # gradients of a tensor sent to several stages are summed, see
+        # `_retrieve_recv_grads`.
+        grad_recv_info: List[RecvInfo] = []
+        grad_recv_index: List[int] = []
         output_nodes = [
             node for node in self.submod.graph.nodes if node.op == "output"
         ]
@@ -783,32 +1882,43 @@ class _PipelineStage(PipelineStageBase):
         output_node = output_nodes[0]
         # The output node may take multiple args, meaning the submod having multiple output values.
         output_vals = flatten_args(output_node.args)
+        output_values = self._output_values()
+        placeholders = [
+            node for node in self.submod.graph.nodes if node.op == "placeholder"
+        ]
 
-        for out_idx, dst_list in act_send_info.items():
-            if not dst_list:
-                # No actual receiver for activation so no grad coming back
+        # Outputs, then relayed inputs, as in `_get_fwd_send_tensors`
+        sent = [
+            (output_vals[out_idx], output_values[out_idx], dst_list)
+            for out_idx, dst_list in act_send_info.items()
+        ] + [
+            (placeholders[idx], self.node.args[idx], self.act_relay_info[idx])
+            for idx in sorted(self.act_relay_info)
+        ]
+        for sent_idx, (node, value, dst_list) in enumerate(sent):
+            # A tensor without receiver, or not requiring gradient, gets no
+            # gradient back
+            if not self._requires_grad(value):
                 continue
-
-            output = output_vals[out_idx]
-            example_value = output.meta["val"]
-            logger.debug(
-                f"{self.log_prefix} Creating grad recv buffer for output {output.name} "
-                f": {example_value.shape}, {example_value.dtype}"
-            )
-
-            # TODO: otherwise needs grad accumulation
-            assert (
-                len(dst_list) == 1
-            ), "Backward of skip connections not supported yet"
-            grad_src = dst_list[0]
-            grad_recv_info[out_idx] = RecvInfo(
-                f"{grad_src}",
-                grad_src,
-                _make_tensor_from_meta(example_value, self.device),
-            )
+            example_value = node.meta["val"]
+            for grad_src in dst_list:
+                logger.debug(
+                    f"{self.log_prefix} Creating grad recv buffer for {node.name} "
+                    f"from stage {grad_src}: {example_value.shape}, {example_value.dtype}"
+                )
+                grad_recv_info.append(
+                    RecvInfo(
+                        f"{grad_src}",
+                        grad_src,
+                        _make_tensor_from_meta(example_value, self.device),
+                        self._node_order[value],
+                    )
+                )
+                grad_recv_index.append(sent_idx)
+        self.grad_recv_index = grad_recv_index
 
         # Convert to tuple for convenience in get_ops and retrieve tensor
-        grad_recv_info_tuple = tuple(grad_recv_info.values())
+        grad_recv_info_tuple = tuple(grad_recv_info)
         logger.debug(
             f"{self.log_prefix} " f"Grad recv info: {grad_recv_info_tuple}"
         )
@@ -822,12 +1932,115 @@ class PipelineStage(_PipelineStage):
         stage_index: int,
         device: torch.device,
         group: dist.ProcessGroup = None,
+        flat_p2p: bool = False,
+        recompute: Union[bool, Sequence[str]] = False,
+        offload: bool = False,
+        offload_dir: Optional[str] = None,
+        act_codec: Optional[Codec] = None,
+        grad_codec: Optional[Codec] = None,
+        transport: Optional[SharedMemoryTransport] = None,
+        multicast: bool = False,
+        warmup: bool = False,
+        placement: Optional[Sequence[int]] = None,
     ):
         """
         Create a pipeline stage given a `Pipe` (representing the whole pipeline) and a stage index.
+        See `PipelineStageBase` for `flat_p2p`, `recompute`, `offload`, the
+        codecs, `transport` and `placement`, and `_PipelineStage` for `multicast` and
+        `warmup`. The stage has dynamic shapes if the pipe was traced with
+        `dynamic_shapes`.
         """
         # Find my stage module
         stage_module = pipe.get_stage_module(stage_index)
         # Get my pipe info
         pipe_info = pipe.info()
-        super().__init__(stage_module, stage_index, pipe_info, device, group)
+        super().__init__(
+            stage_module,
+            stage_index,
+            pipe_info,
+            device,
+            group,
+            flat_p2p,
+            recompute,
+            offload,
+            offload_dir,
+            act_codec,
+            grad_codec,
+            transport,
+            multicast,
+            warmup,
+            placement,
+        )
+
+
+def warmup_p2p(stages: Sequence[PipelineStageBase]) -> Dict[int, float]:
+    """
+    Set up the communicators between this rank and all the ranks its
+    `stages` exchange tensors with, including the ones of skip connections,
+    so that the first step does not pay for it. Each pair of ranks exchanges
+    a tiny tensor, in both directions. Must be called on every rank of the
+    pipeline, with all the stages of the rank.
+
+    Returns the time the exchange took with each peer, in seconds, by global
+    rank, which is also stored in the `p2p_warmup_latency` of the stages.
+    Peers reached through a shared memory transport have no communicator to
+    set up and are skipped.
+    """
+    if len(stages) == 0:
+        raise ValueError("No pipeline stages provided.")
+    stage = stages[0]
+    local_stages = sorted(s.stage_index for s in stages)
+    rank_stages = sorted(
+        i
+        for i, peer_rank in stage.stage_index_to_group_rank.items()
+        if peer_rank == stage.group_rank
+    )
+    if local_stages != rank_stages:
+        raise ValueError(
+            f"Warmup needs all the stages {rank_stages} of rank {stage.group_rank}, got {local_stages}"
+        )
+
+    rank = dist.get_rank()
+    peers = {
+        stage.stage_index_to_global_rank[peer]
+        for s in stages
+        for peer in s._p2p_peers()
+    }
+    peers.discard(rank)
+
+    latency: Dict[int, float] = {}
+    # Going through the peers in ascending order, every rank handles its
+    # pairs of ranks in the order of (lowest rank, highest rank): the first
+    # pair not done yet always has both its ranks waiting on it, hence no
+    # deadlock.
+    for peer in sorted(peers):
+        if stage._uses_transport(peer):
+            continue
+        send_tensor = torch.full(
+            (1,), rank, dtype=torch.int64, device=stage.device
+        )
+        recv_tensor = torch.empty_like(send_tensor)
+        start = time.perf_counter()
+        works = dist.batch_isend_irecv(
+            [
+                dist.P2POp(dist.isend, send_tensor, peer, stage.group),
+                dist.P2POp(dist.irecv, recv_tensor, peer, stage.group),
+            ]
+        )
+        for work in works:
+            work.wait()
+        # Copying to the host synchronizes with the device, whichever it is
+        received = recv_tensor.item()
+        latency[peer] = time.perf_counter() - start
+        if received != peer:
+            raise RuntimeError(
+                f"Warmup with rank {peer} received {received}, stages of both ranks do not match"
+            )
+
+    logger.info(
+        f"[{rank}] P2P warmup latency by peer: "
+        + ", ".join(f"{peer}: {t * 1e3:.2f} ms" for peer, t in latency.items())
+    )
+    for s in stages:
+        s.p2p_warmup_latency = latency
+    return latency
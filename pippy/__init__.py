@@ -8,7 +8,10 @@ from ._IR import (
     pipeline,
     SplitPoint,
 )
-from ._PipelineStage import PipelineStage
+from ._PipelineStage import PipelineStage, warmup_p2p
+from .ChunkedLoss import chunked_cross_entropy, ChunkedCrossEntropyLoss
+from .Compression import CastCodec, Codec, Int8Codec, TopKCodec
+from .LocalPipeline import LocalPipeline
 from .ManualPipelineStage import ManualPipelineStage
 from .ModelSplit import (
     split_by_graph,
@@ -20,7 +23,21 @@ from .PipelineSchedule import (
     ScheduleGPipe,
     ScheduleInterleaved1F1B,
     ScheduleLoopedBFS,
+    ScheduleZeroBubbleH1,
 )
+from .ScheduleSimulator import (
+    costs_from_pipe,
+    PipelineCosts,
+    simulate_schedule,
+)
+from .SharedMemoryTransport import SharedMemoryTransport
+from .StagePlacement import (
+    LinkCosts,
+    measure_links,
+    place_stages,
+    stage_traffic,
+)
+from .VocabParallel import VocabParallelCrossEntropyLoss
 
 
 __all__ = [
@@ -37,7 +54,25 @@ __all__ = [
     "ScheduleGPipe",
     "ScheduleInterleaved1F1B",
     "ScheduleLoopedBFS",
+    "ScheduleZeroBubbleH1",
+    "PipelineCosts",
+    "simulate_schedule",
+    "costs_from_pipe",
     "ManualPipelineStage",
     "ArgsChunkSpec",
     "KwargsChunkSpec",
+    "Codec",
+    "CastCodec",
+    "Int8Codec",
+    "TopKCodec",
+    "SharedMemoryTransport",
+    "warmup_p2p",
+    "LinkCosts",
+    "measure_links",
+    "place_stages",
+    "stage_traffic",
+    "LocalPipeline",
+    "ChunkedCrossEntropyLoss",
+    "chunked_cross_entropy",
+    "VocabParallelCrossEntropyLoss",
 ]
@@ -1,11 +1,54 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates
-from typing import List, Optional
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 import torch
+from torch.autograd.graph import get_gradient_edge, GradientEdge, Node
 
 from ._debug import map_debug_info
 
 
+def _extract_tensors_with_grads(stage_output, output_grads):
+    """
+    Flatten `stage_output` and `output_grads` into matching lists of output
+    tensors that require gradient and their gradients.
+    """
+    stage_output_tensors: List[torch.Tensor] = []
+    output_grad_tensors: List[Optional[torch.Tensor]] = []
+
+    def extract_tensors_with_grads(output_val, grad_val):
+        if isinstance(output_val, torch.Tensor):
+            if not output_val.requires_grad and output_val.grad_fn is None:
+                return
+            assert isinstance(
+                grad_val, (torch.Tensor, type(None))
+            ), f"Expected Tensor or None gradient but got {type(grad_val)}"
+            stage_output_tensors.append(output_val)
+            output_grad_tensors.append(grad_val)
+        elif isinstance(output_val, (tuple, list)):
+            if grad_val is None:
+                return
+            assert isinstance(
+                grad_val, (tuple, list)
+            ), f"grad_value expected to have type {type(output_val)} but got {type(grad_val)}"
+            assert len(output_val) == len(grad_val)
+            for ov, gv in zip(output_val, grad_val):
+                extract_tensors_with_grads(ov, gv)
+        elif isinstance(output_val, dict):
+            if grad_val is None:
+                return
+            assert isinstance(grad_val, dict)
+            assert set(output_val.keys()) == set(grad_val.keys())
+            for k in output_val.keys():
+                extract_tensors_with_grads(output_val[k], grad_val[k])
+        else:
+            # Output is a non-tensor type; just ignore it
+            pass
+
+    extract_tensors_with_grads(stage_output, output_grads)
+    return stage_output_tensors, output_grad_tensors
+
+
 def stage_backward(
     stage_output,
     output_grads,
@@ -30,39 +73,9 @@ def stage_backward(
     try:
         # stage_output may be a composite datatype like dict. Extract all individual
         # tensor values here
-        stage_output_tensors = []
-        output_grad_tensors = []
-
-        def extract_tensors_with_grads(output_val, grad_val):
-            if isinstance(output_val, torch.Tensor):
-                if not output_val.requires_grad and output_val.grad_fn is None:
-                    return
-                assert isinstance(
-                    grad_val, (torch.Tensor, type(None))
-                ), f"Expected Tensor or None gradient but got {type(grad_val)}"
-                stage_output_tensors.append(output_val)
-                output_grad_tensors.append(grad_val)
-            elif isinstance(output_val, (tuple, list)):
-                if grad_val is None:
-                    return
-                assert isinstance(
-                    grad_val, (tuple, list)
-                ), f"grad_value expected to have type {type(output_val)} but got {type(grad_val)}"
-                assert len(output_val) == len(grad_val)
-                for ov, gv in zip(output_val, grad_val):
-                    extract_tensors_with_grads(ov, gv)
-            elif isinstance(output_val, dict):
-                if grad_val is None:
-                    return
-                assert isinstance(grad_val, dict)
-                assert set(output_val.keys()) == set(grad_val.keys())
-                for k in output_val.keys():
-                    extract_tensors_with_grads(output_val[k], grad_val[k])
-            else:
-                # Output is a non-tensor type; just ignore it
-                pass
-
-        extract_tensors_with_grads(stage_output, output_grads)
+        stage_output_tensors, output_grad_tensors = _extract_tensors_with_grads(
+            stage_output, output_grads
+        )
 
         torch.autograd.backward(
             stage_output_tensors, grad_tensors=output_grad_tensors  # type: ignore[arg-type]
@@ -102,6 +115,261 @@ def stage_backward(
     return grad_inputs
 
 
+def _get_grad_node(t: torch.Tensor) -> Optional[Node]:
+    """
+    Return the autograd node producing the gradient for `t` (the `grad_fn` for
+    intermediate tensors, the `AccumulateGrad` node for leaves), or None if `t`
+    does not require gradient.
+    """
+    if not isinstance(t, torch.Tensor) or not t.requires_grad:
+        return None
+    return get_gradient_edge(t).node
+
+
+def _reverse_edges(roots: Iterable[Node]) -> Dict[Node, List[Node]]:
+    """
+    Walk the autograd graph from `roots` and map each node to the nodes that
+    consume its gradient (i.e. the nodes listing it in `next_functions`).
+    """
+    reverse_edges: Dict[Node, List[Node]] = defaultdict(list)
+    seen: Set[Node] = set(roots)
+    q: Deque[Node] = deque(seen)
+    while q:
+        node = q.popleft()
+        for fn, _ in node.next_functions:
+            if fn is None:
+                continue
+            reverse_edges[fn].append(node)
+            if fn not in seen:
+                seen.add(fn)
+                q.append(fn)
+    return reverse_edges
+
+
+def _reverse_closure(
+    roots: Iterable[Node],
+    reverse_edges: Dict[Node, List[Node]],
+    target_nodes: Set[Node],
+) -> Tuple[Set[Node], Set[Node]]:
+    """
+    Collect the nodes reachable from `roots` along reverse edges, stopping at
+    `target_nodes`. Returns the closure and the target nodes that were hit.
+    """
+    closure: Set[Node] = set(roots)
+    hit: Set[Node] = set()
+    q: Deque[Node] = deque(closure)
+    while q:
+        node = q.popleft()
+        for user in reverse_edges.get(node, ()):
+            if user in closure or user in hit:
+                continue
+            if user in target_nodes:
+                hit.add(user)
+                continue
+            closure.add(user)
+            q.append(user)
+    return closure, hit
+
+
+def _has_nested_intermediates(
+    intermediates: Set[Node], inputs_closure: Set[Node]
+) -> bool:
+    """
+    Whether one of `intermediates` is reached from another one when walking
+    the graph towards the inputs. Running the weight pass from both would then
+    count the gradient flowing between them twice.
+    """
+    seen: Set[Node] = set()
+    q: Deque[Node] = deque(
+        fn
+        for node in intermediates
+        for fn, _ in node.next_functions
+        if fn in inputs_closure
+    )
+    while q:
+        node = q.popleft()
+        if node in intermediates:
+            return True
+        if node in seen:
+            continue
+        seen.add(node)
+        q.extend(fn for fn, _ in node.next_functions if fn in inputs_closure)
+    return False
+
+
+def _get_param_groups(
+    input_nodes: List[Node],
+    weights: List[torch.Tensor],
+    reverse_edges: Dict[Node, List[Node]],
+) -> Tuple[List[Dict[str, Any]], List[torch.Tensor]]:
+    """
+    Group the weights by the "intermediate" nodes where their gradient path
+    joins the gradient path of the stage inputs. The gradients flowing into
+    those nodes are all that is needed to compute the weight gradients later.
+
+    Returns the param groups and the weights whose gradient cannot be deferred,
+    either because it does not flow through any input-dependent node or
+    because its intermediate nodes are nested.
+    """
+    inputs_closure, _ = _reverse_closure(input_nodes, reverse_edges, set())
+    param_groups: List[Dict[str, Any]] = []
+    unsplit_weights: List[torch.Tensor] = []
+    for w in weights:
+        _, intermediates = _reverse_closure(
+            [_get_grad_node(w)], reverse_edges, inputs_closure
+        )
+        if not intermediates:
+            unsplit_weights.append(w)
+            continue
+        group: Dict[str, Any] = {
+            "params": [w],
+            "intermediates": set(intermediates),
+        }
+        # Merge with the groups sharing an intermediate node
+        overlapping = [
+            g
+            for g in param_groups
+            if not g["intermediates"].isdisjoint(intermediates)
+        ]
+        for g in overlapping:
+            group["params"] = g["params"] + group["params"]
+            group["intermediates"] |= g["intermediates"]
+        param_groups = [
+            g for g in param_groups if all(g is not o for o in overlapping)
+        ]
+        param_groups.append(group)
+
+    split_groups: List[Dict[str, Any]] = []
+    for group in param_groups:
+        if len(group["intermediates"]) > 1 and _has_nested_intermediates(
+            group["intermediates"], inputs_closure
+        ):
+            unsplit_weights += group["params"]
+        else:
+            split_groups.append(group)
+    return split_groups, unsplit_weights
+
+
+def stage_backward_input(
+    stage_output,
+    output_grads: Optional[List[torch.Tensor]],
+    input_values: List[torch.Tensor],
+    weights: List[torch.Tensor],
+) -> Tuple[List[Optional[torch.Tensor]], Optional[List[Dict[str, Any]]]]:
+    """
+    First half of a split backward: compute the gradients for the stage inputs
+    only, so that they can be sent to the previous stage right away, and
+    capture what `stage_backward_weight` needs to compute the weight gradients
+    later. The autograd graph is retained until then.
+
+    Returns the gradients for `input_values` and the param groups to pass to
+    `stage_backward_weight`. The param groups are None if no input requires
+    gradient (e.g. first stage), in which case there is nothing to split and a
+    regular `stage_backward` should be run in place of the weight pass.
+    """
+    try:
+        stage_output_tensors, output_grad_tensors = _extract_tensors_with_grads(
+            stage_output, output_grads
+        )
+        inputs_with_grad = [
+            val
+            for val in input_values
+            if isinstance(val, torch.Tensor) and val.requires_grad
+        ]
+        if not inputs_with_grad:
+            return [None] * len(input_values), None
+
+        reverse_edges = _reverse_edges(
+            node
+            for node in map(_get_grad_node, stage_output_tensors)
+            if node is not None
+        )
+        param_groups, unsplit_weights = _get_param_groups(
+            [_get_grad_node(val) for val in inputs_with_grad],
+            weights,
+            reverse_edges,
+        )
+        del reverse_edges
+
+        # Capture the gradients flowing into the intermediate nodes
+        for group in param_groups:
+            group["grads"] = {}
+
+            def get_hook(group, node):
+                def hook(grad_outputs):
+                    group["grads"][node] = grad_outputs
+
+                return hook
+
+            for node in group["intermediates"]:
+                node.register_prehook(get_hook(group, node))
+
+        grads = torch.autograd.grad(
+            stage_output_tensors,
+            inputs_with_grad + unsplit_weights,
+            output_grad_tensors,  # type: ignore[arg-type]
+            retain_graph=True,
+            allow_unused=True,
+        )
+        input_grads = dict(zip(map(id, inputs_with_grad), grads))
+        # Weights not separable from the input path are done right away
+        for w, dw in zip(unsplit_weights, grads[len(inputs_with_grad) :]):
+            _accumulate_grad(w, dw)
+
+        grad_inputs = [input_grads.get(id(val)) for val in input_values]
+
+    except Exception as e:
+        exc_msg = f"""
+        Failed to run stage backward for inputs:
+        Stage output: {map_debug_info(stage_output)}
+        Output gradient: {map_debug_info(output_grads)}
+        Input: {map_debug_info(input_values)}
+        """
+        raise RuntimeError(exc_msg) from e
+
+    return grad_inputs, param_groups
+
+
+def stage_backward_weight(param_groups: List[Dict[str, Any]]):
+    """
+    Second half of a split backward: compute and accumulate the weight
+    gradients from the gradients captured by `stage_backward_input`. Only the
+    part of the graph between the intermediate nodes and the weights is run.
+    """
+    for i, group in enumerate(param_groups):
+        outputs: List[GradientEdge] = []
+        grad_outputs: List[torch.Tensor] = []
+        for node, grads in group["grads"].items():
+            for output_nr, grad in enumerate(grads):
+                if grad is not None:
+                    outputs.append(GradientEdge(node, output_nr))
+                    grad_outputs.append(grad)
+        if not outputs:
+            continue
+
+        params = group["params"]
+        dweights = torch.autograd.grad(
+            outputs,  # type: ignore[arg-type]
+            [get_gradient_edge(p) for p in params],
+            grad_outputs,
+            retain_graph=i < len(param_groups) - 1,
+            allow_unused=True,
+        )
+        for p, dw in zip(params, dweights):
+            _accumulate_grad(p, dw)
+        # Release the captured gradients
+        group["grads"].clear()
+
+
+def _accumulate_grad(t: torch.Tensor, grad: Optional[torch.Tensor]):
+    if grad is None:
+        return
+    if t.grad is None:
+        t.grad = grad
+    else:
+        t.grad += grad
+
+
 # TODO: handling requires_grad=False dynamically. Can we analyze this during initial
 # IR emission?
 def _null_coalesce_accumulate(lhs, rhs):
@@ -0,0 +1,117 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Background thread issuing and progressing the P2P ops of a schedule.
+
+With gloo on CPU, the main thread is busy computing between the points where
+a schedule issues its P2P ops and waits for them. A `CommEngine` takes the
+batches of ops from a queue, issues them on its own thread right away, and
+keeps polling the outstanding ones, completing a future per batch, so that
+the transfers progress while the main thread computes.
+"""
+
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Deque, List, Tuple
+
+from .SharedMemoryTransport import batch_isend_irecv
+
+# Seconds between polls of the outstanding ops
+_POLL_INTERVAL = 5e-5
+
+
+class CommFuture(Future):
+    """
+    Future of a batch of ops issued by a `CommEngine`, which can also be
+    waited for like the works of the process group.
+    """
+
+    def is_completed(self) -> bool:
+        return self.done()
+
+    def wait(self) -> bool:
+        self.result()
+        return True
+
+
+def _progress_loop(ops_queue: "queue.Queue") -> None:
+    """
+    Loop of the thread of a `CommEngine` taking its batches from `ops_queue`.
+    """
+    # Issued batches not completed yet, in order
+    outstanding: Deque[Tuple[List, CommFuture]] = deque()
+    while True:
+        try:
+            # Sleep until a batch is submitted, or until the next poll
+            # when there are outstanding ops
+            item = ops_queue.get(
+                timeout=_POLL_INTERVAL if outstanding else None
+            )
+        except queue.Empty:
+            item = None
+        if item is not None:
+            if item[0] is None:
+                break
+            ops, future = item
+            try:
+                outstanding.append((batch_isend_irecv(ops), future))
+            except Exception as e:
+                future.set_exception(e)
+            # Issue everything queued before polling
+            continue
+
+        for _ in range(len(outstanding)):
+            works, future = outstanding.popleft()
+            if not all(work.is_completed() for work in works):
+                outstanding.append((works, future))
+                continue
+            try:
+                # Raises the errors of the ops, if any
+                for work in works:
+                    work.wait()
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+
+
+class CommEngine:
+    """
+    Issues the batches of P2P ops submitted with `submit` on a dedicated
+    thread, in the order they are submitted, and completes their futures
+    once all their ops are done. Only for CPU ops, which can be issued from
+    any thread.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue" = queue.Queue()
+        # The thread does not reference the engine, which is closed when
+        # garbage collected
+        self._thread = threading.Thread(
+            target=_progress_loop,
+            args=(self._queue,),
+            name="pippy-comm",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def submit(self, ops: List) -> CommFuture:
+        """
+        Queue a batch of ops (see `batch_isend_irecv`) to issue. Returns the
+        future of the batch.
+        """
+        future = CommFuture()
+        self._queue.put((ops, future))
+        return future
+
+    def close(self) -> None:
+        """
+        Stop the thread, once the batches submitted so far are issued.
+        """
+        if self._thread.is_alive():
+            self._queue.put((None, None))
+            self._thread.join()
+
+    def __del__(self):
+        if hasattr(self, "_thread"):
+            self.close()
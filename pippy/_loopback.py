@@ -0,0 +1,83 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+"""
+Transfers between pipeline stages placed on the same rank, which do not go
+through the process group: the tensors are copied within the process. As
+with the gloo process group, sends and receives are matched by tag, then in
+the order they are issued.
+"""
+
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Tuple
+
+import torch
+import torch.distributed as dist
+
+
+class LoopbackWork:
+    """
+    Work of a loopback op, waited for like the works of the process group.
+    """
+
+    def __init__(self, done: bool):
+        self._done = done
+
+    def is_completed(self) -> bool:
+        return self._done
+
+    def wait(self) -> bool:
+        if not self._done:
+            raise RuntimeError(
+                "Waiting for a receive from a stage of the same rank, whose "
+                "send has not been issued"
+            )
+        return True
+
+
+# Map (process group, tag) to the tensors sent and not received yet
+_sent: Dict[Tuple[Any, int], Deque[torch.Tensor]] = defaultdict(deque)
+# Map (process group, tag) to the receives posted and not matched yet
+_posted: Dict[
+    Tuple[Any, int], Deque[Tuple[torch.Tensor, LoopbackWork]]
+] = defaultdict(deque)
+
+
+class LoopbackP2POp:
+    """
+    A send or receive between two stages of this rank, used like a
+    `dist.P2POp`: see `SharedMemoryTransport.batch_isend_irecv`. A receive
+    completes when the matching send is issued, so it must be waited for
+    after that.
+    """
+
+    def __init__(
+        self,
+        op,
+        tensor: torch.Tensor,
+        peer: int,
+        group=None,
+        tag: int = 0,
+    ):
+        self.op = op
+        self.tensor = tensor
+        self.peer = peer
+        self.group = group
+        self.tag = tag
+
+    def issue(self) -> LoopbackWork:
+        key = (self.group, self.tag)
+        if self.op is dist.isend:
+            if _posted[key]:
+                recv_tensor, work = _posted[key].popleft()
+                recv_tensor.copy_(self.tensor)
+                work._done = True
+            else:
+                # The sender may reuse its tensor once the send is done
+                _sent[key].append(self.tensor.clone())
+            return LoopbackWork(True)
+
+        if _sent[key]:
+            self.tensor.copy_(_sent[key].popleft())
+            return LoopbackWork(True)
+        work = LoopbackWork(False)
+        _posted[key].append((self.tensor, work))
+        return work
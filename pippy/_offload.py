@@ -0,0 +1,174 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import logging
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch.autograd.graph import saved_tensors_hooks
+
+
+logger = logging.getLogger(__name__)
+
+
+class _OffloadedTensor:
+    """
+    A tensor saved for backward, moved out of device memory between the
+    forward and the backward of its microbatch.
+    """
+
+    __slots__ = ["tensor", "path", "event", "offloaded"]
+
+    def __init__(self, tensor: torch.Tensor):
+        self.tensor = tensor
+        # Backing file of a memory-mapped tensor
+        self.path: Optional[str] = None
+        # Completion of the copy back to the device
+        self.event: Optional[torch.cuda.Event] = None
+        self.offloaded = False
+
+
+class ActivationOffloader:
+    """
+    Offloads the activations saved for backward by the forward of each
+    microbatch, until its backward. Activations on a GPU are copied to pinned
+    host memory, on a side stream; activations on CPU are written to
+    memory-mapped files, which the OS can page out.
+
+    The forward of a microbatch is run under `save(chunk_id)`, then
+    `offload(chunk_id)` moves its saved tensors out and `prefetch(chunk_id)`
+    starts moving them back. Tensors not prefetched are loaded back when
+    autograd unpacks them.
+    """
+
+    def __init__(
+        self,
+        device: torch.device,
+        offload_dir: Optional[str] = None,
+    ):
+        self.device = device
+        self._stream: Optional[torch.cuda.Stream] = None
+        if device.type != "cuda":
+            # Directory of the memory-mapped files, removed with the offloader
+            # if we created it
+            self._own_dir = offload_dir is None
+            self._dir = (
+                tempfile.mkdtemp(prefix="pippy_offload_")
+                if offload_dir is None
+                else offload_dir
+            )
+        # map microbatch ID to its saved tensors not yet prefetched
+        self._chunks: Dict[int, List[_OffloadedTensor]] = {}
+
+    def __del__(self):
+        if self.device.type != "cuda" and self._own_dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def save(self, chunk_id: int) -> saved_tensors_hooks:
+        """
+        Context manager recording the tensors saved for backward by the
+        forward of chunk `chunk_id`.
+        """
+        saved = self._chunks.setdefault(chunk_id, [])
+
+        def pack(tensor: torch.Tensor) -> Any:
+            # Parameters and received inputs are kept alive by the stage
+            # anyway
+            if (
+                tensor.requires_grad
+                and tensor.is_leaf
+                or tensor.device.type != self.device.type
+                or tensor.numel() == 0
+            ):
+                return tensor
+            entry = _OffloadedTensor(tensor)
+            saved.append(entry)
+            return entry
+
+        def unpack(packed: Any) -> torch.Tensor:
+            if isinstance(packed, torch.Tensor):
+                return packed
+            if packed.offloaded:
+                # Not prefetched
+                self._load(packed)
+            if packed.event is not None:
+                torch.cuda.current_stream(self.device).wait_event(packed.event)
+                packed.event = None
+            return packed.tensor
+
+        return saved_tensors_hooks(pack, unpack)
+
+    def offload(self, chunk_id: int) -> None:
+        """
+        Move the saved tensors of chunk `chunk_id` out of device memory.
+        """
+        saved = self._chunks.get(chunk_id, [])
+        if self._stream is None and self.device.type == "cuda":
+            self._stream = torch.cuda.Stream(self.device)
+        if self._stream is not None:
+            # The tensors are written by the compute stream
+            self._stream.wait_stream(torch.cuda.current_stream(self.device))
+
+        for entry in saved:
+            tensor = entry.tensor
+            if self._stream is not None:
+                with torch.cuda.stream(self._stream):
+                    host = torch.empty(
+                        tensor.size(),
+                        dtype=tensor.dtype,
+                        layout=tensor.layout,
+                        pin_memory=True,
+                    )
+                    host.copy_(tensor, non_blocking=True)
+                # Keep the device memory from being reused before the copy
+                tensor.record_stream(self._stream)
+            else:
+                fd, entry.path = tempfile.mkstemp(dir=self._dir)
+                os.ftruncate(fd, tensor.numel() * tensor.element_size())
+                os.close(fd)
+                host = torch.from_file(
+                    entry.path,
+                    shared=True,
+                    size=tensor.numel(),
+                    dtype=tensor.dtype,
+                ).view(tensor.size())
+                host.copy_(tensor)
+            entry.tensor = host
+            entry.offloaded = True
+        logger.debug(f"Offloaded {len(saved)} tensors of chunk {chunk_id}")
+
+    def prefetch(self, chunk_id: int) -> None:
+        """
+        Start moving the saved tensors of chunk `chunk_id` back, ahead of its
+        backward. Does nothing if they were already.
+        """
+        for entry in self._chunks.pop(chunk_id, []):
+            self._load(entry)
+
+    def _load(self, entry: _OffloadedTensor) -> None:
+        if self._stream is not None:
+            with torch.cuda.stream(self._stream):
+                tensor = entry.tensor.to(self.device, non_blocking=True)
+            # Used and freed by the compute stream
+            tensor.record_stream(torch.cuda.current_stream(self.device))
+            entry.event = self._stream.record_event()
+        else:
+            tensor = entry.tensor.clone()
+            if entry.path is not None:
+                os.remove(entry.path)
+                entry.path = None
+        entry.tensor = tensor
+        entry.offloaded = False
+
+    def clear(self) -> None:
+        """
+        Drop the saved tensors of all chunks, e.g. of a step that did not run
+        their backward.
+        """
+        for saved in self._chunks.values():
+            for entry in saved:
+                if entry.path is not None:
+                    os.remove(entry.path)
+                    entry.path = None
+        self._chunks.clear()
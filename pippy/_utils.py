@@ -1,6 +1,7 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates
 import logging
-from typing import Dict
+import operator
+from typing import Dict, List, Optional, Sequence, Set
 
 import torch
 from torch import fx
@@ -88,6 +89,126 @@ def modify_graph_op_device(
         gm.recompile()
 
 
+# Targets whose output does not require gradient, whatever their inputs
+_DETACH_TARGETS = {
+    "detach",
+    torch.detach,
+    torch.Tensor.detach,
+    torch.ops.aten.detach.default,
+}
+
+
+def _graph_module(module: torch.nn.Module) -> Optional[fx.GraphModule]:
+    if isinstance(module, fx.GraphModule):
+        return module
+    if isinstance(module, InterpreterModule):
+        # If unflattening has been performed, the graph is in `.graph_module`
+        return module.graph_module
+    return None
+
+
+def _can_require_grad(node: fx.Node) -> bool:
+    """
+    Whether the value of `node` can require gradient, from its dtype if it is
+    known.
+    """
+    val = node.meta.get("val")
+    if isinstance(val, torch.Tensor):
+        return val.dtype.is_floating_point or val.dtype.is_complex
+    return True
+
+
+def _outputs_requiring_grad(
+    gm: fx.GraphModule,
+    input_grads: Sequence[bool],
+) -> List[bool]:
+    """
+    For each flattened output of `gm`, whether it requires gradient when its
+    inputs do as in `input_grads`: floating point values computed, with
+    gradient enabled, from a parameter or an input requiring gradient. Ops
+    are assumed differentiable, so that the analysis errs on requiring
+    gradient.
+    """
+    grad_nodes: Set[fx.Node] = set()
+    input_grads_iter = iter(input_grads)
+    grad_enabled = True
+    for node in gm.graph.nodes:
+        if node.op == "placeholder":
+            requires_grad = next(input_grads_iter, False)
+        elif node.op == "get_attr":
+            attr = gm
+            for atom in node.target.split("."):  # type: ignore[union-attr]
+                attr = getattr(attr, atom)
+            requires_grad = (
+                isinstance(attr, torch.Tensor) and attr.requires_grad
+            )
+        elif node.op == "output":
+            return [
+                isinstance(val, fx.Node) and val in grad_nodes
+                for val in flatten_args(node.args)
+            ]
+        elif node.target is torch._C._set_grad_enabled:
+            # `torch.no_grad()` regions, as traced by export
+            grad_enabled = bool(node.args[0])
+            continue
+        elif node.target in _DETACH_TARGETS:
+            requires_grad = False
+        elif node.op == "call_module":
+            submod = gm.get_submodule(node.target)  # type: ignore[arg-type]
+            inputs = [
+                isinstance(arg, fx.Node) and arg in grad_nodes
+                for arg in node.args
+            ]
+            sub_gm = _graph_module(submod)
+            if sub_gm is not None:
+                requires_grad = any(_outputs_requiring_grad(sub_gm, inputs))
+            else:
+                requires_grad = any(inputs) or any(
+                    p.requires_grad for p in submod.parameters()
+                )
+        else:
+            requires_grad = any(n in grad_nodes for n in node.all_input_nodes)
+        if requires_grad and grad_enabled and _can_require_grad(node):
+            grad_nodes.add(node)
+    return []
+
+
+def values_requiring_grad(graph: fx.Graph) -> Optional[Set[fx.Node]]:
+    """
+    The values of the pipe graph `graph` (stage nodes with a single output,
+    `getitem`s of the outputs otherwise) that require gradient, so that
+    gradients are only sent back for them. The inputs of the model are not
+    differentiated. Returns `None` if the stage modules are not available,
+    meaning that any value may require gradient.
+    """
+    root = graph.owning_module
+    if root is None:
+        return None
+    grad_values: Set[fx.Node] = set()
+    for node in graph.nodes:
+        if node.op != "call_module":
+            continue
+        inputs = [
+            isinstance(arg, fx.Node) and arg in grad_values for arg in node.args
+        ]
+        gm = _graph_module(root.get_submodule(node.target))  # type: ignore[arg-type]
+        output_grads = (
+            _outputs_requiring_grad(gm, inputs) if gm is not None else []
+        )
+
+        # Map each value holding an output to its index
+        values = {
+            user: user.args[1]
+            for user in node.users
+            if user.target is operator.getitem
+        } or {node: 0}
+        for value, out_idx in values.items():
+            # Unknown outputs may require gradient
+            if out_idx >= len(output_grads) or output_grads[out_idx]:  # type: ignore[operator]
+                grad_values.add(value)
+    return grad_values
+
+
 class QualnameMapMixin:
     """
     A mixin class that helps a `Pipe` object to remap its qualnames back to
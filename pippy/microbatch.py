@@ -194,12 +194,134 @@ def _shard_dict_of_args(
     return args_split
 
 
+class _SplitPlan:
+    """
+    How `split_args_kwargs_into_chunks` split inputs of a given structure:
+    their tree spec, the chunk specs and number of chunks asked for, and the
+    leaves it split, along which dimension, with their sizes on it (hence
+    the chunk boundaries). Inputs matching all of these are split the same
+    way, directly from their flat leaves.
+    """
+
+    def __init__(
+        self,
+        treespec,
+        chunks: int,
+        chunk_spec_key: Any,
+        flat: List[Any],
+        chunk_spec_flat: List[Any],
+        num_chunks: int,
+    ):
+        self.treespec = treespec
+        self.chunks = chunks
+        # See `_chunk_spec_key`
+        self.chunk_spec_key = chunk_spec_key
+        self.num_leaves = len(flat)
+        self.num_chunks = num_chunks
+        # (leaf index, split dim, number of dims, size on the split dim)
+        self.split_leaves: List[Tuple[int, int, int, int]] = []
+        # Leaves with a `TensorChunkSpec` replicated for not being tensors
+        self.non_tensor_leaves: List[int] = []
+        for idx, (v, chunk_v) in enumerate(zip(flat, chunk_spec_flat)):
+            if chunk_v is _Replicate:
+                continue
+            if isinstance(v, torch.Tensor):
+                self.split_leaves.append(
+                    (idx, chunk_v.split_dim, v.dim(), v.size(chunk_v.split_dim))
+                )
+            else:
+                self.non_tensor_leaves.append(idx)
+
+    def matches(
+        self,
+        flat: List[Any],
+        treespec,
+        chunks: int,
+        chunk_spec_key: Any,
+    ) -> bool:
+        if (
+            chunks != self.chunks
+            or len(flat) != self.num_leaves
+            or treespec != self.treespec
+            or chunk_spec_key != self.chunk_spec_key
+        ):
+            return False
+        for idx, dim, ndim, size in self.split_leaves:
+            v = flat[idx]
+            if (
+                not isinstance(v, torch.Tensor)
+                or v.dim() != ndim
+                or v.size(dim) != size
+            ):
+                return False
+        return not any(
+            isinstance(flat[idx], torch.Tensor)
+            for idx in self.non_tensor_leaves
+        )
+
+    def split(self, flat: List[Any]) -> Tuple[List[Tuple], List[Dict]]:
+        chunks_flat = [list(flat) for _ in range(self.num_chunks)]
+        for idx, dim, _, _ in self.split_leaves:
+            chunk_tensors = torch.tensor_split(flat[idx], self.num_chunks, dim)
+            for chunk_flat, chunk_tensor in zip(chunks_flat, chunk_tensors):
+                chunk_flat[idx] = chunk_tensor
+
+        args_split = []
+        kwargs_split = []
+        for chunk_flat in chunks_flat:
+            chunk_args, chunk_kwargs = tree_unflatten(chunk_flat, self.treespec)
+            args_split.append(chunk_args)
+            kwargs_split.append(chunk_kwargs)
+        return args_split, kwargs_split
+
+
+def _chunk_spec_key(chunk_spec) -> Any:
+    """
+    Value of a chunk spec to compare split plans by: its structure, and the
+    split dimension of each `TensorChunkSpec`.
+    """
+    if chunk_spec is None:
+        return None
+    spec_flat, spec_treespec = tree_flatten(chunk_spec)
+    return spec_treespec, [
+        (TensorChunkSpec, v.split_dim) if isinstance(v, TensorChunkSpec) else v
+        for v in spec_flat
+    ]
+
+
+class SplitPlanCache:
+    """
+    Split plans of the most recent input structures, most recent first, for
+    `split_args_kwargs_into_chunks` to reuse. Owned by a schedule or a
+    pipeline, which splits its inputs from one thread.
+    """
+
+    def __init__(self, max_plans: int = 8):
+        self.max_plans = max_plans
+        self.plans: List[_SplitPlan] = []
+
+    def lookup(
+        self, flat: List[Any], treespec, chunks: int, chunk_spec_key: Any
+    ) -> Optional[_SplitPlan]:
+        for plan_idx, plan in enumerate(self.plans):
+            if plan.matches(flat, treespec, chunks, chunk_spec_key):
+                if plan_idx != 0:
+                    self.plans.insert(0, self.plans.pop(plan_idx))
+                return plan
+        return None
+
+    def add(self, plan: _SplitPlan) -> None:
+        self.plans.insert(0, plan)
+        del self.plans[self.max_plans :]
+
+
 def split_args_kwargs_into_chunks(
     args: Tuple[Any, ...],
     kwargs: Optional[Dict[str, Any]],
     chunks: int,
     args_chunk_spec: Optional[Tuple[TensorChunkSpec, ...]] = None,
     kwargs_chunk_spec: Optional[Dict[str, TensorChunkSpec]] = None,
+    split_plans: Optional[SplitPlanCache] = None,
 ) -> Tuple[List[Tuple], List[Dict]]:
     """
     Given a sequence of args and kwargs, split them into a number of chunks
@@ -211,6 +333,8 @@ def split_args_kwargs_into_chunks(
         chunks: Number of chunks to split the args and kwargs into
         args_chunk_spec: chunking specs for args, in same shape as args
         kwargs_chunk_spec: chunking specs for kwargs, in same shape as kwargs
+        split_plans: where to find and keep the plans splitting inputs of the
+            same structure the same way (see `SplitPlanCache`)
 
     Returns:
         args_split: List of sharded args
@@ -253,6 +377,20 @@ def split_args_kwargs_into_chunks(
     if kwargs is None:
         kwargs = {}
 
+    # Inputs of the same structure as a previous call are split the same way,
+    # without going through the steps above again
+    if _debug_mask_minibatches:
+        split_plans = None
+    if split_plans is not None:
+        flat, treespec = tree_flatten((tuple(args), kwargs))
+        chunk_spec_key = (
+            _chunk_spec_key(args_chunk_spec),
+            _chunk_spec_key(kwargs_chunk_spec),
+        )
+        plan = split_plans.lookup(flat, treespec, chunks, chunk_spec_key)
+        if plan is not None:
+            return plan.split(flat)
+
     # If user did not provide args_chunk_spec or kwargs_chunk_spec, we extend
     # their format and use default chunking along dim 0
     if args_chunk_spec is None:
@@ -297,6 +435,24 @@ def split_args_kwargs_into_chunks(
     for chunk_args in args_split_dict:
         args_split.append(tuple(chunk_args[i] for i in range(len(chunk_args))))
 
+    if split_plans is not None:
+        # Chunk spec of each leaf, in the order of `flat`
+        chunk_spec_flat: List[Any] = []
+        for i in range(len(args)):
+            chunk_spec_flat.extend(tree_flatten(args_chunk_spec[i])[0])
+        for key in kwargs:
+            chunk_spec_flat.extend(tree_flatten(kwargs_chunk_spec[key])[0])
+        split_plans.add(
+            _SplitPlan(
+                treespec,
+                chunks,
+                chunk_spec_key,
+                flat,
+                chunk_spec_flat,
+                len(args_split),
+            )
+        )
+
     return args_split, kwargs_split
 
 
@@ -430,3 +586,114 @@ def merge_chunks(
 
     # Stage 4: Unflatten combined args
     return tree_unflatten(args_flattened, flatten_spec)
+
+
+class ChunkMerger:
+    """
+    Merges chunks into a single value according to a chunk spec, as they
+    come, which gives the result of `merge_chunks` without keeping the
+    chunks nor concatenating them at the end.
+
+    Each value sharded by a `TensorChunkSpec` is allocated for the whole
+    batch with the first chunk, assuming the chunks are split as by
+    `torch.tensor_split` (the first one being the largest), and every chunk
+    is copied into its slice. The merged value is a view of the used part.
+    The values of `_CustomReducer`s are reduced as the chunks come, and the
+    other values are those of the first chunk. The merged tensors are not
+    part of the autograd graph of the chunks.
+    """
+
+    def __init__(self, num_chunks: int, chunk_spec=None):
+        self.num_chunks = num_chunks
+        self.chunk_spec = chunk_spec
+        self.num_added = 0
+        # Flat merged values so far, and where the next chunk goes along the
+        # split dimension of each sharded value
+        self.values: List[Any] = []
+        self._offsets: List[int] = []
+        self._spec_flattened: List[Any] = []
+        self._treespec = None
+        # With `_debug_mask_minibatches`, the chunks are merged at the end
+        self._chunks: List[Any] = []
+
+    def add(self, chunk: Any) -> None:
+        """
+        Merge the next chunk.
+        """
+        if _debug_mask_minibatches:
+            self._chunks.append(chunk)
+            return
+
+        chunk_flattened, treespec = tree_flatten(chunk)
+        first = self.num_added == 0
+        if first:
+            if self.chunk_spec is not None:
+                self._spec_flattened, self._treespec = tree_flatten(
+                    self.chunk_spec
+                )
+            else:
+                # Merge all output fields along the default dimension (0)
+                self._spec_flattened = [
+                    TensorChunkSpec(DEFAULT_CHUNK_DIM)
+                ] * len(chunk_flattened)
+                self._treespec = treespec
+            self.values = [None] * len(self._spec_flattened)
+            self._offsets = [0] * len(self._spec_flattened)
+        if len(chunk_flattened) != len(self._spec_flattened):
+            raise ValueError(
+                f"Chunk {chunk} did not match chunk spec {self.chunk_spec}"
+            )
+
+        for arg_idx, (arg, value) in enumerate(
+            zip(self._spec_flattened, chunk_flattened)
+        ):
+            if isinstance(arg, TensorChunkSpec):
+                self._copy_into_slice(arg_idx, arg.split_dim, value)
+            elif isinstance(arg, _CustomReducer):
+                self.values[arg_idx] = arg.reduce_fn(
+                    arg.init_value if first else self.values[arg_idx], value
+                )
+            elif first:
+                self.values[arg_idx] = value
+        self.num_added += 1
+
+    def _copy_into_slice(
+        self, arg_idx: int, dim: int, value: torch.Tensor
+    ) -> None:
+        merged = self.values[arg_idx]
+        offset = self._offsets[arg_idx]
+        size = value.size(dim)
+        if merged is None or offset + size > merged.size(dim):
+            # First chunk, or a chunk larger than the first one: allocate for
+            # the chunks left, as large as this one
+            shape = list(value.shape)
+            shape[dim] = offset + size * max(
+                self.num_chunks - self.num_added, 1
+            )
+            new_merged = value.new_empty(shape)
+            if merged is not None:
+                new_merged.narrow(dim, 0, offset).copy_(
+                    merged.narrow(dim, 0, offset)
+                )
+            merged = self.values[arg_idx] = new_merged
+        with torch.no_grad():
+            merged.narrow(dim, offset, size).copy_(value)
+        self._offsets[arg_idx] = offset + size
+
+    def merge(self) -> Any:
+        """
+        The merged value of the chunks added so far.
+        """
+        if _debug_mask_minibatches:
+            return merge_chunks(self._chunks, self.chunk_spec)
+        if self.num_added == 0:
+            raise RuntimeError("No chunk to merge")
+        args_flattened = [
+            value.narrow(arg.split_dim, 0, self._offsets[arg_idx])
+            if isinstance(arg, TensorChunkSpec)
+            else value
+            for arg_idx, (arg, value) in enumerate(
+                zip(self._spec_flattened, self.values)
+            )
+        ]
+        return tree_unflatten(args_flattened, self._treespec)
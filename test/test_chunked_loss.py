@@ -0,0 +1,86 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import copy
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from pippy import chunked_cross_entropy, ChunkedCrossEntropyLoss
+
+
+batch_size = 2
+seq_len = 7
+d_hid = 8
+vocab = 11
+
+
+class TestChunkedLoss(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.hidden = torch.randn(batch_size, seq_len, d_hid)
+        self.target = torch.randint(vocab, (batch_size, seq_len))
+        self.target[0, :3] = -100
+        self.head = torch.nn.Linear(d_hid, vocab)
+
+    def check(self, chunk_size, reduction):
+        head = copy.deepcopy(self.head)
+        hidden = self.hidden.clone().requires_grad_()
+        loss = chunked_cross_entropy(
+            hidden,
+            head.weight,
+            self.target,
+            head.bias,
+            chunk_size=chunk_size,
+            reduction=reduction,
+        )
+        loss.backward()
+
+        ref_head = copy.deepcopy(self.head)
+        ref_hidden = self.hidden.clone().requires_grad_()
+        ref_loss = F.cross_entropy(
+            ref_head(ref_hidden).flatten(0, 1),
+            self.target.flatten(),
+            reduction=reduction,
+        )
+        ref_loss.backward()
+
+        torch.testing.assert_close(loss, ref_loss)
+        torch.testing.assert_close(hidden.grad, ref_hidden.grad)
+        torch.testing.assert_close(head.weight.grad, ref_head.weight.grad)
+        torch.testing.assert_close(head.bias.grad, ref_head.bias.grad)
+
+    def test_chunked_cross_entropy(self):
+        # Chunks not dividing the tokens, one token, all tokens at once
+        for chunk_size in (3, 1, batch_size * seq_len):
+            for reduction in ("mean", "sum"):
+                self.check(chunk_size, reduction)
+
+    def test_loss_module(self):
+        loss_fn = ChunkedCrossEntropyLoss(self.head, chunk_size=4)
+        self.assertEqual(
+            list(loss_fn.parameters()), list(self.head.parameters())
+        )
+        torch.testing.assert_close(
+            loss_fn(self.hidden, self.target),
+            F.cross_entropy(
+                self.head(self.hidden).flatten(0, 1), self.target.flatten()
+            ),
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            chunked_cross_entropy(
+                self.hidden, self.head.weight, self.target, reduction="none"
+            )
+        with self.assertRaises(ValueError):
+            chunked_cross_entropy(
+                self.hidden, self.head.weight, self.target, chunk_size=0
+            )
+        with self.assertRaises(ValueError):
+            chunked_cross_entropy(
+                self.hidden, self.head.weight, self.target[:, :-1]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
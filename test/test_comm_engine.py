@@ -0,0 +1,39 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import unittest
+
+import torch
+import torch.distributed as dist
+
+from pippy._comm_engine import CommEngine
+from pippy._loopback import LoopbackP2POp
+
+
+class TestCommEngine(unittest.TestCase):
+    def test_submit(self):
+        engine = CommEngine()
+        sent = torch.arange(4.0)
+        received = torch.zeros(4)
+        # The receive completes once the send is issued, in a later batch
+        recv_future = engine.submit(
+            [LoopbackP2POp(dist.irecv, received, 0, tag=1)]
+        )
+        send_future = engine.submit([LoopbackP2POp(dist.isend, sent, 0, tag=1)])
+        recv_future.wait()
+        self.assertTrue(send_future.wait())
+        torch.testing.assert_close(received, sent)
+        engine.close()
+
+    def test_error(self):
+        engine = CommEngine()
+        engine.submit([LoopbackP2POp(dist.isend, torch.ones(3), 0, tag=2)])
+        future = engine.submit(
+            [LoopbackP2POp(dist.irecv, torch.zeros(4), 0, tag=2)]
+        )
+        # Raised in the thread waiting for the future
+        with self.assertRaises(RuntimeError):
+            future.result()
+        engine.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
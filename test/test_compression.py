@@ -0,0 +1,87 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import unittest
+
+import torch
+
+from pippy.Compression import CastCodec, Int8Codec, TopKCodec
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.x = torch.randn(4, 6, 8)
+
+    def round_trip(self, codec, tensor, key=0):
+        wire = codec.encode(tensor, key)
+        buffers = codec.wire_buffers(tensor)
+        # Encoded tensors fit the receive buffers
+        self.assertEqual(len(wire), len(buffers))
+        for w, b in zip(wire, buffers):
+            self.assertEqual(w.shape, b.shape)
+            self.assertEqual(w.dtype, b.dtype)
+            self.assertTrue(w.is_contiguous())
+            b.copy_(w)
+        self.assertEqual(
+            codec.wire_bytes(tensor),
+            sum(b.numel() * b.element_size() for b in buffers),
+        )
+        out = torch.empty_like(tensor)
+        codec.decode(buffers, out)
+        return out
+
+    def test_cast(self):
+        for dtype in (torch.bfloat16, torch.float16):
+            codec = CastCodec(dtype)
+            out = self.round_trip(codec, self.x)
+            torch.testing.assert_close(out, self.x.to(dtype).float())
+            self.assertEqual(codec.wire_bytes(self.x), self.x.numel() * 2)
+        with self.assertRaises(ValueError):
+            CastCodec(torch.int8)
+
+    def test_int8(self):
+        for per_channel in (False, True):
+            codec = Int8Codec(per_channel=per_channel)
+            out = self.round_trip(codec, self.x)
+            if per_channel:
+                scale = self.x.abs().amax(dim=(0, 1)) / 127
+            else:
+                scale = self.x.abs().max() / 127
+            # Rounding error of at most half a step
+            self.assertTrue(((out - self.x).abs() <= scale / 2 + 1e-6).all())
+        self.assertEqual(
+            Int8Codec(per_channel=True).wire_bytes(self.x),
+            self.x.numel() + 8 * 4,
+        )
+
+    def test_top_k(self):
+        codec = TopKCodec(ratio=0.25, error_feedback=False)
+        out = self.round_trip(codec, self.x)
+        k = self.x.numel() // 4
+        # The largest elements are kept, the others are zeros
+        kept = out != 0
+        self.assertEqual(kept.sum().item(), k)
+        self.assertGreaterEqual(
+            self.x[kept].abs().min(), self.x[~kept].abs().max()
+        )
+        torch.testing.assert_close(out[kept], self.x[kept])
+
+    def test_top_k_error_feedback(self):
+        codec = TopKCodec(ratio=0.1)
+        xs = [torch.randn(4, 6, 8) for _ in range(5)]
+        total = sum(self.round_trip(codec, x, key="a") for x in xs)
+        # Nothing is lost: what was not sent yet is in the residual
+        torch.testing.assert_close(
+            total + codec.residuals["a"].view(self.x.shape), sum(xs)
+        )
+        # Other keys have their own residuals
+        self.round_trip(codec, self.x, key="b")
+        self.assertEqual(set(codec.residuals), {"a", "b"})
+
+    def test_non_floating_point(self):
+        ids = torch.randint(0, 100, (4, 6))
+        for codec in (CastCodec(), Int8Codec(), TopKCodec()):
+            self.assertTrue(torch.equal(self.round_trip(codec, ids), ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import copy
+import unittest
+
+import torch
+
+from pippy import LocalPipeline, pipe_split, pipeline
+from pippy.PipelineSchedule import (
+    Schedule1F1B,
+    ScheduleGPipe,
+    ScheduleInterleaved1F1B,
+    ScheduleLoopedBFS,
+    ScheduleZeroBubbleH1,
+)
+
+
+d_hid = 16
+batch_size = 32
+chunks = 4
+
+
+class SkipModel(torch.nn.Module):
+    """
+    Four stages, with a skip connection from the first to the last one.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList(
+            [torch.nn.Linear(d_hid, d_hid) for _ in range(4)]
+        )
+
+    def forward(self, x, y=None):
+        x = torch.relu(self.layers[0](x))
+        if y is not None:
+            x = x + y
+        skip = x
+        pipe_split()
+        x = torch.relu(self.layers[1](x))
+        pipe_split()
+        x = torch.relu(self.layers[2](x))
+        pipe_split()
+        return self.layers[3](x) + skip
+
+
+class TestLocalPipeline(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.mod = SkipModel()
+        self.x = torch.randn(batch_size, d_hid)
+        self.target = torch.randn(batch_size, d_hid)
+        self.loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        ref_mod = copy.deepcopy(self.mod)
+        self.ref_out = ref_mod(self.x)
+        self.loss_fn(self.ref_out, self.target).backward()
+        self.ref_grads = {n: p.grad for n, p in ref_mod.named_parameters()}
+
+    def make_pipe(self):
+        return pipeline(
+            copy.deepcopy(self.mod),
+            chunks,
+            example_args=(self.x.chunk(chunks)[0],),
+        )
+
+    def check_grads(self, pipe):
+        for stage_index in range(pipe.num_stages):
+            stage_mod = pipe.get_stage_module(stage_index)
+            for name, p in stage_mod.named_parameters():
+                ref_name = pipe.remap_qualname(f"submod_{stage_index}.{name}")
+                torch.testing.assert_close(p.grad, self.ref_grads[ref_name])
+
+    def test_schedules(self):
+        for schedule_class, num_ranks in [
+            (ScheduleGPipe, None),
+            (Schedule1F1B, None),
+            (ScheduleZeroBubbleH1, None),
+            (ScheduleLoopedBFS, 2),
+            (ScheduleInterleaved1F1B, 2),
+        ]:
+            with self.subTest(schedule=schedule_class.__name__):
+                pipe = self.make_pipe()
+                runner = LocalPipeline(
+                    pipe,
+                    schedule_class,
+                    chunks,
+                    loss_fn=self.loss_fn,
+                    num_ranks=num_ranks,
+                )
+                losses = []
+                out = runner.step(self.x, target=self.target, losses=losses)
+                runner.shutdown()
+                torch.testing.assert_close(out, self.ref_out)
+                self.assertEqual(len(losses), chunks)
+                torch.testing.assert_close(
+                    sum(losses), self.loss_fn(self.ref_out, self.target)
+                )
+                self.check_grads(pipe)
+
+    def test_forward_only(self):
+        runner = LocalPipeline(self.make_pipe(), Schedule1F1B, chunks)
+        with torch.no_grad():
+            out = runner.step(self.x)
+        torch.testing.assert_close(out, self.ref_out.detach())
+        # Several steps with the same runner
+        torch.testing.assert_close(runner.step(self.x), self.ref_out)
+        runner.shutdown()
+
+    def test_values_released(self):
+        runner = LocalPipeline(
+            self.make_pipe(), ScheduleGPipe, chunks, self.loss_fn
+        )
+        # Outputs of the stages left once all the consumers read them
+        values_left = []
+        clear_runtime_states = runner._clear_runtime_states
+
+        def check_and_clear():
+            values_left.append(len(runner._values))
+            clear_runtime_states()
+
+        runner._clear_runtime_states = check_and_clear
+        runner.step(self.x, target=self.target)
+        self.assertEqual(values_left, [0])
+        runner.shutdown()
+
+    def test_kwargs(self):
+        y = torch.randn(batch_size, d_hid)
+        pipe = pipeline(
+            copy.deepcopy(self.mod),
+            chunks,
+            example_args=(self.x.chunk(chunks)[0],),
+            example_kwargs={"y": y.chunk(chunks)[0]},
+        )
+        runner = LocalPipeline(pipe, ScheduleGPipe, chunks)
+        torch.testing.assert_close(
+            runner.step(self.x, y=y), self.mod(self.x, y=y)
+        )
+        runner.shutdown()
+
+    def test_error(self):
+        def failing_loss(output, target):
+            raise RuntimeError("loss failed")
+
+        runner = LocalPipeline(
+            self.make_pipe(), Schedule1F1B, chunks, loss_fn=failing_loss
+        )
+        # The ranks waiting on the failed one are released
+        with self.assertRaisesRegex(RuntimeError, "loss failed"):
+            runner.step(self.x, target=self.target)
+        with self.assertRaises(ValueError):
+            runner.step(self.x)
+        runner.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,8 +4,12 @@ import unittest
 import torch
 
 from pippy.microbatch import (
+    _Replicate,
+    ChunkMerger,
     merge_chunks,
     split_args_kwargs_into_chunks,
+    SplitPlanCache,
+    sum_reducer,
     TensorChunkSpec,
 )
 
@@ -60,3 +64,73 @@ if __name__ == "__main__":
 class TestMicrobatch(unittest.TestCase):
     def test_microbatch(self):
         main()
+
+    def test_chunk_merger(self):
+        # Uneven chunks along dim 1, a loss and a non-sharded value
+        x = torch.randn(4, 10, d_hid)
+        x_chunks = torch.tensor_split(x, 3, dim=1)
+        losses = [torch.tensor(float(i)) for i in range(3)]
+        chunks = [
+            {"x": x_chunk, "loss": loss, "step": 7}
+            for x_chunk, loss in zip(x_chunks, losses)
+        ]
+        spec = {
+            "x": TensorChunkSpec(1),
+            "loss": sum_reducer,
+            "step": _Replicate,
+        }
+
+        merger = ChunkMerger(3, spec)
+        for chunk in chunks:
+            merger.add(chunk)
+        merged = merger.merge()
+        torch.testing.assert_close(merged, merge_chunks(chunks, spec))
+        torch.testing.assert_close(merged["x"], x)
+        self.assertEqual(merged["step"], 7)
+
+        # Default spec: dim 0 of every output
+        merger = ChunkMerger(3)
+        for x_chunk in torch.tensor_split(x, 3):
+            merger.add((x_chunk, x_chunk * 2))
+        torch.testing.assert_close(merger.merge(), (x, x * 2))
+
+        with self.assertRaises(RuntimeError):
+            ChunkMerger(3).merge()
+
+    def test_split_plan(self):
+        split_plans = SplitPlanCache()
+        args_chunk_spec = ((TensorChunkSpec(0), _Replicate), TensorChunkSpec(1))
+
+        def split(batch_size):
+            args = ([torch.randn(batch_size, d_hid), 3], torch.randn(2, 5))
+            kwargs = {"mask": torch.randn(batch_size), "scale": 0.5}
+            # Equal chunk specs, not the same objects
+            kwargs_chunk_spec = {
+                "mask": TensorChunkSpec(0),
+                "scale": _Replicate,
+            }
+            return split_args_kwargs_into_chunks(
+                args,
+                kwargs,
+                4,
+                args_chunk_spec,
+                kwargs_chunk_spec,
+                split_plans=split_plans,
+            )
+
+        split(10)
+        self.assertEqual(len(split_plans.plans), 1)
+        # Same structure: split with the same plan
+        arg_chunks, kwarg_chunks = split(10)
+        self.assertEqual(len(split_plans.plans), 1)
+        self.assertEqual(len(arg_chunks), 4)
+        self.assertEqual(arg_chunks[3][0][0].shape, torch.Size([2, d_hid]))
+        self.assertEqual(arg_chunks[0][0][1], 3)
+        self.assertEqual(arg_chunks[0][1].shape, torch.Size([2, 2]))
+        self.assertEqual(kwarg_chunks[0]["mask"].shape, torch.Size([3]))
+        self.assertEqual(kwarg_chunks[0]["scale"], 0.5)
+        # Other chunk boundaries: a new plan
+        arg_chunks, kwarg_chunks = split(8)
+        self.assertEqual(len(split_plans.plans), 2)
+        self.assertEqual(arg_chunks[3][0][0].shape, torch.Size([2, d_hid]))
+        self.assertEqual(kwarg_chunks[0]["mask"].shape, torch.Size([2]))
@@ -0,0 +1,85 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.nn as nn
+
+from pippy._offload import ActivationOffloader
+
+
+class TestActivationOffloader(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.mod = nn.Sequential(
+            nn.Linear(8, 8), nn.ReLU(), nn.Linear(8, 8), nn.Tanh()
+        )
+        self.x = torch.randn(4, 8)
+
+    def reference_grads(self):
+        self.mod.zero_grad()
+        self.mod(self.x).sum().backward()
+        grads = [p.grad.clone() for p in self.mod.parameters()]
+        self.mod.zero_grad()
+        return grads
+
+    def check_grads(self, ref_grads):
+        for p, ref_grad in zip(self.mod.parameters(), ref_grads):
+            torch.testing.assert_close(p.grad, ref_grad)
+
+    def test_offload_to_files(self):
+        ref_grads = self.reference_grads()
+        with tempfile.TemporaryDirectory() as offload_dir:
+            offloader = ActivationOffloader(torch.device("cpu"), offload_dir)
+            outputs = []
+            for chunk_id in range(2):
+                with offloader.save(chunk_id):
+                    outputs.append(self.mod(self.x))
+                offloader.offload(chunk_id)
+            # Saved activations are in files, parameters are not
+            n_files = len(os.listdir(offload_dir))
+            self.assertGreater(n_files, 0)
+            self.assertLess(n_files, 2 * len(list(self.mod.parameters())))
+
+            for chunk_id, output in enumerate(outputs):
+                offloader.prefetch(chunk_id)
+                output.sum().backward()
+                # Gradients accumulate over the chunks
+                self.check_grads([(chunk_id + 1) * g for g in ref_grads])
+            self.assertEqual(os.listdir(offload_dir), [])
+
+    def test_load_without_prefetch(self):
+        ref_grads = self.reference_grads()
+        offloader = ActivationOffloader(torch.device("cpu"))
+        with offloader.save(0):
+            output = self.mod(self.x)
+        offloader.offload(0)
+        output.sum().backward()
+        self.check_grads(ref_grads)
+
+    def test_clear(self):
+        with tempfile.TemporaryDirectory() as offload_dir:
+            offloader = ActivationOffloader(torch.device("cpu"), offload_dir)
+            with offloader.save(0):
+                self.mod(self.x)
+            offloader.offload(0)
+            offloader.clear()
+            self.assertEqual(os.listdir(offload_dir), [])
+
+    @unittest.skipIf(not torch.cuda.is_available(), "CUDA not available")
+    def test_offload_to_pinned_memory(self):
+        self.mod.cuda()
+        self.x = self.x.cuda()
+        ref_grads = self.reference_grads()
+        offloader = ActivationOffloader(torch.device("cuda"))
+        with offloader.save(0):
+            output = self.mod(self.x)
+        offloader.offload(0)
+        offloader.prefetch(0)
+        output.sum().backward()
+        self.check_grads(ref_grads)
+
+
+if __name__ == "__main__":
+    unittest.main()
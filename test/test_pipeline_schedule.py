@@ -1,6 +1,9 @@
 # (c) Meta Platforms, Inc. and affiliates. Confidential and proprietary.
 
+import copy
+import os
 import random
+import tempfile
 import time
 import unittest
 
@@ -8,10 +11,18 @@ import torch
 import torch.distributed as dist
 import torch.nn as nn
 
-from pippy import Schedule1F1B, ScheduleInterleaved1F1B
+from pippy import (
+    pipe_split,
+    pipeline,
+    PipelineStage,
+    Schedule1F1B,
+    ScheduleInterleaved1F1B,
+)
 
 from pippy.ManualPipelineStage import (
     create_metadata_tensor,
+    decode_metadata,
+    encode_metadata,
     extract_metadata_from_tensor,
     get_stage_shapes,
     ManualPipelineStage,
@@ -83,6 +94,23 @@ class MultiOutputArgMLP(nn.Module):
         return x, y
 
 
+class MixedOutputMLP(nn.Module):
+    """
+    Takes the outputs of the previous stage, if any, and returns a tensor of
+    another dtype and a dict holding an integer mask.
+    """
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.w1 = nn.Linear(dim, dim, bias=False)
+
+    def forward(self, x, extra=None):
+        if extra is not None:
+            x = x.float() * extra["mask"]
+        x = self.w1(x)
+        return x.double(), {"mask": (x > 0).long()}
+
+
 class InvalidOutputModel(nn.Module):
     def __init__(
         self,
@@ -124,6 +152,48 @@ class ModelWithSleep(nn.Module):
         return x
 
 
+class SkipMLP(nn.Module):
+    """
+    `n_layers` stages, with a skip connection from the first to the last one.
+    """
+
+    def __init__(self, dim: int, n_layers: int):
+        super().__init__()
+        self.layers = nn.ModuleList(
+            [nn.Linear(dim, dim) for _ in range(n_layers)]
+        )
+
+    def forward(self, x):
+        x = torch.relu(self.layers[0](x))
+        skip = torch.tanh(x)
+        for layer in self.layers[1:-1]:
+            pipe_split()
+            x = torch.relu(layer(x))
+        pipe_split()
+        return self.layers[-1](x) + skip
+
+
+class MulticastMLP(nn.Module):
+    """
+    `n_layers` stages, with a tensor of the first stage consumed by all the
+    others.
+    """
+
+    def __init__(self, dim: int, n_layers: int):
+        super().__init__()
+        self.layers = nn.ModuleList(
+            [nn.Linear(dim, dim) for _ in range(n_layers)]
+        )
+
+    def forward(self, x):
+        x = torch.relu(self.layers[0](x))
+        enc = torch.tanh(x)
+        for layer in self.layers[1:]:
+            pipe_split()
+            x = torch.relu(layer(x)) + enc
+        return x
+
+
 # Tests defined below
 ##########################
 
@@ -256,9 +326,10 @@ class TestPipelineSchedule(MultiProcessTestCase):
         )
         self.assertEqual(len(stages_shapes), 1)
         shapes = stages_shapes[self.rank]
-        self.assertEqual(len(shapes), 2)
+        self.assertEqual(len(shapes), 4)
         self.assertEqual(shapes["inputs"], [torch.Size([10, 8])])
         self.assertEqual(shapes["outputs"], [torch.Size([10, 8])])
+        self.assertTrue(shapes["output_meta"].is_meta)
 
         # test multiple models (multiple stages)
         model_chunk1 = MLP(dim=8, hidden_dim=4, out_dim=8)
@@ -278,6 +349,57 @@ class TestPipelineSchedule(MultiProcessTestCase):
         self.assertEqual(shapes["inputs"], [torch.Size([10, 8])])
         self.assertEqual(shapes["outputs"], [torch.Size([10, 8])])
 
+        # dtypes and structure of the outputs are passed to the next stage
+        stages_shapes = get_stage_shapes(
+            stage_modules=[MixedOutputMLP(dim=8)],
+            stage_ids=[self.rank],
+            num_stages=self.world_size,
+            rank=self.rank,
+            world_size=self.world_size,
+            device=device,
+            microbatch=microbatch if self.rank == 0 else None,
+        )
+        shapes = stages_shapes[self.rank]
+        if self.rank > 0:
+            x, extra = shapes["input_meta"]
+            self.assertEqual(x.dtype, torch.double)
+            self.assertEqual(extra["mask"].dtype, torch.long)
+            self.assertEqual(
+                shapes["inputs"], [torch.Size([10, 8]), torch.Size([10, 8])]
+            )
+
+    def test_get_stage_shapes_cache(self):
+        device = "cpu"
+        self.init_distributed()
+
+        model_chunk = MLP(dim=8, hidden_dim=4, out_dim=8)
+        num_calls = []
+        model_chunk.register_forward_hook(lambda *args: num_calls.append(1))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, f"shapes_{self.rank}.json")
+            for batch_size in (10, 10, 12):
+                microbatch = torch.rand((batch_size, 8), device=device)
+                stages_shapes = get_stage_shapes(
+                    stage_modules=[model_chunk],
+                    stage_ids=[self.rank],
+                    num_stages=self.world_size,
+                    rank=self.rank,
+                    world_size=self.world_size,
+                    device=device,
+                    microbatch=microbatch if self.rank == 0 else None,
+                    cache_file=cache_file,
+                )
+                shapes = stages_shapes[self.rank]
+                self.assertEqual(
+                    shapes["inputs"], [torch.Size([batch_size, 8])]
+                )
+                self.assertEqual(
+                    shapes["outputs"], [torch.Size([batch_size, 8])]
+                )
+        # The second call finds the shapes in the cache, the third one has
+        # another input signature
+        self.assertEqual(len(num_calls), 2)
+
     def test_validate_stage_shapes(self):
         device = "cpu"
         self.init_distributed()
@@ -474,6 +596,112 @@ class TestPipelineSchedule(MultiProcessTestCase):
             torch.cuda.synchronize()
             print(f"Finished with testing {num_microbatches} microbatches")
 
+    def test_interleaved_1f1b_skip_connections(self):
+        device = torch.device("cpu")
+        self.init_distributed()
+
+        dim = 8
+        microbatch_size = 2
+        num_stages = 2 * self.world_size
+        torch.manual_seed(0)
+        mod = SkipMLP(dim, num_stages)
+        loss_fn = nn.MSELoss(reduction="sum")
+
+        # P2P ops matched by tag (gloo) lift the requirement of a multiple of
+        # the number of ranks
+        for num_microbatches in (4, 6, 3):
+            x = torch.randn(num_microbatches * microbatch_size, dim)
+            target = torch.randn(num_microbatches * microbatch_size, dim)
+            ref_mod = copy.deepcopy(mod)
+            ref_out = ref_mod(x)
+            loss_fn(ref_out, target).backward()
+
+            pipe = pipeline(
+                copy.deepcopy(mod),
+                num_microbatches,
+                example_args=(x.chunk(num_microbatches)[0],),
+            )
+            stages = [
+                PipelineStage(pipe, stage_index, device=device)
+                for stage_index in range(self.rank, num_stages, self.world_size)
+            ]
+            schedule = ScheduleInterleaved1F1B(
+                stages, num_microbatches, loss_fn=loss_fn
+            )
+            if self.rank == 0:
+                schedule.step(x)
+            elif self.rank == self.world_size - 1:
+                out = schedule.step(target=target)
+                torch.testing.assert_close(out, ref_out)
+            else:
+                schedule.step()
+
+            for stage in stages:
+                stage_mod = pipe.get_stage_module(stage.stage_index)
+                for name, p in stage_mod.named_parameters():
+                    ref_name = pipe.remap_qualname(
+                        f"submod_{stage.stage_index}.{name}"
+                    )
+                    torch.testing.assert_close(
+                        p.grad, ref_mod.get_parameter(ref_name).grad
+                    )
+            dist.barrier()
+
+    def test_multicast(self):
+        device = torch.device("cpu")
+        self.init_distributed()
+
+        dim = 8
+        num_microbatches = 4
+        torch.manual_seed(0)
+        mod = MulticastMLP(dim, self.world_size)
+        loss_fn = nn.MSELoss(reduction="sum")
+        x = torch.randn(num_microbatches * 2, dim)
+        target = torch.randn(num_microbatches * 2, dim)
+        ref_mod = copy.deepcopy(mod)
+        ref_out = ref_mod(x)
+        loss_fn(ref_out, target).backward()
+
+        for multicast in (False, True):
+            pipe = pipeline(
+                copy.deepcopy(mod),
+                num_microbatches,
+                example_args=(x.chunk(num_microbatches)[0],),
+            )
+            stage = PipelineStage(
+                pipe, self.rank, device=device, multicast=multicast
+            )
+            # The first stage sends `enc` to one stage with multicast, to
+            # all others otherwise
+            if self.rank == 0:
+                dsts = sorted(len(d) for d in stage.act_send_info.values())
+                self.assertEqual(
+                    dsts, [1, 1] if multicast else [1, self.world_size - 1]
+                )
+            elif multicast and self.rank < self.world_size - 1:
+                self.assertEqual(
+                    list(stage.act_relay_info.values()), [[self.rank + 1]]
+                )
+            else:
+                self.assertEqual(stage.act_relay_info, {})
+
+            schedule = Schedule1F1B(stage, num_microbatches, loss_fn=loss_fn)
+            if self.rank == 0:
+                schedule.step(x)
+            elif self.rank == self.world_size - 1:
+                out = schedule.step(target=target)
+                torch.testing.assert_close(out, ref_out)
+            else:
+                schedule.step()
+
+            stage_mod = pipe.get_stage_module(self.rank)
+            for name, p in stage_mod.named_parameters():
+                ref_name = pipe.remap_qualname(f"submod_{self.rank}.{name}")
+                torch.testing.assert_close(
+                    p.grad, ref_mod.get_parameter(ref_name).grad
+                )
+            dist.barrier()
+
     def test_check_inputs(self):
         device = (
             torch.device(f"cuda:{self.rank}")
@@ -540,6 +768,23 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(shapes[2], t3.shape)
         self.assertEqual(shapes[3], t4.shape)
 
+    def test_encode_metadata(self):
+        value = (
+            torch.ones((3, 4, 5, 6, 7, 8)),
+            {"mask": torch.tensor([1, 0]), "scale": 2.0},
+            [torch.tensor(1, dtype=torch.bfloat16)],
+        )
+        decoded = decode_metadata(encode_metadata(value))
+        self.assertIsInstance(decoded, tuple)
+        for t, ref in zip(
+            (decoded[0], decoded[1]["mask"], decoded[2][0]),
+            (value[0], value[1]["mask"], value[2][0]),
+        ):
+            self.assertTrue(t.is_meta)
+            self.assertEqual(t.shape, ref.shape)
+            self.assertEqual(t.dtype, ref.dtype)
+        self.assertEqual(decoded[1]["scale"], 2.0)
+
 
 if __name__ == "__main__":
     unittest.main()
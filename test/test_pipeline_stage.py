@@ -1,18 +1,33 @@
 # (c) Meta Platforms, Inc. and affiliates. Confidential and proprietary.
 
+import copy
 import unittest
+from typing import List
 
 import torch
 import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 
 from pippy import (
     annotate_split_points,
+    CastCodec,
+    ChunkedCrossEntropyLoss,
+    Int8Codec,
     ManualPipelineStage,
+    measure_links,
+    pipe_split,
     pipeline,
     PipelineStage,
+    Schedule1F1B,
     ScheduleGPipe,
+    ScheduleLoopedBFS,
+    ScheduleZeroBubbleH1,
+    SharedMemoryTransport,
     SplitPoint,
+    TopKCodec,
+    VocabParallelCrossEntropyLoss,
+    warmup_p2p,
 )
 
 # torch.testing._internal.common_distributed requires "expecttest"
@@ -46,6 +61,69 @@ class MLP(nn.Module):
         return x
 
 
+class TwoStreamMLP(nn.Module):
+    """
+    Passes two tensors of different dtypes across each stage boundary.
+    """
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.w1 = nn.Linear(dim, dim)
+        self.w2 = nn.Linear(dim, dim).double()
+
+    def forward(self, x, y):
+        return torch.relu(self.w1(x)), torch.relu(self.w2(y))
+
+
+class DropoutMLP(nn.Module):
+    def __init__(self, dim: int):
+        super().__init__()
+        self.w1 = nn.Linear(dim, dim)
+        self.dropout = nn.Dropout(0.5)
+        self.w2 = nn.Linear(dim, dim)
+
+    def forward(self, x):
+        return torch.relu(self.w2(self.dropout(self.w1(x))))
+
+
+class MaskedMLP(nn.Module):
+    """
+    Passes an integer mask and a detached scale next to the activation
+    across the stage boundary: neither gets a gradient back.
+    """
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.w1 = nn.Linear(dim, dim)
+        self.w2 = nn.Linear(dim, dim)
+
+    def forward(self, x):
+        h = self.w1(x)
+        mask = (h > 0).long()
+        scale = h.detach().norm(dim=-1, keepdim=True)
+        pipe_split()
+        return self.w2(h * mask) / scale
+
+
+class ChainMLP(nn.Module):
+    """
+    `n_layers` stages of one layer each.
+    """
+
+    def __init__(self, dim: int, n_layers: int):
+        super().__init__()
+        self.layers = nn.ModuleList(
+            [nn.Linear(dim, dim) for _ in range(n_layers)]
+        )
+
+    def forward(self, x):
+        for i, layer in enumerate(self.layers):
+            if i > 0:
+                pipe_split()
+            x = torch.relu(layer(x))
+        return x
+
+
 # Tests defined below
 ##########################
 
@@ -146,6 +224,746 @@ class TestPipelineStage(MultiProcessTestCase):
         else:
             schedule.step()
 
+    @parametrize("flat_p2p", [True, False])
+    def test_flat_p2p(self, flat_p2p):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        batch_size = 32
+        chunks = 4
+        # Same weights on every rank, so that each rank can run a reference
+        torch.manual_seed(0)
+        mods = [TwoStreamMLP(dim) for _ in range(self.world_size)]
+        ref_mods = [TwoStreamMLP(dim) for _ in range(self.world_size)]
+        for mod, ref_mod in zip(mods, ref_mods):
+            ref_mod.load_state_dict(mod.state_dict())
+
+        x = torch.randn(batch_size, dim)
+        y = torch.randn(batch_size, dim, dtype=torch.double)
+        target = torch.randn(batch_size, dim)
+
+        def loss_fn(output, target):
+            return sum(
+                torch.nn.functional.mse_loss(
+                    o, target.to(o.dtype), reduction="sum"
+                )
+                for o in output
+            )
+
+        stage = ManualPipelineStage(
+            mods[self.rank],
+            self.rank,
+            self.world_size,
+            device,
+            chunks,
+            input_args=[x.chunk(chunks)[0], y.chunk(chunks)[0]],
+            flat_p2p=flat_p2p,
+        )
+        schedule = ScheduleGPipe(stage, chunks, loss_fn=loss_fn)
+        if self.rank == 0:
+            schedule.step(x, y)
+        else:
+            output = schedule.step(target=target)
+
+        # Reference
+        ref_out = (x, y)
+        for ref_mod in ref_mods:
+            ref_out = ref_mod(*ref_out)
+        loss_fn(ref_out, target).backward()
+
+        if self.rank == self.world_size - 1:
+            for out, ref in zip(output, ref_out):
+                torch.testing.assert_close(out, ref)
+        for name, p in mods[self.rank].named_parameters():
+            torch.testing.assert_close(
+                p.grad, ref_mods[self.rank].get_parameter(name).grad
+            )
+
+        # One message per peer with `flat_p2p`, and the ops are built once
+        if self.rank != 0:
+            ops = stage.get_fwd_recv_ops(0)
+            self.assertEqual(len(ops), 1 if flat_p2p else 2)
+            self.assertIs(stage.get_fwd_recv_ops(0), ops)
+            self.assertEqual(
+                len(stage.get_bwd_send_ops()), 1 if flat_p2p else 2
+            )
+
+    def test_change_num_microbatches(self):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        microbatch_size = 4
+        torch.manual_seed(0)
+        mods = [MLP(dim, dim, dim) for _ in range(self.world_size)]
+        mod = mods[self.rank]
+        loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        # The stage is created for 2 microbatches, then reused with more
+        stage = ManualPipelineStage(
+            mod,
+            self.rank,
+            self.world_size,
+            device,
+            2,
+            input_args=torch.randn(microbatch_size, dim),
+        )
+        for chunks in (2, 8, 16):
+            x = torch.randn(chunks * microbatch_size, dim)
+            target = torch.randn(chunks * microbatch_size, dim)
+
+            # Reference
+            ref_out = x
+            for ref_mod in mods:
+                ref_out = ref_mod(ref_out)
+            loss_fn(ref_out, target).backward()
+            ref_grads = [p.grad.clone() for p in mod.parameters()]
+            for ref_mod in mods:
+                ref_mod.zero_grad()
+
+            schedule = Schedule1F1B(stage, chunks, loss_fn=loss_fn)
+            if self.rank == 0:
+                schedule.step(x)
+            else:
+                schedule.step(target=target)
+            for p, ref_grad in zip(mod.parameters(), ref_grads):
+                torch.testing.assert_close(p.grad, ref_grad)
+            mod.zero_grad()
+            # Buffers are recycled instead of allocated per microbatch
+            self.assertLessEqual(
+                len(stage.args_recv_info) + len(stage.grad_recv_info), 4
+            )
+
+    @parametrize("pipeline_stage_type", ["manual", "tracing"])
+    def test_dynamic_shapes(self, pipeline_stage_type):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        chunks = 4
+        torch.manual_seed(0)
+        mods = [MLP(dim, dim, dim) for _ in range(self.world_size)]
+        ref_mod = nn.Sequential(*copy.deepcopy(mods))
+        loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        if pipeline_stage_type == "tracing":
+            model = nn.Sequential(*mods)
+            annotate_split_points(model, {"0": SplitPoint.END})
+            pipe = pipeline(
+                model,
+                chunks,
+                example_args=(torch.randn(8 * chunks, dim),),
+                dynamic_shapes=({0: torch.export.Dim("batch")},),
+            )
+            stage = PipelineStage(pipe, self.rank, device)
+        elif pipeline_stage_type == "manual":
+            stage = ManualPipelineStage(
+                mods[self.rank],
+                self.rank,
+                self.world_size,
+                device,
+                chunks,
+                input_args=torch.randn(8, dim),
+                dynamic_shapes=True,
+            )
+        else:
+            raise ValueError(
+                f"Unknown pipeline stage type {pipeline_stage_type}"
+            )
+        self.assertTrue(stage.dynamic_shapes)
+        schedule = Schedule1F1B(stage, chunks, loss_fn=loss_fn)
+
+        # Microbatches of 8, 3, 5 rows, then of 3 and 2 rows in one step
+        for batch_size in (32, 12, 20, 10):
+            x = torch.randn(batch_size, dim)
+            target = torch.randn(batch_size, dim)
+            if self.rank == 0:
+                schedule.step(x)
+            else:
+                out = schedule.step(target=target)
+                with torch.no_grad():
+                    torch.testing.assert_close(out, ref_mod(x))
+
+        if self.rank == 1:
+            # Microbatches of 80, 30, 50 and 20 elements share 3 buckets
+            for storage in stage._recv_storage.values():
+                buckets = {key[2] for key in storage if not key[0]}
+                self.assertLessEqual(buckets, {32, 64, 128})
+
+    @parametrize("recompute", ["stage", "submodules"])
+    def test_recompute(self, recompute):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        chunks = 4
+        torch.manual_seed(0)
+        mod = DropoutMLP(dim)
+        x = torch.randn(chunks * 4, dim)
+        target = torch.randn(chunks * 4, dim)
+
+        grads = []
+        for stage_recompute in (
+            False,
+            True if recompute == "stage" else ["w1", "dropout"],
+        ):
+            stage = ManualPipelineStage(
+                copy.deepcopy(mod),
+                self.rank,
+                self.world_size,
+                device,
+                chunks,
+                input_args=x.chunk(chunks)[0],
+                recompute=stage_recompute,
+            )
+            schedule = Schedule1F1B(
+                stage, chunks, loss_fn=torch.nn.MSELoss(reduction="sum")
+            )
+            # Same dropout masks with and without recomputation
+            torch.manual_seed(self.rank)
+            if self.rank == 0:
+                schedule.step(x)
+            else:
+                schedule.step(target=target)
+            self.assertEqual(len(stage.recompute_cache), 0)
+            grads.append([p.grad for p in stage.submod.parameters()])
+
+        for grad, ref_grad in zip(grads[1], grads[0]):
+            torch.testing.assert_close(grad, ref_grad)
+
+    def test_offload(self):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        chunks = 8
+        torch.manual_seed(0)
+        mod = MLP(dim, dim, dim)
+        x = torch.randn(chunks * 4, dim)
+        target = torch.randn(chunks * 4, dim)
+
+        grads = []
+        for offload in (False, True):
+            stage = ManualPipelineStage(
+                copy.deepcopy(mod),
+                self.rank,
+                self.world_size,
+                device,
+                chunks,
+                input_args=x.chunk(chunks)[0],
+                offload=offload,
+            )
+            schedule = ScheduleGPipe(
+                stage, chunks, loss_fn=torch.nn.MSELoss(reduction="sum")
+            )
+            if self.rank == 0:
+                schedule.step(x)
+            else:
+                schedule.step(target=target)
+            grads.append([p.grad for p in stage.submod.parameters()])
+
+        for grad, ref_grad in zip(grads[1], grads[0]):
+            torch.testing.assert_close(grad, ref_grad)
+
+    @parametrize("codec", ["cast", "int8", "topk"])
+    @parametrize("flat_p2p", [True, False])
+    def test_codec(self, codec, flat_p2p):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        chunks = 4
+        torch.manual_seed(0)
+        mods = [TwoStreamMLP(dim) for _ in range(self.world_size)]
+        mod = mods[self.rank]
+        x = torch.randn(chunks * 4, dim)
+        y = torch.randn(chunks * 4, dim, dtype=torch.double)
+        target = torch.randn(chunks * 4, dim)
+
+        def loss_fn(out, target):
+            return torch.nn.functional.mse_loss(
+                out[0], target, reduction="sum"
+            ) + torch.nn.functional.mse_loss(
+                out[1].float(), target, reduction="sum"
+            )
+
+        # Reference
+        ref_out = (x, y)
+        for ref_mod in mods:
+            ref_out = ref_mod(*ref_out)
+        loss_fn(ref_out, target).backward()
+        ref_grads = [p.grad.clone() for p in mod.parameters()]
+        mod.zero_grad()
+
+        if codec == "cast":
+            act_codec, grad_codec, atol = CastCodec(), CastCodec(), 0.1
+        elif codec == "int8":
+            act_codec, grad_codec = Int8Codec(per_channel=True), Int8Codec()
+            atol = 0.1
+        else:
+            # Sending all elements is lossless
+            act_codec, grad_codec, atol = None, TopKCodec(ratio=1.0), 1e-5
+
+        stage = ManualPipelineStage(
+            mod,
+            self.rank,
+            self.world_size,
+            device,
+            chunks,
+            input_args=(x.chunk(chunks)[0], y.chunk(chunks)[0]),
+            flat_p2p=flat_p2p,
+            act_codec=act_codec,
+            grad_codec=grad_codec,
+        )
+        schedule = ScheduleGPipe(stage, chunks, loss_fn=loss_fn)
+        if self.rank == 0:
+            schedule.step(x, y)
+        else:
+            out = schedule.step(target=target)
+            for o, ref_o in zip(out, ref_out):
+                torch.testing.assert_close(
+                    o, ref_o.detach(), atol=atol, rtol=0.1
+                )
+        for p, ref_grad in zip(mod.parameters(), ref_grads):
+            torch.testing.assert_close(
+                p.grad, ref_grad, atol=atol * 10, rtol=0.1
+            )
+
+    @parametrize("codec", [False, True])
+    @parametrize("flat_p2p", [False, True])
+    def test_shared_memory_transport(self, codec, flat_p2p):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+        transport = SharedMemoryTransport()
+        # Both processes of the test run on this host
+        self.assertEqual(transport.local_peers, {1 - self.rank})
+
+        dim = 10
+        chunks = 4
+        torch.manual_seed(0)
+        mods = [TwoStreamMLP(dim) for _ in range(self.world_size)]
+        mod = mods[self.rank]
+        x = torch.randn(chunks * 4, dim)
+        y = torch.randn(chunks * 4, dim, dtype=torch.double)
+        target = torch.randn(chunks * 4, dim)
+
+        def loss_fn(out, target):
+            return torch.nn.functional.mse_loss(
+                out[0], target, reduction="sum"
+            ) + torch.nn.functional.mse_loss(
+                out[1].float(), target, reduction="sum"
+            )
+
+        # Reference
+        ref_out = (x, y)
+        for ref_mod in mods:
+            ref_out = ref_mod(*ref_out)
+        loss_fn(ref_out, target).backward()
+        ref_grads = [p.grad.clone() for p in mod.parameters()]
+        mod.zero_grad()
+
+        # Lossless codec, to cover the wire buffers
+        act_codec = TopKCodec(ratio=1.0) if codec else None
+        stage = ManualPipelineStage(
+            mod,
+            self.rank,
+            self.world_size,
+            device,
+            chunks,
+            input_args=(x.chunk(chunks)[0], y.chunk(chunks)[0]),
+            flat_p2p=flat_p2p,
+            act_codec=act_codec,
+            transport=transport,
+        )
+        schedule = Schedule1F1B(stage, chunks, loss_fn=loss_fn)
+        # Twice, reusing the receive buffers
+        for _ in range(2):
+            mod.zero_grad()
+            if self.rank == 0:
+                schedule.step(x, y)
+            else:
+                out = schedule.step(target=target)
+                for o, ref_o in zip(out, ref_out):
+                    torch.testing.assert_close(o, ref_o.detach())
+            for p, ref_grad in zip(mod.parameters(), ref_grads):
+                torch.testing.assert_close(p.grad, ref_grad)
+        transport.close()
+
+    def test_no_grad_outputs(self):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        batch_size = 32
+        chunks = 4
+        torch.manual_seed(0)
+        mod = MaskedMLP(dim)
+        ref_mod = copy.deepcopy(mod)
+        x = torch.randn(batch_size, dim)
+        target = torch.randn(batch_size, dim)
+        loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        pipe = pipeline(mod, chunks, example_args=(x.chunk(chunks)[0],))
+        stage = PipelineStage(pipe, self.rank, device)
+        schedule = Schedule1F1B(stage, chunks, loss_fn=loss_fn)
+        if self.rank == 0:
+            schedule.step(x)
+        else:
+            schedule.step(target=target)
+
+        # Only the gradient of the activation crosses the boundary
+        if self.rank == 0:
+            self.assertEqual(len(stage._get_grad_recv_info(0)), 1)
+        else:
+            self.assertEqual(len(stage.args_recv_info[0]), 3)
+            self.assertEqual(
+                sum(dst is not None for dst in stage.grad_send_info), 1
+            )
+
+        loss_fn(ref_mod(x), target).backward()
+        stage_mod = pipe.get_stage_module(self.rank)
+        for name, p in stage_mod.named_parameters():
+            ref_name = pipe.remap_qualname(f"submod_{self.rank}.{name}")
+            torch.testing.assert_close(
+                p.grad, ref_mod.get_parameter(ref_name).grad
+            )
+
+    def test_retained_state(self):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        batch_size = 32
+        chunks = 4
+        torch.manual_seed(0)
+        mod = MaskedMLP(dim)
+        ref_mod = copy.deepcopy(mod)
+        x = torch.randn(batch_size, dim)
+        target = torch.randn(batch_size, dim)
+        loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        pipe = pipeline(mod, chunks, example_args=(x.chunk(chunks)[0],))
+        stage = PipelineStage(pipe, self.rank, device)
+        schedule = ScheduleGPipe(stage, chunks, loss_fn=loss_fn)
+        if self.rank == 0:
+            schedule.step(x)
+        else:
+            out = schedule.step(target=target)
+
+        # Nothing outlives the step: the outputs are merged as they come
+        self.assertEqual(stage.fwd_send_outputs, {})
+        self.assertEqual(stage.output_chunks, [])
+        self.assertIsNone(stage.output_merger)
+        if self.rank == 0:
+            self.assertEqual(stage.retained_bytes(), 0)
+        else:
+            # All forwards run first: the last stage keeps the output and
+            # the received activation of every chunk, but not the mask and
+            # the scale, which get no gradient
+            activation_bytes = batch_size // chunks * dim * 4
+            self.assertEqual(
+                stage.peak_retained_bytes, chunks * 2 * activation_bytes
+            )
+
+        loss_fn(ref_mod(x), target).backward()
+        if self.rank == 1:
+            torch.testing.assert_close(out, ref_mod(x))
+        stage_mod = pipe.get_stage_module(self.rank)
+        for name, p in stage_mod.named_parameters():
+            ref_name = pipe.remap_qualname(f"submod_{self.rank}.{name}")
+            torch.testing.assert_close(
+                p.grad, ref_mod.get_parameter(ref_name).grad
+            )
+
+    @parametrize("pipeline_stage_type", ["manual", "tracing"])
+    def test_warmup(self, pipeline_stage_type):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        batch_size = 32
+        chunks = 2
+        torch.manual_seed(0)
+        model = MLP(dim, dim, dim)
+        x = torch.randn(batch_size, dim)
+        if pipeline_stage_type == "tracing":
+            annotate_split_points(model, {"w1": SplitPoint.END})
+            pipe = pipeline(model, chunks, example_args=(x.chunk(chunks)[0],))
+            stage = PipelineStage(pipe, self.rank, device, warmup=True)
+        else:
+            stage = ManualPipelineStage(
+                model,
+                self.rank,
+                self.world_size,
+                device,
+                chunks,
+                input_args=x.chunk(chunks)[0],
+                warmup=True,
+            )
+        peer = 1 - self.rank
+        self.assertEqual(list(stage.p2p_warmup_latency), [peer])
+        self.assertEqual(list(warmup_p2p([stage])), [peer])
+
+        # The stage still runs after the warmup
+        schedule = ScheduleGPipe(stage, chunks)
+        if self.rank == 0:
+            schedule.step(x)
+        else:
+            schedule.step()
+
+        # A rank running several stages must warm them up together
+        with self.assertRaises(ValueError):
+            ManualPipelineStage(
+                MLP(dim, dim, dim),
+                self.rank,
+                2 * self.world_size,
+                device,
+                chunks,
+                input_args=x.chunk(chunks)[0],
+                warmup=True,
+            )
+
+    def test_placement(self):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        batch_size = 32
+        chunks = 4
+        torch.manual_seed(0)
+        mod = ChainMLP(dim, 2 * self.world_size)
+        ref_mod = copy.deepcopy(mod)
+        x = torch.randn(batch_size, dim)
+        target = torch.randn(batch_size, dim)
+        loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        # V shape: stages 1 and 2 exchange tensors within rank 1
+        placement = [0, 1, 1, 0]
+        pipe = pipeline(mod, chunks, example_args=(x.chunk(chunks)[0],))
+        stages = [
+            PipelineStage(pipe, i, device, placement=placement)
+            for i in range(pipe.num_stages)
+            if placement[i] == self.rank
+        ]
+        schedule = ScheduleLoopedBFS(stages, chunks, loss_fn=loss_fn)
+        if self.rank == 0:
+            out = schedule.step(x, target=target)
+        else:
+            schedule.step()
+
+        ref_out = ref_mod(x)
+        loss_fn(ref_out, target).backward()
+        if self.rank == 0:
+            torch.testing.assert_close(out, ref_out)
+        for stage in stages:
+            stage_mod = pipe.get_stage_module(stage.stage_index)
+            for name, p in stage_mod.named_parameters():
+                ref_name = pipe.remap_qualname(
+                    f"submod_{stage.stage_index}.{name}"
+                )
+                torch.testing.assert_close(
+                    p.grad, ref_mod.get_parameter(ref_name).grad
+                )
+
+        # The stage must be placed on this rank
+        with self.assertRaises(ValueError):
+            PipelineStage(
+                pipe,
+                placement.index(1 - self.rank),
+                device,
+                placement=placement,
+            )
+        with self.assertRaises(ValueError):
+            PipelineStage(pipe, self.rank, device, placement=[0, 1])
+
+    def test_measure_links(self):
+        self.init_distributed(use_cuda=False)
+        links = measure_links(torch.device("cpu"), nbytes=1024, iters=2)
+        self.assertEqual(links.num_ranks, self.world_size)
+        peer = 1 - self.rank
+        self.assertGreater(links.latency[self.rank][peer], 0)
+        self.assertGreater(links.bandwidth[peer][self.rank], 0)
+        self.assertEqual(links.transfer_time(peer, peer, 1024), 0)
+
+    def test_comm_thread(self):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        batch_size = 32
+        chunks = 8
+        torch.manual_seed(0)
+        mods = [MLP(dim, dim, dim) for _ in range(self.world_size)]
+        ref_mods = copy.deepcopy(mods)
+        x = torch.randn(batch_size, dim)
+        target = torch.randn(batch_size, dim)
+        loss_fn = torch.nn.MSELoss(reduction="sum")
+
+        stage = ManualPipelineStage(
+            mods[self.rank],
+            self.rank,
+            self.world_size,
+            device,
+            chunks,
+            input_args=x.chunk(chunks)[0],
+        )
+        schedule = Schedule1F1B(
+            stage, chunks, loss_fn=loss_fn, comm_thread=True
+        )
+        # Several steps with the same thread
+        for _ in range(2):
+            if self.rank == 0:
+                schedule.step(x)
+            else:
+                out = schedule.step(target=target)
+
+        ref_out = x
+        for ref_mod in ref_mods:
+            ref_out = ref_mod(ref_out)
+        (2 * loss_fn(ref_out, target)).backward()
+        if self.rank == self.world_size - 1:
+            torch.testing.assert_close(out, ref_out)
+        for p, ref_p in zip(
+            mods[self.rank].parameters(), ref_mods[self.rank].parameters()
+        ):
+            torch.testing.assert_close(p.grad, ref_p.grad)
+
+    @parametrize("schedule_class", [Schedule1F1B, ScheduleZeroBubbleH1])
+    def test_chunked_loss(self, schedule_class):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        vocab = 13
+        batch_size = 32
+        chunks = 4
+        torch.manual_seed(0)
+        mods = [MLP(dim, dim, dim) for _ in range(self.world_size)]
+        head = nn.Linear(dim, vocab)
+        ref_mods = copy.deepcopy(mods)
+        ref_head = copy.deepcopy(head)
+        x = torch.randn(batch_size, dim)
+        target = torch.randint(vocab, (batch_size,))
+
+        stage = ManualPipelineStage(
+            mods[self.rank],
+            self.rank,
+            self.world_size,
+            device,
+            chunks,
+            input_args=x.chunk(chunks)[0],
+        )
+        schedule = schedule_class(
+            stage, chunks, loss_fn=ChunkedCrossEntropyLoss(head, chunk_size=3)
+        )
+        losses: List[torch.Tensor] = []
+        if self.rank == 0:
+            out = schedule.step(x)
+        else:
+            out = schedule.step(target=target, losses=losses)
+        # Only the losses are kept
+        self.assertIsNone(out)
+        self.assertEqual(stage.output_chunks, [])
+
+        ref_out = x
+        for ref_mod in ref_mods:
+            ref_out = ref_mod(ref_out)
+        ref_losses = [
+            F.cross_entropy(ref_head(out_mb), target_mb)
+            for out_mb, target_mb in zip(
+                ref_out.chunk(chunks), target.chunk(chunks)
+            )
+        ]
+        sum(ref_losses).backward()
+        if self.rank == self.world_size - 1:
+            for loss, ref_loss in zip(losses, ref_losses):
+                torch.testing.assert_close(loss, ref_loss)
+            torch.testing.assert_close(head.weight.grad, ref_head.weight.grad)
+            torch.testing.assert_close(head.bias.grad, ref_head.bias.grad)
+        for p, ref_p in zip(
+            mods[self.rank].parameters(), ref_mods[self.rank].parameters()
+        ):
+            torch.testing.assert_close(p.grad, ref_p.grad)
+
+    @parametrize("schedule_class", [ScheduleGPipe, Schedule1F1B])
+    def test_vocab_parallel(self, schedule_class):
+        device = torch.device("cpu")
+        self.init_distributed(use_cuda=False)
+
+        dim = 10
+        vocab = 13
+        batch_size = 32
+        chunks = 4
+        torch.manual_seed(0)
+        mods = [MLP(dim, dim, dim) for _ in range(self.world_size)]
+        head = nn.Linear(dim, vocab)
+        ref_mods = copy.deepcopy(mods)
+        ref_head = copy.deepcopy(head)
+        x = torch.randn(batch_size, dim)
+        target = torch.randint(vocab, (batch_size,))
+        target[:3] = -100
+
+        stage = ManualPipelineStage(
+            mods[self.rank],
+            self.rank,
+            self.world_size,
+            device,
+            chunks,
+            input_args=x.chunk(chunks)[0],
+        )
+        loss_fn = VocabParallelCrossEntropyLoss(head)
+        schedule = schedule_class(stage, chunks, loss_fn=loss_fn)
+        losses: List[torch.Tensor] = []
+        # Several steps, with the same slices
+        for _ in range(2):
+            if self.rank == 0:
+                out = schedule.step(x)
+            else:
+                out = schedule.step(target=target, losses=losses)
+            self.assertIsNone(out)
+
+        ref_out = x
+        for ref_mod in ref_mods:
+            ref_out = ref_mod(ref_out)
+        ref_losses = [
+            F.cross_entropy(ref_head(out_mb), target_mb)
+            for out_mb, target_mb in zip(
+                ref_out.chunk(chunks), target.chunk(chunks)
+            )
+        ]
+        (2 * sum(ref_losses)).backward()
+        if self.rank == self.world_size - 1:
+            self.assertEqual(len(losses), chunks)
+            for loss, ref_loss in zip(losses, ref_losses):
+                torch.testing.assert_close(loss, ref_loss)
+        # Each rank has the gradients of its slice of the vocabulary
+        self.assertLess(loss_fn.vocab_start, loss_fn.vocab_end)
+        vocab_slice = slice(loss_fn.vocab_start, loss_fn.vocab_end)
+        torch.testing.assert_close(
+            loss_fn.weight.grad, ref_head.weight.grad[vocab_slice]
+        )
+        torch.testing.assert_close(
+            loss_fn.bias.grad, ref_head.bias.grad[vocab_slice]
+        )
+        for p, ref_p in zip(
+            mods[self.rank].parameters(), ref_mods[self.rank].parameters()
+        ):
+            torch.testing.assert_close(p.grad, ref_p.grad)
+
+    def test_recompute_unknown_submodule(self):
+        self.init_distributed(use_cuda=False)
+        with self.assertRaises(ValueError):
+            ManualPipelineStage(
+                DropoutMLP(10),
+                self.rank,
+                self.world_size,
+                torch.device("cpu"),
+                2,
+                input_args=torch.randn(4, 10),
+                recompute=["w3"],
+            )
+
 
 instantiate_parametrized_tests(TestPipelineStage)
 
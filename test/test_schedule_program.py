@@ -0,0 +1,486 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import unittest
+from collections import Counter
+
+from pippy.PipelineSchedule import (
+    _1f1b_program,
+    _Action,
+    _COMM_TYPES,
+    _gpipe_program,
+    _interleaved_1f1b_program,
+    _looped_bfs_program,
+    _num_recv_slots,
+    _without_prefetch,
+    _zero_bubble_h1_program,
+    BACKWARD,
+    BACKWARD_INPUT,
+    BACKWARD_WEIGHT,
+    FORWARD,
+    RECV_B,
+    RECV_F,
+    SEND_B,
+    SEND_F,
+)
+
+
+def single_stage_programs(program_fn, n_microbatches, num_stages, has_backward):
+    return {
+        rank: program_fn(n_microbatches, num_stages, rank, has_backward)
+        for rank in range(num_stages)
+    }
+
+
+def looped_bfs_programs(n_microbatches, group_size, n_local, has_backward):
+    num_stages = group_size * n_local
+    return {
+        rank: _looped_bfs_program(
+            n_microbatches,
+            num_stages,
+            tuple(range(rank, num_stages, group_size)),
+            has_backward,
+        )
+        for rank in range(group_size)
+    }
+
+
+def interleaved_programs(n_microbatches, group_size, n_local, has_backward):
+    num_stages = group_size * n_local
+    return {
+        rank: _interleaved_1f1b_program(
+            n_microbatches,
+            num_stages,
+            group_size,
+            rank,
+            tuple(range(rank, num_stages, group_size)),
+            has_backward,
+        )
+        for rank in range(group_size)
+    }
+
+
+def replay(programs, num_stages):
+    """
+    Replay the per-rank programs with the executor semantics: comm actions are
+    issued at the next computation, and a computation blocks until the send it
+    depends on has been issued. Raises if the programs cannot finish.
+    """
+    pcs = {rank: 0 for rank in programs}
+    pending = {rank: [] for rank in programs}
+    issued = set()
+    posted_recvs = set()
+
+    def flush(rank):
+        for action in pending[rank]:
+            if action.computation_type in (SEND_F, SEND_B):
+                issued.add(action)
+            else:
+                posted_recvs.add(action)
+        pending[rank].clear()
+
+    progress = True
+    while progress:
+        progress = False
+        for rank, program in programs.items():
+            while pcs[rank] < len(program):
+                action = program[pcs[rank]]
+                if action.computation_type in _COMM_TYPES:
+                    pending[rank].append(action)
+                    pcs[rank] += 1
+                    continue
+                flush(rank)
+                stage, mb = action.stage_index, action.microbatch_index
+                dep = None
+                if action.computation_type == FORWARD and stage != 0:
+                    dep = (
+                        _Action(SEND_F, stage - 1, mb),
+                        _Action(RECV_F, stage, mb),
+                    )
+                elif (
+                    action.computation_type in (BACKWARD, BACKWARD_INPUT)
+                    and stage != num_stages - 1
+                ):
+                    dep = (
+                        _Action(SEND_B, stage + 1, mb),
+                        _Action(RECV_B, stage, mb),
+                    )
+                if dep is not None:
+                    assert dep[1] in posted_recvs, f"{action} without {dep[1]}"
+                    if dep[0] not in issued:
+                        break
+                pcs[rank] += 1
+                progress = True
+            if pcs[rank] == len(program):
+                flush(rank)
+
+    stuck = {
+        rank: program[pcs[rank]]
+        for rank, program in programs.items()
+        if pcs[rank] < len(program)
+    }
+    if stuck:
+        raise RuntimeError(f"Programs are stuck at {stuck}")
+
+
+def message(action):
+    """
+    Identify the message a communication action sends or receives.
+    """
+    if action.computation_type == SEND_F:
+        return (SEND_F, action.stage_index, action.microbatch_index)
+    if action.computation_type == RECV_F:
+        return (SEND_F, action.stage_index - 1, action.microbatch_index)
+    if action.computation_type == SEND_B:
+        return (SEND_B, action.stage_index, action.microbatch_index)
+    return (SEND_B, action.stage_index + 1, action.microbatch_index)
+
+
+def replay_nccl(programs, num_stages, coalesce=False):
+    """
+    Replay the per-rank programs with NCCL-like semantics, where the host does
+    not block but the device can: the P2P batches between two ranks run in
+    order on the stream of the pair, a batch starts once the computations
+    posted before it are done, and completes once all its receives have been
+    matched by a running batch of the peer (sends are buffered by the peer).
+    A computation waits for the batch carrying its receive. Batches are formed
+    as in `_group_p2p`.
+    Raises if the programs cannot finish.
+    """
+    group_size = len(programs)
+
+    def rank_of(stage):
+        return stage % group_size
+
+    def peer_of(action):
+        stage = action.stage_index
+        if action.computation_type in (SEND_F, RECV_B):
+            return rank_of(stage + 1)
+        return rank_of(stage - 1)
+
+    # batch: (rank, peers, actions, number of computations posted before it)
+    batches = []
+    # (rank, peer) -> batch ids in issue order
+    streams = {}
+    # rank -> computations in order
+    computes = {}
+    # receive action -> id of the batch carrying it
+    recv_batch = {}
+    for rank, program in programs.items():
+        computes[rank] = []
+        pending = []
+
+        def flush():
+            if not pending:
+                return
+            if coalesce:
+                groups = [list(pending)]
+            else:
+                by_key = {}
+                n_recvs = {}
+                for a in pending:
+                    peer = peer_of(a)
+                    if a.computation_type in (RECV_F, RECV_B):
+                        index = n_recvs.get(peer, 0)
+                        n_recvs[peer] = index + 1
+                    else:
+                        index = 0
+                    by_key.setdefault((peer, index), []).append(a)
+                groups = [by_key[k] for k in sorted(by_key)]
+            for group in groups:
+                batch_id = len(batches)
+                peers = {peer_of(a) for a in group}
+                batches.append((rank, peers, group, len(computes[rank])))
+                for peer in peers:
+                    streams.setdefault((rank, peer), []).append(batch_id)
+                for a in group:
+                    if a.computation_type in (RECV_F, RECV_B):
+                        recv_batch[a] = batch_id
+            pending.clear()
+
+        for action in program:
+            if action.computation_type in _COMM_TYPES:
+                pending.append(action)
+                continue
+            flush()
+            computes[rank].append(action)
+        flush()
+
+    def consumed_recv(action):
+        stage = action.stage_index
+        if action.computation_type == FORWARD and stage != 0:
+            return _Action(RECV_F, stage, action.microbatch_index)
+        if (
+            action.computation_type in (BACKWARD, BACKWARD_INPUT)
+            and stage != num_stages - 1
+        ):
+            return _Action(RECV_B, stage, action.microbatch_index)
+        return None
+
+    batch_of_send = {
+        message(a): i
+        for i, (_, _, group, _) in enumerate(batches)
+        for a in group
+        if a.computation_type in (SEND_F, SEND_B)
+    }
+    done_computes = {rank: 0 for rank in programs}
+    started = set()
+    completed = set()
+    progress = True
+    while progress:
+        progress = False
+        for i, (rank, peers, group, n_computes) in enumerate(batches):
+            if i not in started and done_computes[rank] >= n_computes:
+                # Head of the stream of every pair it belongs to
+                if all(
+                    all(
+                        j in completed
+                        for j in streams[(rank, peer)][
+                            : streams[(rank, peer)].index(i)
+                        ]
+                    )
+                    for peer in peers
+                ):
+                    started.add(i)
+                    progress = True
+            if i in started and i not in completed:
+                matched = all(
+                    batch_of_send.get(message(a)) in started
+                    for a in group
+                    if a.computation_type in (RECV_F, RECV_B)
+                )
+                if matched:
+                    completed.add(i)
+                    progress = True
+        for rank in programs:
+            while done_computes[rank] < len(computes[rank]):
+                recv = consumed_recv(computes[rank][done_computes[rank]])
+                if recv is not None and recv_batch[recv] not in completed:
+                    break
+                done_computes[rank] += 1
+                progress = True
+
+    if len(completed) != len(batches) or any(
+        done_computes[rank] != len(computes[rank]) for rank in programs
+    ):
+        raise RuntimeError(
+            "Programs deadlock on device at "
+            + str(
+                {
+                    rank: computes[rank][done_computes[rank]]
+                    for rank in programs
+                    if done_computes[rank] < len(computes[rank])
+                }
+            )
+        )
+
+
+class TestScheduleProgram(unittest.TestCase):
+    def check(
+        self,
+        programs,
+        num_stages,
+        n_microbatches,
+        has_backward,
+        split_backward=False,
+        coalesce=False,
+    ):
+        replay(programs, num_stages)
+        replay_nccl(programs, num_stages, coalesce)
+        counts = Counter(
+            action
+            for program in programs.values()
+            for action in program
+            if action.computation_type not in _COMM_TYPES
+        )
+        backward_types = (
+            (BACKWARD_INPUT, BACKWARD_WEIGHT) if split_backward else (BACKWARD,)
+        )
+        for stage in range(num_stages):
+            for mb in range(n_microbatches):
+                self.assertEqual(counts[_Action(FORWARD, stage, mb)], 1)
+                for computation_type in backward_types:
+                    self.assertEqual(
+                        counts[_Action(computation_type, stage, mb)],
+                        1 if has_backward else 0,
+                    )
+        self.assertEqual(
+            sum(counts.values()),
+            num_stages
+            * n_microbatches
+            * (1 + len(backward_types) * has_backward),
+        )
+        # Every send has exactly one matching receive
+        sends = Counter(
+            (a.computation_type, a.stage_index, a.microbatch_index)
+            for program in programs.values()
+            for a in program
+            if a.computation_type in (SEND_F, SEND_B)
+        )
+        recvs = Counter(
+            (
+                SEND_F if a.computation_type == RECV_F else SEND_B,
+                a.stage_index - 1
+                if a.computation_type == RECV_F
+                else a.stage_index + 1,
+                a.microbatch_index,
+            )
+            for program in programs.values()
+            for a in program
+            if a.computation_type in (RECV_F, RECV_B)
+        )
+        self.assertEqual(sends, recvs)
+
+    def test_single_stage_schedules(self):
+        for program_fn in (_gpipe_program, _1f1b_program):
+            for num_stages in (1, 2, 4):
+                for n_microbatches in (1, 3, 4, 8):
+                    for has_backward in (True, False):
+                        programs = single_stage_programs(
+                            program_fn, n_microbatches, num_stages, has_backward
+                        )
+                        self.check(
+                            programs, num_stages, n_microbatches, has_backward
+                        )
+
+    def test_prefetch(self):
+        for program_fn in (_gpipe_program, _1f1b_program):
+            program = program_fn(8, 4, 1, True)
+            # The receive of the next microbatch is posted before the
+            # computation of the current one
+            for mb in range(7):
+                for recv_type, computation_type in (
+                    (RECV_F, FORWARD),
+                    (RECV_B, BACKWARD),
+                ):
+                    self.assertLess(
+                        program.index(_Action(recv_type, 1, mb + 1)),
+                        program.index(_Action(computation_type, 1, mb)),
+                    )
+
+    def test_without_prefetch(self):
+        consumer = {RECV_F: (FORWARD,), RECV_B: (BACKWARD, BACKWARD_INPUT)}
+        for program_fn in (
+            _gpipe_program,
+            _1f1b_program,
+            _zero_bubble_h1_program,
+        ):
+            for num_stages in (2, 4):
+                programs = {
+                    rank: _without_prefetch(program, num_stages)
+                    for rank, program in single_stage_programs(
+                        program_fn, 8, num_stages, True
+                    ).items()
+                }
+                self.check(
+                    programs,
+                    num_stages,
+                    8,
+                    True,
+                    split_backward=program_fn is _zero_bubble_h1_program,
+                )
+                # Every receive is right before the computation consuming it
+                for program in programs.values():
+                    for a, b in zip(program, program[1:]):
+                        if a.computation_type in consumer:
+                            self.assertIn(
+                                b.computation_type,
+                                consumer[a.computation_type],
+                            )
+                            self.assertEqual(
+                                b.microbatch_index, a.microbatch_index
+                            )
+        # Programs already posting receives late are unchanged
+        program = _zero_bubble_h1_program(8, 4, 1, True)
+        self.assertEqual(_without_prefetch(program, 4), program)
+
+    def test_zero_bubble_h1(self):
+        for num_stages in (1, 2, 4):
+            for n_microbatches in (1, 3, 4, 8):
+                for has_backward in (True, False):
+                    programs = single_stage_programs(
+                        _zero_bubble_h1_program,
+                        n_microbatches,
+                        num_stages,
+                        has_backward,
+                    )
+                    self.check(
+                        programs,
+                        num_stages,
+                        n_microbatches,
+                        has_backward,
+                        split_backward=has_backward,
+                    )
+                    if not has_backward:
+                        continue
+                    # Weight passes follow their input gradient pass
+                    for program in programs.values():
+                        for i, a in enumerate(program):
+                            if a.computation_type == BACKWARD_WEIGHT:
+                                self.assertIn(
+                                    a._replace(computation_type=BACKWARD_INPUT),
+                                    program[:i],
+                                )
+
+    def test_multi_stage_schedules(self):
+        for programs_fn in (looped_bfs_programs, interleaved_programs):
+            for group_size, n_local in ((2, 2), (4, 2), (2, 4)):
+                for n_microbatches in (group_size, 2 * group_size):
+                    for has_backward in (True, False):
+                        programs = programs_fn(
+                            n_microbatches, group_size, n_local, has_backward
+                        )
+                        self.check(
+                            programs,
+                            group_size * n_local,
+                            n_microbatches,
+                            has_backward,
+                            coalesce=programs_fn is interleaved_programs,
+                        )
+
+    def test_num_recv_slots(self):
+        num_stages, n_microbatches = 4, 16
+        for stage in range(1, num_stages):
+            # Double buffering without backward
+            for program_fn in (_gpipe_program, _1f1b_program):
+                self.assertEqual(
+                    _num_recv_slots(
+                        program_fn(n_microbatches, num_stages, stage, False),
+                        stage,
+                    ),
+                    2,
+                )
+            # GPipe keeps every microbatch
+            self.assertEqual(
+                _num_recv_slots(
+                    _gpipe_program(n_microbatches, num_stages, stage, True),
+                    stage,
+                ),
+                n_microbatches,
+            )
+            # 1F1B keeps its warmup, the microbatch in its steady state and
+            # the one received ahead
+            self.assertEqual(
+                _num_recv_slots(
+                    _1f1b_program(n_microbatches, num_stages, stage, True),
+                    stage,
+                ),
+                2 * (num_stages - stage - 1) + 2,
+            )
+            # Kept until the weight pass in ZB-H1
+            self.assertEqual(
+                _num_recv_slots(
+                    _zero_bubble_h1_program(
+                        n_microbatches, num_stages, stage, True
+                    ),
+                    stage,
+                ),
+                num_stages,
+            )
+
+    def test_program_is_cached(self):
+        self.assertIs(
+            _1f1b_program(8, 4, 1, True), _1f1b_program(8, 4, 1, True)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import unittest
+
+import torch
+
+from pippy import pipe_split, pipeline
+from pippy.PipelineSchedule import (
+    _Action,
+    _add_p2p_actions,
+    _COMM_TYPES,
+    FORWARD,
+    RECV_F,
+    Schedule1F1B,
+    ScheduleGPipe,
+    ScheduleInterleaved1F1B,
+    ScheduleLoopedBFS,
+    ScheduleZeroBubbleH1,
+    SEND_F,
+)
+from pippy.ScheduleSimulator import (
+    costs_from_pipe,
+    get_schedule_programs,
+    PipelineCosts,
+    simulate_programs,
+    simulate_schedule,
+)
+
+
+d_hid = 16
+batch_size = 8
+chunks = 2
+
+
+class ExampleCode(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.lin0 = torch.nn.Linear(d_hid, d_hid)
+        self.lin1 = torch.nn.Linear(d_hid, d_hid)
+
+    def forward(self, x):
+        x = self.lin0(x)
+        pipe_split()
+        x = self.lin1(x)
+        return x
+
+
+def uniform_costs(num_stages, forward_time=1.0, backward_time=2.0, **kwargs):
+    return PipelineCosts(
+        forward_time=[forward_time] * num_stages,
+        backward_time=[backward_time] * num_stages,
+        activation_bytes=[1000] * num_stages,
+        **kwargs,
+    )
+
+
+class TestScheduleSimulator(unittest.TestCase):
+    def test_gpipe_bubble(self):
+        num_stages, n_microbatches = 4, 8
+        result = simulate_schedule(
+            ScheduleGPipe, n_microbatches, uniform_costs(num_stages)
+        )
+        # (n + p - 1) forward and backward slots
+        self.assertAlmostEqual(
+            result.step_time, (n_microbatches + num_stages - 1) * 3.0
+        )
+        self.assertAlmostEqual(
+            result.bubble_fraction,
+            (num_stages - 1) / (n_microbatches + num_stages - 1),
+        )
+        self.assertEqual(
+            result.peak_live_microbatches,
+            {rank: n_microbatches for rank in range(num_stages)},
+        )
+
+    def test_1f1b_memory(self):
+        num_stages, n_microbatches = 4, 8
+        costs = uniform_costs(num_stages)
+        gpipe = simulate_schedule(ScheduleGPipe, n_microbatches, costs)
+        one_f_one_b = simulate_schedule(Schedule1F1B, n_microbatches, costs)
+        self.assertLessEqual(one_f_one_b.step_time, gpipe.step_time)
+        for rank in range(num_stages):
+            self.assertEqual(
+                one_f_one_b.peak_live_microbatches[rank],
+                min(n_microbatches, 2 * (num_stages - rank - 1) + 1),
+            )
+
+    def test_zero_bubble_h1(self):
+        num_stages, n_microbatches = 4, 8
+        costs = uniform_costs(num_stages)
+        one_f_one_b = simulate_schedule(Schedule1F1B, n_microbatches, costs)
+        zb = simulate_schedule(ScheduleZeroBubbleH1, n_microbatches, costs)
+        self.assertLess(zb.bubble_fraction, one_f_one_b.bubble_fraction)
+        # Bubble of (p - 1) * (F + I - W)
+        self.assertAlmostEqual(
+            zb.step_time, n_microbatches * 3.0 + (num_stages - 1) * 1.0
+        )
+        self.assertEqual(
+            zb.peak_live_microbatches,
+            {rank: num_stages for rank in range(num_stages)},
+        )
+
+    def test_multi_stage_schedules(self):
+        costs = uniform_costs(8, latency=0.1, bandwidth=1e4)
+        for schedule_class in (ScheduleLoopedBFS, ScheduleInterleaved1F1B):
+            result = simulate_schedule(schedule_class, 4, costs, num_ranks=4)
+            self.assertEqual(set(result.busy_time.values()), {2 * 4 * 3.0})
+            self.assertGreater(result.bubble_fraction, 0)
+
+    def test_interleaved_partial_round(self):
+        # The number of microbatches is not a multiple of the number of ranks:
+        # the P2P ops are not posted in matching order, but do not hang when
+        # matched by tag, as in the simulator
+        costs = uniform_costs(8)
+        for n_microbatches in (1, 3, 5, 6):
+            for has_backward in (True, False):
+                result = simulate_schedule(
+                    ScheduleInterleaved1F1B,
+                    n_microbatches,
+                    costs,
+                    num_ranks=4,
+                    has_backward=has_backward,
+                )
+                step_time = 3.0 if has_backward else 1.0
+                self.assertEqual(
+                    set(result.busy_time.values()),
+                    {2 * n_microbatches * step_time},
+                )
+
+    def test_communication_cost(self):
+        fast = simulate_schedule(Schedule1F1B, 4, uniform_costs(2))
+        slow = simulate_schedule(
+            Schedule1F1B, 4, uniform_costs(2, latency=1.0, bandwidth=1e3)
+        )
+        self.assertGreater(slow.step_time, fast.step_time)
+
+    def test_prefetch_hides_latency(self):
+        num_stages, n_microbatches = 4, 8
+        costs = uniform_costs(num_stages, latency=0.5)
+        for schedule_class in (ScheduleGPipe, Schedule1F1B):
+            programs = get_schedule_programs(
+                schedule_class, n_microbatches, num_stages
+            )
+            # Same computations, with each receive posted right before the
+            # computation consuming it
+            unprefetched = {
+                rank: _add_p2p_actions(
+                    [
+                        a
+                        for a in program
+                        if a.computation_type not in _COMM_TYPES
+                    ],
+                    num_stages,
+                )
+                for rank, program in programs.items()
+            }
+            result = simulate_programs(programs, costs)
+            self.assertLess(
+                result.step_time,
+                simulate_programs(unprefetched, costs).step_time,
+            )
+            # Only the latency of filling and draining the pipeline is exposed
+            self.assertAlmostEqual(
+                result.step_time,
+                (n_microbatches + num_stages - 1) * 3.0
+                + 2 * (num_stages - 1) * 0.5,
+            )
+
+    def test_unmatched_send(self):
+        programs = get_schedule_programs(Schedule1F1B, 2, 2)
+        # Drop a receive of the second stage
+        programs[1] = tuple(
+            a for a in programs[1] if a != _Action(RECV_F, 1, 1)
+        )
+        with self.assertRaisesRegex(RuntimeError, "without posting"):
+            simulate_programs(programs, uniform_costs(2))
+
+    def test_hang(self):
+        programs = get_schedule_programs(
+            ScheduleGPipe, 2, 2, has_backward=False
+        )
+        # First stage never sends microbatch 1
+        programs[0] = (_Action(FORWARD, 0, 0), _Action(SEND_F, 0, 0))
+        with self.assertRaisesRegex(RuntimeError, "would hang"):
+            simulate_programs(programs, uniform_costs(2))
+
+    def test_costs_from_pipe(self):
+        x = torch.randn(batch_size, d_hid)
+        pipe = pipeline(ExampleCode(), chunks, example_args=(x,))
+        costs = costs_from_pipe(pipe, time_per_param=1e-6, bandwidth=1e9)
+        self.assertEqual(costs.num_stages, 2)
+        self.assertAlmostEqual(
+            costs.forward_time[0], (d_hid + 1) * d_hid * 1e-6
+        )
+        self.assertAlmostEqual(
+            costs.backward_time[0], 2 * costs.forward_time[0]
+        )
+        # One microbatch of float activations sent by the first stage
+        self.assertEqual(
+            costs.activation_bytes, [batch_size // chunks * d_hid * 4, 0]
+        )
+        result = simulate_schedule(Schedule1F1B, chunks, costs)
+        self.assertGreater(result.step_time, 0)
+
+    def test_invalid_layout(self):
+        with self.assertRaises(ValueError):
+            get_schedule_programs(Schedule1F1B, 4, 4, num_ranks=2)
+        with self.assertRaises(ValueError):
+            get_schedule_programs(ScheduleLoopedBFS, 4, 6, num_ranks=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates
+import itertools
+import unittest
+
+import torch
+
+from pippy import LinkCosts, pipe_split, pipeline, place_stages, stage_traffic
+from pippy.StagePlacement import _round_robin_pairs
+
+
+d_hid = 16
+batch_size = 8
+chunks = 2
+
+
+class SkipModel(torch.nn.Module):
+    """
+    Three stages; the first one sends a wide tensor to the second one, and a
+    skip connection to the last one.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lin0 = torch.nn.Linear(d_hid, 4 * d_hid)
+        self.lin1 = torch.nn.Linear(4 * d_hid, d_hid)
+        self.lin2 = torch.nn.Linear(d_hid, d_hid)
+
+    def forward(self, x):
+        skip = torch.relu(x)
+        x = self.lin0(x)
+        pipe_split()
+        x = self.lin1(x)
+        pipe_split()
+        return self.lin2(x) + skip
+
+
+def two_hosts(host_of, intra_bw=1e11, inter_bw=1e9):
+    """
+    Links between the ranks on hosts `host_of`: within a host, they are 100x
+    faster than across hosts.
+    """
+    num_ranks = len(host_of)
+    return LinkCosts(
+        latency=[[1e-6] * num_ranks for _ in range(num_ranks)],
+        bandwidth=[
+            [intra_bw if h == host else inter_bw for h in host_of]
+            for host in host_of
+        ],
+    )
+
+
+class TestStagePlacement(unittest.TestCase):
+    def test_round_robin_pairs(self):
+        for num_ranks in range(1, 8):
+            rounds = _round_robin_pairs(num_ranks)
+            pairs = [pair for pairs in rounds for pair in pairs]
+            self.assertEqual(
+                sorted(pairs),
+                list(itertools.combinations(range(num_ranks), 2)),
+            )
+            for pairs in rounds:
+                ranks = [r for pair in pairs for r in pair]
+                self.assertEqual(len(ranks), len(set(ranks)))
+
+    def test_stage_traffic(self):
+        x = torch.randn(batch_size, d_hid)
+        pipe = pipeline(SkipModel(), chunks, example_args=(x.chunk(chunks)[0],))
+        traffic = stage_traffic(pipe)
+        mb = batch_size // chunks
+        self.assertEqual(traffic[(0, 1)], mb * 4 * d_hid * 4)
+        self.assertEqual(traffic[(1, 2)], mb * d_hid * 4)
+        self.assertEqual(traffic[(0, 2)], mb * d_hid * 4)
+        self.assertEqual(len(traffic), 3)
+
+    def test_place_stages(self):
+        # A chain of 4 stages, whose middle boundary has the least traffic,
+        # on 2 hosts of 2 ranks. Wrapped around, every boundary would cross
+        # hosts; only the middle one should.
+        traffic = {(0, 1): 1e9, (1, 2): 1e6, (2, 3): 1e9}
+        host_of = [0, 1, 0, 1]
+        placement = place_stages(traffic, 4, two_hosts(host_of))
+        self.assertEqual(sorted(placement), [0, 1, 2, 3])
+        hosts = [host_of[rank] for rank in placement]
+        self.assertEqual(hosts[0], hosts[1])
+        self.assertEqual(hosts[2], hosts[3])
+        self.assertNotEqual(hosts[1], hosts[2])
+
+        # Several stages per rank, deterministic
+        placement = place_stages(traffic, 8, two_hosts(host_of))
+        self.assertEqual(sorted(placement), [0, 0, 1, 1, 2, 2, 3, 3])
+        self.assertEqual(
+            placement, place_stages(traffic, 8, two_hosts(host_of))
+        )
+
+        with self.assertRaises(ValueError):
+            place_stages(traffic, 6, two_hosts(host_of))
+
+    def test_invalid_link_costs(self):
+        with self.assertRaises(ValueError):
+            LinkCosts(latency=[[0.0, 1.0]], bandwidth=[[1.0, 1.0]])
+
+
+if __name__ == "__main__":
+    unittest.main()